@@ -24,6 +24,13 @@
 # these can be ignored.
 #
 # Typical use: python3 config-generator.py --in_file=./IDY_Bin_Mapping.xlsx -d True --out_file="./test.3SC"
+# or, from a CSV saved from the workbook, or any 'count|location|type|bin' rows on stdin:
+#   python3 config-generator.py --in_file=./IDY_Bin_Mapping.csv --out_file="./test.3SC"
+#   cat idy_bins.lst | python3 config-generator.py --in_file=- --out_file="./test.3SC"
+# or, for every branch's sheet of one workbook, writing matrices/EPLIDY.3SC, matrices/EPLIDY.csv and so on:
+#   python3 config-generator.py --in_file=./Bin_Mappings.xlsx --all_branches --out_dir=./matrices
+# or, to try out changes to the bins and see their effect as they are typed, 'move JUVFIC JBOOK 3' and so on:
+#   python3 config-generator.py --in_file=./IDY_Bin_Mapping.xlsx --what_if
 #
 # Copyright (c) 2020 Andrew Nisbet
 #
@@ -43,16 +50,537 @@
 # MA 02110-1301, USA.
 #
 #######################################################################################################################
-import xlrd
 import sys
 import argparse
 import re
 import os
-import declxml as xml
+import time
+import csv
+import struct
+import hashlib
+import zlib
+import random
+import heapq
+import bisect
+import io
+import contextlib
+import concurrent.futures
+from array import array
+import sortemu
+# xlrd is only needed to read Excel workbooks. CSV, TSV and pipe-delimited files, and stdin, are read without it.
+try:
+    import xlrd
+except ImportError:
+    xlrd = None
 
 # Reads in a standard XSLS spreadsheet and displays the entire contents in JSON.
 from typing import Dict
 
+# Set with --debug when run as a script.
+debug = False
+
+
+# Keeps the rows read from a staff workbook in a small binary file next to it, so that re-running the generator on
+# an unchanged workbook doesn't parse the sheet cell by cell again. The cache is keyed by the workbook's path, the
+# sheet index and a hash of the workbook's contents, and is simply rebuilt when any of them change.
+# Layout: header, the path, then zlib compressed rows, column by column: the spread sheet row numbers, and for each
+# of the 5 columns a type per row ('f' for a number, 's' for text), the numbers, and the indexes of the texts in a
+# table of the distinct '\n' separated strings, which comes last.
+# param:  file name of the workbook.
+# param:  index the zero-based index of the sheet.
+class RowCache:
+    MAGIC = b'CGROWS01'
+    HEADER = struct.Struct('<8s32sIII')
+    COLUMN = struct.Struct('<II')
+
+    def __init__(self, file, index=0):
+        self.path = os.path.abspath(file)
+        self.index = index
+        self.cache_file = "{}.{}.rows".format(file, index)
+        digest = hashlib.sha256()
+        with open(file, 'rb') as workbook:
+            for block in iter(lambda: workbook.read(1 << 20), b''):
+                digest.update(block)
+        self.digest = digest.digest()
+
+    # Reads the cached rows.
+    # return: list of (row, cells), or None if there is no cache for this version of the workbook.
+    def load(self):
+        try:
+            with open(self.cache_file, 'rb') as cache:
+                data = cache.read()
+        except OSError:
+            return None
+        if len(data) < self.HEADER.size:
+            return None
+        (magic, digest, index, path_length, count) = self.HEADER.unpack_from(data)
+        offset = self.HEADER.size
+        if magic != self.MAGIC or digest != self.digest or index != self.index:
+            return None
+        if data[offset:offset + path_length].decode() != self.path:
+            return None
+        data = zlib.decompress(data[offset + path_length:])
+        rows = array('I')
+        rows.frombytes(data[:4 * count])
+        offset = 4 * count
+        columns = []
+        for col in range(5):
+            (number_count, text_count) = self.COLUMN.unpack_from(data, offset)
+            offset += self.COLUMN.size
+            types = data[offset:offset + count]
+            offset += count
+            numbers = array('d')
+            numbers.frombytes(data[offset:offset + 8 * number_count])
+            offset += 8 * number_count
+            texts = array('I')
+            texts.frombytes(data[offset:offset + 4 * text_count])
+            offset += 4 * text_count
+            columns.append((types, numbers, texts))
+        strings = data[offset:].decode().split('\n')
+        cells = []
+        for (types, numbers, texts) in columns:
+            number_values = iter(numbers)
+            text_values = iter([strings[i] for i in texts])
+            cells.append([next(number_values) if kind == 102 else next(text_values) for kind in types])
+        return [(row, list(row_cells)) for (row, row_cells) in zip(rows, zip(*cells))]
+
+    # Writes the rows to the cache. A cache that can't be written is just skipped.
+    # param:  rows list of (row, cells) as read from the workbook.
+    def save(self, rows):
+        strings = {}
+        columns = [(bytearray(), array('d'), array('I')) for col in range(5)]
+        for (row, cells) in rows:
+            for col in range(5):
+                (types, numbers, texts) = columns[col]
+                value = cells[col]
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    types.append(102) # 'f'
+                    numbers.append(value)
+                else:
+                    types.append(115) # 's'
+                    texts.append(strings.setdefault(str(value).replace('\n', ' '), len(strings)))
+        body = [array('I', [row for (row, cells) in rows]).tobytes()]
+        for (types, numbers, texts) in columns:
+            body += [self.COLUMN.pack(len(numbers), len(texts)), bytes(types), numbers.tobytes(), texts.tobytes()]
+        body.append('\n'.join(strings).encode())
+        path = self.path.encode()
+        try:
+            with open(self.cache_file, 'wb') as cache:
+                cache.write(self.HEADER.pack(self.MAGIC, self.digest, self.index, len(path), len(rows)))
+                cache.write(path)
+                cache.write(zlib.compress(b''.join(body), 1))
+        except OSError:
+            pass
+
+
+# Finds a small matrix that sorts every location and item type pair on the staff sheet into its bin. Each rule is a
+# set of locations and a set of item types, and matches every pair of one of its locations with one of its types,
+# so finding the rules for a bin is a covering problem: cover the bin's pairs with as few rules and names as
+# possible. A rule may include any pair of its own bin, or any pair that isn't on the sheet, since no item has it, but
+# never a pair that staff put in another bin or left for the exception bin. Rules for different bins then never
+# match the same item, so they can be in any order. Pairs of the exception bin need no rule at all, since the sorter
+# sends anything no rule matches there.
+# The search is greedy: it repeatedly takes the rule that covers the most pairs not yet covered for each name in it,
+# built around one location and all its types, or one type and all its locations. It then merges rules and drops
+# names and rules that other rules already cover, and starts again with some randomness until the time is up,
+# keeping the smallest matrix found for each bin.
+# param:  pair_counts dictionary of (location, type) to a dictionary of bin to the count of items staff put there.
+#   Where staff put a pair in more than one bin, it goes in the bin with the most items.
+# param:  exception_bin the bin where items go that no rule matches.
+# param:  field_limit most characters in a rule's location or item type field, or 0 for no limit. Default: 0.
+# param:  row_limit most characters in a rule's location and item type fields together, or 0 for no limit. Default: 0.
+class MatrixSynthesizer:
+
+    def __init__(self, pair_counts, exception_bin, field_limit=0, row_limit=0):
+        self.exception_bin = exception_bin
+        self.field_limit = field_limit
+        self.row_limit = row_limit
+        self.pair_bins = {}
+        self.pair_counts = {}
+        # Pairs staff put in more than one bin, and the items that won't go where some staff wanted.
+        self.conflicts = 0
+        self.conflict_items = 0
+        # The bins of the types found with each location, and of the locations found with each type.
+        self.location_pairs = {}
+        self.type_pairs = {}
+        for pair, bin_counts in pair_counts.items():
+            pair_bin = sorted(bin_counts.items(), key=lambda bin_count: (-bin_count[1], bin_count[0]))[0][0]
+            self.pair_bins[pair] = pair_bin
+            self.pair_counts[pair] = bin_counts[pair_bin]
+            if len(bin_counts) > 1:
+                self.conflicts += 1
+                self.conflict_items += sum(bin_counts.values()) - bin_counts[pair_bin]
+            (location, item_type) = pair
+            self.location_pairs.setdefault(location, {})[item_type] = pair_bin
+            self.type_pairs.setdefault(item_type, {})[location] = pair_bin
+        # Pairs that need a rule, by bin.
+        self.required = {}
+        for pair, pair_bin in self.pair_bins.items():
+            if pair_bin != exception_bin:
+                self.required.setdefault(pair_bin, set()).add(pair)
+        # Pairs too long to fit the limits even in a rule of their own.
+        self.oversize = []
+        # The best rules found for each bin, as lists of [locations, types], see synthesize().
+        self.rules = {}
+        self.seconds = 0.0
+
+    # Searches for the smallest matrix until the time is up, but always finishes at least one pass over every bin.
+    # param:  seconds time to search for.
+    # param:  seed for the random choices after the first pass, so runs can be repeated.
+    # return: list of (bin, locations, types, affected) with sorted lists of names, and the count of items each rule
+    #   sorts, ordered by bin.
+    def synthesize(self, seconds=1.0, seed=0):
+        start = time.time()
+        deadline = start + seconds
+        rng = random.Random(seed)
+        for bin_number in sorted(self.required):
+            self.rules[bin_number] = self._improve_(bin_number, self._cover_(bin_number))
+        # A bin covered with one rule can't do better.
+        improvable = [bin_number for bin_number in sorted(self.required) if len(self.rules[bin_number]) > 1]
+        while improvable and time.time() < deadline:
+            for bin_number in improvable:
+                if time.time() >= deadline:
+                    break
+                rules = self._improve_(bin_number, self._cover_(bin_number, rng))
+                if self._cost_(rules) < self._cost_(self.rules[bin_number]):
+                    self.rules[bin_number] = rules
+        self.seconds = time.time() - start
+        return self.matrix()
+
+    # return: list of (bin, locations, types, affected) of the best rules found, see synthesize().
+    def matrix(self):
+        matrix = []
+        for bin_number in sorted(self.rules):
+            counted = set()
+            for (locations, types) in self.rules[bin_number]:
+                pairs = set([(location, item_type) for location in locations for item_type in types]) \
+                    & self.required[bin_number]
+                affected = sum([self.pair_counts[pair] for pair in pairs - counted])
+                counted |= pairs
+                matrix.append((bin_number, sorted(locations), sorted(types), affected))
+        return matrix
+
+    # return: the number of rules, and names in them, found so far, and the same for one rule per bin.
+    def size(self):
+        rows = sum([len(rules) for rules in self.rules.values()])
+        names = sum([len(locations) + len(types) for rules in self.rules.values() for (locations, types) in rules])
+        bin_rows = len(self.required)
+        bin_names = sum([len(set([location for (location, item_type) in pairs]))
+                         + len(set([item_type for (location, item_type) in pairs]))
+                         for pairs in self.required.values()])
+        return rows, names, bin_rows, bin_names
+
+    # The cost of a bin's rules. Fewer rules first, then fewer names.
+    def _cost_(self, rules):
+        return len(rules), sum([len(locations) + len(types) for (locations, types) in rules])
+
+    # Tests if a rule is short enough for the sorter's web interface.
+    # param:  locations of the rule.
+    # param:  types of the rule.
+    # return: True if the rule is within the limits and False otherwise.
+    def _fits_(self, locations, types):
+        return self._fits_lengths_(len(', '.join(locations)), len(', '.join(types)))
+
+    # Tests if fields of these lengths are within the limits.
+    def _fits_lengths_(self, location_length, type_length):
+        if self.field_limit and (location_length > self.field_limit or type_length > self.field_limit):
+            return False
+        if self.row_limit and location_length + type_length > self.row_limit:
+            return False
+        return True
+
+    # Greedily covers a bin's pairs with rules.
+    # param:  bin_number the bin.
+    # param:  rng random.Random to break ties differently each pass, or None to always choose the same rules.
+    # return: list of [locations, types] sets.
+    def _cover_(self, bin_number, rng=None):
+        required = self.required[bin_number]
+        uncovered_types = {}
+        uncovered_locations = {}
+        for (location, item_type) in required:
+            uncovered_types.setdefault(location, set()).add(item_type)
+            uncovered_locations.setdefault(item_type, set()).add(location)
+        # All the bin's types for each of its locations and the other way round.
+        location_types = dict([(location, set(types)) for (location, types) in uncovered_types.items()])
+        type_locations = dict([(item_type, set(locations)) for (item_type, locations) in uncovered_locations.items()])
+        # Names that can't be in a rule with these, because the pair is in another bin.
+        blocked_types = dict([(location, set([item_type for (item_type, pair_bin)
+                                              in self.location_pairs[location].items() if pair_bin != bin_number]))
+                              for location in location_types])
+        blocked_locations = dict([(item_type, set([location for (location, pair_bin)
+                                                   in self.type_pairs[item_type].items() if pair_bin != bin_number]))
+                                  for item_type in type_locations])
+        # Candidates are kept on a heap by the score they had when last looked at. Scores only go down as pairs are
+        # covered, so a candidate that still beats the next one's old score when looked at again is the best.
+        heap = []
+        for location in sorted(location_types):
+            heap.append((float('-inf'), len(heap), 'location', location))
+        for item_type in sorted(type_locations):
+            heap.append((float('-inf'), len(heap), 'type', item_type))
+        rules = []
+        while uncovered_types:
+            best = None
+            while heap:
+                (old_score, order, kind, seed) = heapq.heappop(heap)
+                if kind == 'location':
+                    types = location_types[seed]
+                    locations = set([other for other in location_types if blocked_types[other].isdisjoint(types)
+                                     and not uncovered_types.get(other, set()).isdisjoint(types)])
+                    candidate = self._trim_(locations, set(types), uncovered_types)
+                else:
+                    locations = type_locations[seed]
+                    types = set([other for other in type_locations if blocked_locations[other].isdisjoint(locations)
+                                 and not uncovered_locations.get(other, set()).isdisjoint(locations)])
+                    candidate = self._trim_(set(locations), types, uncovered_types)
+                if candidate is None:
+                    continue
+                gain = self._gain_(candidate[0], candidate[1], uncovered_types)
+                if gain == 0:
+                    continue
+                score = gain / float(len(candidate[0]) + len(candidate[1]))
+                if rng:
+                    score *= 1.0 + rng.random() * 0.5
+                if heap and -score > heap[0][0]:
+                    heapq.heappush(heap, (-score, order, kind, seed))
+                    continue
+                best = candidate
+                heapq.heappush(heap, (-score, order, kind, seed))
+                break
+            if best is None:
+                # Not even a single pair fits the limits, so it goes in a rule of its own anyway.
+                location = sorted(uncovered_types)[0]
+                best = [set([location]), set([sorted(uncovered_types[location])[0]])]
+                self.oversize.append((location, sorted(uncovered_types[location])[0]))
+            rules.append(best)
+            (locations, types) = best
+            for location in locations:
+                for item_type in types & uncovered_types.get(location, set()):
+                    uncovered_types[location].discard(item_type)
+                    uncovered_locations[item_type].discard(location)
+                    if not uncovered_locations[item_type]:
+                        del uncovered_locations[item_type]
+                if location in uncovered_types and not uncovered_types[location]:
+                    del uncovered_types[location]
+        return rules
+
+    # Counts the pairs a rule covers that aren't covered yet.
+    def _gain_(self, locations, types, uncovered_types):
+        return sum([len(uncovered_types.get(location, set()) & types) for location in locations])
+
+    # Drops the names that add the fewest uncovered pairs from the longer field until the rule fits the limits.
+    # return: [locations, types], or None if nothing of the rule fits.
+    def _trim_(self, locations, types, uncovered_types):
+        if self._fits_(locations, types):
+            return [locations, types]
+        type_gains = dict([(item_type, 0) for item_type in types])
+        for location in locations:
+            for item_type in uncovered_types.get(location, set()) & types:
+                type_gains[item_type] += 1
+        # The names to drop first are last.
+        location_order = sorted(locations, key=lambda name: (len(uncovered_types.get(name, set()) & types),
+                                                             -len(name), name), reverse=True)
+        type_order = sorted(types, key=lambda name: (type_gains[name], -len(name), name), reverse=True)
+        location_length = len(', '.join(locations))
+        type_length = len(', '.join(types))
+        while locations and types and not self._fits_lengths_(location_length, type_length):
+            if location_length >= type_length:
+                location = location_order.pop()
+                locations.discard(location)
+                location_length -= len(location) + 2
+            else:
+                item_type = type_order.pop()
+                types.discard(item_type)
+                type_length -= len(item_type) + 2
+        if not locations or not types:
+            return None
+        return [locations, types]
+
+    # Merges rules where the result is allowed and fits, then drops names, and rules, whose pairs other rules
+    # already cover.
+    # param:  bin_number the bin.
+    # param:  rules list of [locations, types] sets from _cover_().
+    # return: the improved rules.
+    def _improve_(self, bin_number, rules):
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(rules)):
+                if rules[i] is None:
+                    continue
+                for j in range(i + 1, len(rules)):
+                    if rules[j] is None:
+                        continue
+                    locations = rules[i][0] | rules[j][0]
+                    types = rules[i][1] | rules[j][1]
+                    if self._allows_(bin_number, locations, types) and self._fits_(locations, types):
+                        rules[i] = [locations, types]
+                        rules[j] = None
+                        merged = True
+            rules = [rule for rule in rules if rule is not None]
+        required = self.required[bin_number]
+        coverage = {}
+        for (locations, types) in rules:
+            for location in locations:
+                for item_type in types:
+                    if (location, item_type) in required:
+                        coverage[(location, item_type)] = coverage.get((location, item_type), 0) + 1
+        for rule in rules:
+            (locations, types) = rule
+            for location in sorted(locations):
+                pairs = [(location, item_type) for item_type in types if (location, item_type) in required]
+                if len(locations) > 1 and all([coverage[pair] > 1 for pair in pairs]):
+                    locations.discard(location)
+                    for pair in pairs:
+                        coverage[pair] -= 1
+            for item_type in sorted(types):
+                pairs = [(location, item_type) for location in locations if (location, item_type) in required]
+                if len(types) > 1 and all([coverage[pair] > 1 for pair in pairs]):
+                    types.discard(item_type)
+                    for pair in pairs:
+                        coverage[pair] -= 1
+        improved = []
+        for (locations, types) in rules:
+            pairs = [(location, item_type) for location in locations for item_type in types
+                     if (location, item_type) in required]
+            if all([coverage[pair] > 1 for pair in pairs]):
+                for pair in pairs:
+                    coverage[pair] -= 1
+            else:
+                improved.append([locations, types])
+        return improved
+
+    # Tests that a rule matches no pair that staff put in another bin.
+    def _allows_(self, bin_number, locations, types):
+        for location in locations:
+            for item_type in self.location_pairs.get(location, {}).keys() & types:
+                if self.location_pairs[location][item_type] != bin_number:
+                    return False
+        return True
+
+
+# Moves location and item type groups between bins so each bin fills at the same rate. The load of a bin is the count
+# of items expected there, from the spread sheet's count column, divided by the bin's capacity, so a bin twice the
+# size should get twice the items. Starting from the bins staff chose, the group that lowers the most loaded bin the
+# most is moved to another bin, or swapped with a group of about the right size from another bin, until no move makes
+# the fullest bin any emptier, or it is within the tolerance of an even fill. Few groups move, so the matrix stays close
+# to what staff asked for.
+# Pinned groups stay where they are, and nothing moves in or out of the exception bin.
+# param:  groups dictionary of (location, type, staff's bin) to [bin, count, pinned].
+# param:  capacities dictionary of bin to capacity. Bins not listed have a capacity of 1, and bins with a capacity of
+#   0 take no groups that aren't pinned there.
+# param:  exception_bin the exception bin.
+# param:  tolerance how much fuller than an even fill the fullest bin may be, as a fraction. Default: 0.01.
+class BinBalancer:
+
+    def __init__(self, groups, capacities, exception_bin, tolerance=0.01):
+        self.groups = groups
+        self.exception_bin = exception_bin
+        self.bins = sorted(set([group[0] for group in groups.values()] + list(capacities.keys()))
+                           - set([exception_bin]))
+        self.capacities = dict([(bin_number, float(capacities.get(bin_number, 1.0))) for bin_number in self.bins])
+        self.tolerance = tolerance
+        self.before = self.loads()
+        # (location, type, from bin, to bin) of each group that moved.
+        self.moves = []
+
+    # return: dictionary of bin to the count of items in it.
+    def loads(self):
+        loads = dict([(bin_number, 0) for bin_number in self.bins])
+        for (bin_number, count, pinned) in self.groups.values():
+            if bin_number in loads:
+                loads[bin_number] += count
+        return loads
+
+    # The load of a bin for its size.
+    def _fill_(self, loads, bin_number):
+        if self.capacities[bin_number] <= 0.0:
+            return float('inf') if loads[bin_number] else 0.0
+        return loads[bin_number] / self.capacities[bin_number]
+
+    # Moves and swaps groups until the fullest bin can't be made any emptier.
+    # return: list of (location, type, from bin, to bin) of the groups that moved.
+    def balance(self):
+        loads = self.loads()
+        # The groups that can move, by bin, and by count within a bin.
+        movable = dict([(bin_number, []) for bin_number in self.bins])
+        for pair, (bin_number, count, pinned) in self.groups.items():
+            if not pinned and count > 0 and bin_number in movable:
+                movable[bin_number].append((count, pair))
+        for bin_number in self.bins:
+            movable[bin_number].sort()
+        targets = [bin_number for bin_number in self.bins if self.capacities[bin_number] > 0.0]
+        total_capacity = sum([self.capacities[bin_number] for bin_number in targets])
+        even = sum(loads.values()) / total_capacity if total_capacity else 0.0
+        moved = {}
+        while True:
+            fullest = max(self.bins, key=lambda bin_number: (self._fill_(loads, bin_number), -bin_number))
+            peak = self._fill_(loads, fullest)
+            if peak <= even * (1.0 + self.tolerance):
+                break
+            best = None
+            best_peak = peak
+            for target in targets:
+                if target == fullest:
+                    continue
+                # Moving half the difference in load would even the two bins, so try the groups either side of it.
+                gap = self._gap_(loads, fullest, target)
+                for (count, pair) in self._near_(movable[fullest], gap):
+                    new_peak = max(self._fill_after_(loads, fullest, -count), self._fill_after_(loads, target, count))
+                    if new_peak < best_peak:
+                        (best, best_peak) = ((count, pair, target, None), new_peak)
+            # When no group can move on its own, a swap trades a group for a smaller one so the difference is about
+            # right.
+            for target in targets:
+                if best is not None and best[3] is None or target == fullest:
+                    continue
+                gap = self._gap_(loads, fullest, target)
+                for (count, pair) in movable[fullest]:
+                    for (other_count, other_pair) in self._near_(movable[target], count - gap):
+                        if other_count >= count:
+                            continue
+                        difference = count - other_count
+                        new_peak = max(self._fill_after_(loads, fullest, -difference),
+                                       self._fill_after_(loads, target, difference))
+                        if new_peak < best_peak:
+                            (best, best_peak) = ((count, pair, target, (other_count, other_pair)), new_peak)
+            # Stop when the fullest bin doesn't get noticeably emptier.
+            if best is None or best_peak >= peak * (1.0 - 1e-9):
+                break
+            (count, pair, target, swap) = best
+            self._move_(movable, loads, moved, count, pair, fullest, target)
+            if swap:
+                self._move_(movable, loads, moved, swap[0], swap[1], target, fullest)
+        for pair, (from_bin, to_bin) in sorted(moved.items()):
+            if from_bin != to_bin:
+                self.moves.append((pair[0], pair[1], from_bin, to_bin))
+        return self.moves
+
+    # The items that would even the load of two bins if moved from one to the other.
+    def _gap_(self, loads, fullest, target):
+        total = loads[fullest] + loads[target]
+        share = total * self.capacities[fullest] / (self.capacities[fullest] + self.capacities[target])
+        return loads[fullest] - share
+
+    # The fill of a bin after adding items to it.
+    def _fill_after_(self, loads, bin_number, count):
+        if self.capacities[bin_number] <= 0.0:
+            return float('inf') if loads[bin_number] + count else 0.0
+        return (loads[bin_number] + count) / self.capacities[bin_number]
+
+    # return: the groups of a sorted list with counts either side of a count.
+    def _near_(self, groups, count):
+        index = bisect.bisect_left(groups, (count,))
+        return groups[max(0, index - 2):index + 2]
+
+    # Moves a group from one bin to another.
+    def _move_(self, movable, loads, moved, count, pair, from_bin, to_bin):
+        movable[from_bin].remove((count, pair))
+        bisect.insort(movable[to_bin], (count, pair))
+        loads[from_bin] -= count
+        loads[to_bin] += count
+        self.groups[pair][0] = to_bin
+        moved[pair] = (moved.get(pair, (from_bin, from_bin))[0], to_bin)
+
 
 # ConfigGenerator builds an optimized configuration file based on staff recommendations provided in a simple
 # MicroSoft spread sheet. The first sheet should contain four columns. The second and third column must contain
@@ -74,15 +602,51 @@ from typing import Dict
 #  then the csv file opened and saved in MS office, Open Office or what have you. The XLS file should be saved as
 #  Excel 2007 XSLS file type.
 class ConfigGenerator:
+    # The columns of the staff sheet, in order.
+    COL_NAME: Dict[str, int] = {'count': 0, 'location': 1, 'type': 2, 'callnum': 3, 'bin': 4}
+    # Delimiters of the text formats that can be streamed instead of read from a workbook.
+    TEXT_FORMATS: Dict[str, str] = {'csv': ',', 'tsv': '\t', 'pipe': '|'}
+    # Ways _order_rules_() can order the rules: by its score, the rules that sort the fewest items first, or the most
+    # first, or by bin.
+    ORDERINGS = ('score', 'narrow', 'wide', 'bin')
 
-    # The constructor requires a file name (with path) to the XSLS file.
+    # The constructor requires a file name (with path) to the XSLS file, or a CSV, TSV or pipe-delimited file, or '-'
+    # to read stdin. See read_rows().
     # The XSLS configuration file must include a header row. The names read there are the index to the dictionaries.
     # param:  sheet_index the zero-based index to the sheet to read. Default: 0.
+    # param:  file_format one of 'xlsx', 'csv', 'tsv' or 'pipe', or '' to tell from the file name. Default: ''.
+    # param:  use_cache - True to keep the rows read from a workbook in a RowCache. Default: True.
+    # param:  location_db - reference table of all locations, so globs don't catch locations no rule names.
+    #   Default: 'location.db'.
+    # param:  type_db - reference table of all item types. Default: 'type.db'.
+    # param:  minimize - True to search for the smallest matrix with a MatrixSynthesizer, rather than make one rule
+    #   for each bin. Default: False.
+    # param:  field_limit - most characters in a location or item type field of a minimized rule, 0 for no limit.
+    # param:  row_limit - most characters in both fields of a minimized rule together, 0 for no limit.
+    # param:  time_budget - seconds to search for the smallest matrix. Default: 1.0.
+    # param:  balance - True to move location and item type groups between bins with a BinBalancer, so the bins
+    #   fill evenly. This turns on minimize, since one rule per bin, of all its locations by all its item types, would
+    #   take much more than the groups that moved. Default: False.
+    # param:  capacities - capacity of each bin for balancing, like '1:2,7:0.5'. Unlisted bins have a capacity of 1.
+    # param:  pins - file of 'location|type|bin' lines of groups that must go to a bin, where the location or type
+    #   can be '*' for any. Default: '', none.
+    # param:  compression - minimum length of the start of a name that wildcards are made from, see __compress__().
+    #   Default: 3.
+    # param:  ordering - one of ORDERINGS, how _order_rules_() orders the rules. Default: 'score'.
+    # param:  rows - the rows of the sheet if they have already been read with read_rows(), so they aren't read
+    #   again. Default: None, read them from file.
+    # param:  library_code - code of the branch where the sorter operates, like EPLIDY. The sorting rules then only
+    #   match items of that library, destined for it, see _set_branch_(). Default: '', any library.
+    # param:  profile - sortemu.ProfileStore file of catalog counts. Its locations and item types are added to the
+    #   vocabulary, like location_db and type_db. Default: '', none.
+    # param:  recount - True to replace the counts of the spread sheet with the profile's current counts, so that
+    #   balancing, minimizing and verifying weigh the catalog as it is now. Default: False.
     # param:  debug - output additional information. Default: False.
-    def __init__(self, file, index=0):
+    def __init__(self, file, index=0, file_format='', use_cache=True, location_db='location.db', type_db='type.db',
+                 minimize=False, field_limit=0, row_limit=0, time_budget=1.0, balance=False, capacities='',
+                 pins='', compression=3, ordering='score', rows=None, library_code='', profile='', recount=False):
         # The fewest number of bins permissible on any sorter real or fictional.
         self.MIN_BINS = 3
-        self.COL_NAME: Dict[str, int] = {'count': 0, 'location': 1, 'type': 2, 'callnum': 3, 'bin': 4}
         self.ALT_SORT_CRITERIA: list[str] = [
             "Alert",              # 'alert'
             "AlertType",          # HOLD_TYPE
@@ -107,6 +671,7 @@ class ConfigGenerator:
         self.BAD_TYPES = []
         # Keep count of the number of items in BAD_LOCATIONS so we can make a rule to catch them by default.
         self.rejected_item_count = 0
+        self.rejected_rule = []
         # The master matrix as an array (or List) of named rules. Their order matters. The smaller the index of
         # the rule, the sooner the rule is used for testing materials.
         self.matrix = []
@@ -122,23 +687,63 @@ class ConfigGenerator:
         self.last_bin = 0
         self.malformed_rule_name_row = {}
         self.malformed_rule_item_count = 0
+        self.malformed_rule = []
+        # Rules of self.matrix by name, built by _compile_rules_(), so each spread sheet row finds its bin's rule
+        # without searching the matrix.
+        self.rule_index = {}
+        # Seconds taken by each stage of the compilation, in the order they ran. See report_timings().
+        self.timings = []
+        self.use_cache = use_cache
+        self.compression = compression
+        self.library_code = library_code
+        self.ordering = ordering
+        self.minimize = minimize or balance
+        self.field_limit = field_limit
+        self.row_limit = row_limit
+        self.time_budget = time_budget
+        # The MatrixSynthesizer that found the rules, if minimize was set. See report().
+        self.synthesizer = None
+        self.balance = balance
+        self.capacities = capacities
+        self.pins = pins
+        # The BinBalancer that moved groups between bins, if balance was set. See report().
+        self.balancer = None
+        # Where the rows of the spread sheet really go, see verify_matrix().
+        self.verification = None
+        # Every location and item type a glob could match: those in the reference tables and the spread sheet.
+        self.location_vocabulary = self._read_vocabulary_(location_db)
+        self.type_vocabulary = self._read_vocabulary_(type_db)
+        # Catalog counts by location, item type and call number class, if there is a profile store.
+        self.profile = None
+        if profile:
+            self.profile = sortemu.ProfileStore(profile)
+            for location, item_type, call_class in self.profile.counts:
+                self.location_vocabulary.add(location)
+                self.type_vocabulary.add(item_type)
+        self.recount = recount and self.profile is not None
 
+        stage_start = time.time()
         # Ignore what the columns are called and use the names defined in self.col_name.
-        workbook = xlrd.open_workbook(file)
-        worksheet = workbook.sheet_by_index(index)
         for column_name, col_index in self.COL_NAME.items():
             self.header_row.append(column_name)
         # transform the staff_selection_workbook to a list of dictionies, building them up from the spread sheet
         # row-by-row.
-        for row in range(1, worksheet.nrows):
-            count_loc_typ_callnum_bin = {}
+        # These are required to define a matrix completely but most are irrelivant to the final output. Nothing
+        # changes them, so every row shares the same ['*'] lists.
+        alt_sort_criteria = dict([(column_name, ['*']) for column_name in self.ALT_SORT_CRITERIA])
+        if rows is None:
+            rows = self.read_rows(file, index, file_format, use_cache)
+        for row, cells in rows:
             item_count: int = 0
             # These are the minumum rows from the spread sheet.
-            for column_name, col_index in self.COL_NAME.items():
-                count_loc_typ_callnum_bin[self.header_row[col_index]] = worksheet.cell_value(row, col_index)
-            # These are required to define a matrix completely but most are irrelivant to the final output.
-            for column_name in self.ALT_SORT_CRITERIA:
-                count_loc_typ_callnum_bin[column_name] = ['*']
+            count_loc_typ_callnum_bin = dict(zip(self.header_row, cells))
+            count_loc_typ_callnum_bin.update(alt_sort_criteria)
+            if self.recount:
+                count_loc_typ_callnum_bin['count'] = float(self.profile.count(
+                    str(count_loc_typ_callnum_bin['location']), str(count_loc_typ_callnum_bin['type']),
+                    str(count_loc_typ_callnum_bin['callnum']) or '*'))
+            self.location_vocabulary.add(str(count_loc_typ_callnum_bin['location']))
+            self.type_vocabulary.add(str(count_loc_typ_callnum_bin['type']))
             # See if the location is one of the BAD_LOCATIONS keep a count and don't add it to any rule
             # Count the number of rules specified for each bin. We'll use this for reporting and for computing
             # which bin is the exception bin if one isn't specifically added in the column.
@@ -148,11 +753,13 @@ class ConfigGenerator:
             if count_loc_typ_callnum_bin['type'] in self.BAD_TYPES:
                 # TODO: Add switch so users can specify bad types, and code to add a bad item type rule.
                 self.rejected_item_count += item_count
+                self.rejected_rule.append(count_loc_typ_callnum_bin)
                 # Carry on to the next line in the spread sheet without further processing. Stops bad types
                 # ending up in the matrix. They are added explicitly later.
                 continue
             if count_loc_typ_callnum_bin['location'] in self.BAD_LOCATIONS:
                 self.rejected_item_count += item_count
+                self.rejected_rule.append(count_loc_typ_callnum_bin)
                 # Carry on to the next line in the spread sheet without further processing. Stops bad locations
                 # ending up in the matrix. They are added explicitly later.
                 continue
@@ -160,20 +767,23 @@ class ConfigGenerator:
             if count_loc_typ_callnum_bin['bin'] != '':
                 try:
                     my_bin_key: int = round(count_loc_typ_callnum_bin['bin'], None)
-                except ValueError:
+                except (ValueError, TypeError):
                     # Since we couldn't make the entry an integer, issue a warning to staff to fix it.
-                    if count_loc_typ_callnum_bin['bin'].upper() == "REJECT":
+                    if str(count_loc_typ_callnum_bin['bin']).upper() == "REJECT":
                         # TODO: We don't know what the reject bin is at this point but should handle these somehow
                         #  For now it isn't a problem because if it is REJECT these definitions won't be reflected
                         #  in the matrix, which means they won't be recognized by the sorter, which will then punt
                         #  them to the exception bin anyway.
-                        pass
+                        self.unhandled_rule.append(count_loc_typ_callnum_bin)
+                        self.unhandled_items_count += item_count
+                        continue
                     else:
                         if debug:  # These get reported in the report.
                             sys.stdout.write(" **WARN: invalid bin assignment '{}' on spread sheet row {}.\n".format(
                                 count_loc_typ_callnum_bin['bin'], row + 1))
                         self.malformed_rule_name_row[count_loc_typ_callnum_bin['bin']] = row + 1
                         self.malformed_rule_item_count += item_count
+                        self.malformed_rule.append(count_loc_typ_callnum_bin)
                         continue
                 if my_bin_key in self.bins:
                     self.bins[my_bin_key] += 1
@@ -186,8 +796,17 @@ class ConfigGenerator:
                 # Do these rules have any use? Is it just the counts we need?
                 self.unhandled_rule.append(count_loc_typ_callnum_bin)
                 self.unhandled_items_count += item_count
+        stage_start = self._time_stage_('read spread sheet', stage_start)
         if self._is_well_formed_(self.bins):
-            self._compile_rules_(self.all_count_locn_type_cnum_binnum)
+            if self.balance:
+                self._balance_bins_()
+                stage_start = self._time_stage_('balance', stage_start)
+            if self.minimize:
+                self._synthesize_rules_()
+                stage_start = self._time_stage_('synthesize', stage_start)
+            else:
+                self._compile_rules_(self.all_count_locn_type_cnum_binnum)
+                stage_start = self._time_stage_('compile', stage_start)
             # Add the default rule for unknown items to the new matrix, it will ensure there is at least one rule
             # on the matrix when we loop through for comparison. If you remove it, you will have to check if the
             # new_matrix has any items or the loop below will fail the first test and nothing will be added.
@@ -197,8 +816,14 @@ class ConfigGenerator:
                                                                         affected=self.rejected_item_count)}
                 self.matrix.append(bad_locn_rule)
             self._order_rules_()
+            stage_start = self._time_stage_('order', stage_start)
             self._compress_rules_()
+            stage_start = self._time_stage_('compress', stage_start)
             self._tidy_()
+            stage_start = self._time_stage_('tidy', stage_start)
+            if self.library_code:
+                self._set_branch_()
+                self._time_stage_('branch', stage_start)
         else:
             sys.stdout.write("There are errors in the spread sheet. Please fix them and re-run the application.\n")
             sys.exit(2)
@@ -206,6 +831,93 @@ class ConfigGenerator:
         if debug:
             sys.stdout.write(">>> JSON sorter rules:\n{0}\n\n".format(self.all_count_locn_type_cnum_binnum))
 
+    # Reads the rows of staff selections, skipping the header. Excel workbooks are read with xlrd. CSV, TSV and
+    # pipe-delimited files are streamed a row at a time, so the output of
+    # selitem -olt | pipe.pl -dc0,c1 -A -P
+    # with a bin added to each line can be piped straight in with '-'. Text rows can have 4 columns,
+    # 'count|location|type|bin', or 5 with the call number before the bin, and a first line that doesn't start with
+    # a count is taken to be a header. pipe.pl -P ends each line with the delimiter, so an empty last field is
+    # dropped, unless the header names that many columns, when it is an empty bin. Counts and bins are read as
+    # numbers, as they would be from a workbook.
+    # param:  file name of the file, or '-' for stdin.
+    # param:  index the zero-based index of the sheet in a workbook.
+    # param:  file_format one of 'xlsx', 'csv', 'tsv' or 'pipe', or '' to tell from the file name.
+    # param:  use_cache True to keep the rows read from a workbook in a RowCache.
+    # return: generator of (row, cells) where row is the zero-based row and cells are the 5 columns of COL_NAME.
+    @classmethod
+    def read_rows(cls, file, index=0, file_format='', use_cache=True):
+        if not file_format:
+            extension = os.path.splitext(file)[1].lower()
+            if extension in ('.xls', '.xlsx'):
+                file_format = 'xlsx'
+            elif extension == '.csv':
+                file_format = 'csv'
+            elif extension in ('.tsv', '.tab'):
+                file_format = 'tsv'
+            else:
+                file_format = 'pipe'
+        if file_format not in cls.TEXT_FORMATS:
+            row_cache = RowCache(file, index) if use_cache else None
+            rows = row_cache.load() if row_cache else None
+            if rows is None:
+                if xlrd is None:
+                    sys.stderr.write("**error: xlrd is needed to read '{}'. Save the sheet as CSV, or install xlrd.\n"
+                                     .format(file))
+                    sys.exit(2)
+                worksheet = xlrd.open_workbook(file).sheet_by_index(index)
+                rows = [(row, [worksheet.cell_value(row, col_index) for col_index in cls.COL_NAME.values()])
+                        for row in range(1, worksheet.nrows)]
+                if row_cache:
+                    row_cache.save(rows)
+            elif debug:
+                sys.stdout.write("read {} rows from cache {}.\n".format(len(rows), row_cache.cache_file))
+            for row, cells in rows:
+                yield row, cells
+            return
+        if file == '-':
+            text_file = sys.stdin
+        else:
+            text_file = open(file, 'r', newline='')
+        try:
+            row = -1
+            # Number of columns the header names, 0 without a header.
+            header_columns = 0
+            for fields in csv.reader(text_file, delimiter=cls.TEXT_FORMATS[file_format]):
+                row += 1
+                if len(fields) > 1 and fields[-1].strip() == '' and len(fields) != header_columns:
+                    # The line ends with the delimiter, as from pipe.pl -P.
+                    fields.pop()
+                cells = [field.strip() for field in fields]
+                if not cells:
+                    continue
+                cells[0] = cls._cell_value_(cells[0])
+                if row == 0 and isinstance(cells[0], str):
+                    header_columns = len(cells)
+                    continue
+                if len(cells) == 3:
+                    cells += ['*', '']
+                elif len(cells) == 4:
+                    cells.insert(cls.COL_NAME['callnum'], '*')
+                elif len(cells) != len(cls.COL_NAME):
+                    sys.stderr.write("**error: expected {} columns but got {} on row {}.\n"
+                                     .format(len(cls.COL_NAME), len(cells), row + 1))
+                    continue
+                cells[-1] = cls._cell_value_(cells[-1])
+                yield row, cells
+        finally:
+            if text_file is not sys.stdin:
+                text_file.close()
+
+    # Reads a number from a text file the way a workbook cell would be read, as a float.
+    # param:  field string.
+    # return: float, or the string if it isn't a number.
+    @staticmethod
+    def _cell_value_(field):
+        try:
+            return float(field)
+        except ValueError:
+            return field
+
     # Gets the item count if the column contains a number but populate default rules if it contains 'hold*'
     # in any case. In that case create default rules.
     # param:  The count as a string.
@@ -221,15 +933,20 @@ class ConfigGenerator:
             sys.stderr.write("**error: invalid value found. Expected an integer but got '{}'.\n".format(count_str))
         return item_count
 
+    # Records how long a stage of the compilation took.
+    # param:  stage name of the stage.
+    # param:  stage_start time the stage started.
+    # return: the time now, which is when the next stage starts.
+    def _time_stage_(self, stage, stage_start):
+        now = time.time()
+        self.timings.append((stage, now - stage_start))
+        return now
+
     # Helper function to find a named dictionary in the List of rules.
     # param:  name of the dictionary.
     # return: the dictionary, if there is one, and None none were found with that name.
     def __search__(self, name):
-        rule: dict
-        for rule in self.matrix:
-            if name in rule:
-                return rule
-        return None
+        return self.rule_index.get(name)
 
     # Rules begin compilation by creating one rule for each bin and adding all the locations and item types that
     # need to match for that rule to fire. One rule which should covers the largest number of items in the catalog
@@ -245,7 +962,7 @@ class ConfigGenerator:
             affected_count: int = round(ss_item['count'], None)
             this_bin_num: int = round(ss_item['bin'], None)
             r_name = "R{}".format(this_bin_num)
-            existing_rule = self.__search__(r_name)
+            existing_rule = self.rule_index.get(r_name)
             if existing_rule:
                 rule_content = existing_rule[r_name]
                 new_location: str = ss_item['location']
@@ -260,53 +977,164 @@ class ConfigGenerator:
                                 'affected': affected_count}
                 new_rule = {r_name: rule_content}
                 self.matrix.append(new_rule)
+                self.rule_index[r_name] = new_rule
+
+    # Reassigns the bins of the spread sheet rows so that the bins fill evenly for their capacities, see BinBalancer.
+    # Rows for the same location and item type, and bin, move together. Rows matching a pin go to the pinned bin.
+    def _balance_bins_(self):
+        pins = self._read_pins_(self.pins)
+        groups = {}
+        for ss_item in self.all_count_locn_type_cnum_binnum:
+            (location, item_type) = (str(ss_item['location']), str(ss_item['type']))
+            bin_number = round(ss_item['bin'], None)
+            group = groups.setdefault((location, item_type, bin_number), [bin_number, 0, False])
+            group[1] += self._get_integer_(ss_item['count'])
+            for (pin_location, pin_type, pin_bin) in pins:
+                if pin_location in ('*', location) and pin_type in ('*', item_type):
+                    group[0] = pin_bin
+                    group[2] = True
+                    break
+        self.balancer = BinBalancer(groups, self._read_capacities_(self.capacities), self.exception_bin)
+        self.balancer.balance()
+        self.bins = {}
+        for ss_item in self.all_count_locn_type_cnum_binnum:
+            bin_number = round(ss_item['bin'], None)
+            new_bin = groups[(str(ss_item['location']), str(ss_item['type']), bin_number)][0]
+            if new_bin != bin_number:
+                ss_item['bin'] = float(new_bin)
+            self.bins[new_bin] = self.bins.get(new_bin, 0) + 1
+
+    # Reads the groups that must go to a particular bin.
+    # param:  file_name file of 'location|type|bin' lines, where the location or type can be '*' for any.
+    # return: list of (location, type, bin), in the order of the file.
+    def _read_pins_(self, file_name):
+        pins = []
+        if not file_name:
+            return pins
+        with open(file_name, 'r') as pin_file:
+            for line_number, line in enumerate(pin_file, 1):
+                fields = [field.strip() for field in line.split('|')]
+                if len(fields) < 3 or not fields[0]:
+                    continue
+                try:
+                    pins.append((fields[0], fields[1], int(float(fields[2]))))
+                except ValueError:
+                    sys.stderr.write("**error: invalid bin '{}' on line {} of {}.\n"
+                                     .format(fields[2], line_number, file_name))
+        return pins
+
+    # Reads the capacities of bins.
+    # param:  text like '1:2,7:0.5', capacity 2 for bin 1, and 0.5 for bin 7.
+    # return: dictionary of bin to capacity.
+    def _read_capacities_(self, text):
+        capacities = {}
+        for spec in [spec for spec in text.split(',') if spec.strip()]:
+            try:
+                (bin_number, capacity) = spec.split(':')
+                capacities[int(bin_number)] = float(capacity)
+            except ValueError:
+                sys.stderr.write("**error: invalid bin capacity '{}', expected 'bin:capacity'.\n".format(spec))
+                sys.exit(2)
+        return capacities
+
+    # Builds the matrix with the fewest rules and names that still sorts every location and item type pair on the
+    # spread sheet into the bin staff chose, with a MatrixSynthesizer. Pairs without a bin, or with a bin that isn't
+    # valid, have to end up in the exception bin, so no rule may match them.
+    def _synthesize_rules_(self):
+        pair_counts = {}
+        for ss_item in self.all_count_locn_type_cnum_binnum:
+            self._count_pair_(pair_counts, ss_item, round(ss_item['bin'], None))
+        for ss_item in self.unhandled_rule + self.malformed_rule:
+            self._count_pair_(pair_counts, ss_item, self.exception_bin)
+        self.synthesizer = MatrixSynthesizer(pair_counts, self.exception_bin, self.field_limit, self.row_limit)
+        for bin_number, locations, types, affected in self.synthesizer.synthesize(self.time_budget):
+            self.matrix.append({"R{}".format(bin_number): {'location': locations, 'type': types,
+                                                           'affected': affected}})
+
+    # Adds the items of a spread sheet row to the count for its location and item type in a bin.
+    def _count_pair_(self, pair_counts, ss_item, bin_number):
+        bin_counts = pair_counts.setdefault((str(ss_item['location']), str(ss_item['type'])), {})
+        bin_counts[bin_number] = bin_counts.get(bin_number, 0) + self._get_integer_(ss_item['count'])
 
     '''
-    Helper (static) function that finds and replaces multiple instances of rules that can be shortened by
+    Helper function that finds and replaces multiple instances of rules that can be shortened by
     replacing them with name globbing. For example 'they, them, these' can be replaced with 'the*' in the case
-    of sorter rule definitions.
-    param:  the_list List of words to compress by glob-ing and or deduplication of the list.
-    param:  length integer minimum number of initial characters that must match before the rule can be reduced.
-      Any value less than 1 will deduplicate the list, while values larger than the longest string will have no effect.
-      The default compression is 3 which makes most shortened words readable in the sort matrix.
-    >>> juv = ['JUV', 'JUV', 'JUV', 'JUViDVD', 'JUV_COMIC', 'JUV']
-    >>> print("=> {}\n".format(glob(juv, 0)))
-    ['JUV_COMIC', 'JUV', 'JUViDVD']
-    >>> juv = ['JUV', 'JUV_LIT', 'JUV_FIC', 'JUViDVD', 'JUV_COMIC', 'JUV_COMICBOOK']
-    >>> print("=> {}\n".format(glob(juv, 1)))
-    ['J*']
-    >>> juv = ['JUV', 'JUV_LIT', 'JUV_FIC', 'JUViDVD', 'JUV_COMIC', 'JUV_COMICBOOK']
-    >>> print("=> {}\n".format(glob(juv, 2)))
-    ['JU*']
-    >>> juv = ['JUV', 'JUV_LIT', 'JUV_FIC', 'JUViDVD', 'JUV_COMIC', 'JUV_COMICBOOK']
-    >>> print("=> {}\n".format(glob(juv, 3)))
-    ['JUV*']
-    >>> juv = ['JUV', 'JUV_LIT', 'JUV_FIC', 'JUViDVD', 'JUV_COMIC', 'JUV_COMICBOOK']
-    >>> print("=> {}\n".format(glob(juv, 4)))
-    ['JUV', 'JUViDVD', 'JUV_*']
+    of sorter rule definitions, but only if no other word in the vocabulary, like 'then', starts with 'the'.
+    The vocabulary is kept as a prefix trie, flattened into a dictionary of how many of the rule's words, and how
+    many other words, start with each prefix. A prefix no other word starts with can be globbed, and the shortest
+    of those for each word gives the fewest globs that cover exactly the rule's words. A glob is only used if it
+    replaces at least two words.
+    param:  word_list List of words to compress by glob-ing and or deduplication of the list.
+    param:  minimum_length integer minimum number of initial characters that must match before the rule can be
+      reduced. Any value less than 1 will deduplicate the list, while values larger than the longest string will
+      have no effect. The default compression is 3 which makes most shortened words readable in the sort matrix.
+    param:  vocabulary set of all the words a glob could match, such as every location. Default: just word_list.
+    Examples, for juv = ['JUV', 'JUV_LIT', 'JUV_FIC', 'JUViDVD', 'JUV_COMIC', 'JUV_COMICBOOK']:
+      __compress__(['JUV', 'JUV', 'JUViDVD', 'JUV_COMIC'], 0) gives 'JUV', 'JUV_COMIC' and 'JUViDVD', in any order.
+      __compress__(juv, 1) gives ['J*'].
+      __compress__(juv, 3, set(juv + ['JUVENILE', 'JUNK'])) gives ['JUV', 'JUV_*', 'JUViDVD'].
+      __compress__(juv, 4) gives ['JUV', 'JUV_*', 'JUViDVD'].
     '''
-    def __compress__(self, word_list, minimum_length=3):
+    def __compress__(self, word_list, minimum_length=3, vocabulary=None):
         word_list: list
         # if the user wants fewer than length characters, assume they just want the list de-duplicated.
         if minimum_length < 1:
             return list(set(word_list))
-        # Sorting the list makes sure that the most similar words appear together.
-        word_list.sort()
-        for i in range(1, len(word_list)):
-            if word_list[i - 1][0:minimum_length] == word_list[i][0:minimum_length]:
-                word_list[i] = word_list[i - 1] = word_list[i][0:minimum_length] + '*'
-        # Remove all the repeated glob-ed words.
-        return list(set(word_list))
+        words = set([str(word) for word in word_list])
+        # A rule that takes anything can't be made any shorter.
+        if '*' in words:
+            return ['*']
+        if vocabulary is None:
+            vocabulary = words
+        # Count the rule's words and the other words under each prefix of at least minimum_length characters. Only
+        # other words that start the same way as one of the rule's words can stop it being globbed.
+        starts = set([word[:minimum_length] for word in words])
+        prefix_counts = {}
+        for word in words | set([word for word in vocabulary if word[:minimum_length] in starts]):
+            is_ours = word in words
+            for length in range(minimum_length, len(word) + 1):
+                counts = prefix_counts.setdefault(word[:length], [0, 0])
+                counts[0 if is_ours else 1] += 1
+        compressed = set()
+        for word in words:
+            for length in range(minimum_length, len(word) + 1):
+                (ours, others) = prefix_counts[word[:length]]
+                if others == 0:
+                    # The shortest prefix only the rule's words start with.
+                    if ours > 1:
+                        compressed.add(word[:length] + '*')
+                    else:
+                        compressed.add(word)
+                    break
+            else:
+                compressed.add(word)
+        return sorted(compressed)
 
     # Rules with similar prefixes can be reduced to one rule. For example, TEENFIC, TEENGEN, TEEMCOMIC
-    # can be reduced to TEEN*. This method does that. This method only looks at suffixes and the prefix
-    # must have at least 3 characters in length.
+    # can be reduced to TEEN*, as long as no other location starts with TEEN. This method does that. This method
+    # only looks at suffixes and the prefix must have at least 3 characters in length.
     def _compress_rules_(self):
         for rule in self.matrix:
             rule: dict
             for key, value in rule.items():
-                value['location'] = self.__compress__(value['location'], compression)
-                value['type'] = self.__compress__(value['type'], compression)
+                value['location'] = self.__compress__(value['location'], self.compression, self.location_vocabulary)
+                value['type'] = self.__compress__(value['type'], self.compression, self.type_vocabulary)
+
+    # Reads the names in a reference table, like location.db with its 'NAME|number' lines. A table that doesn't
+    # exist adds nothing.
+    # param:  file_name name of the table.
+    # return: set of names.
+    def _read_vocabulary_(self, file_name):
+        names = set()
+        if file_name and os.path.isfile(file_name):
+            with open(file_name, 'r') as db_file:
+                for line in db_file:
+                    name = line.split('|')[0].strip()
+                    if name:
+                        names.add(name)
+        elif debug:
+            sys.stdout.write("reference table '{}' not found, using the spread sheet's names only.\n".format(file_name))
+        return names
 
     # Orders the matrix so testing flows from most specific rule matching to most general.
     # Other facets of the algorithm include ordering specific exception item types before
@@ -335,8 +1163,6 @@ class ConfigGenerator:
         # 
         # * Reject rules are those marked with names: 'REJECT' as opposed to reject rules for BAD_LOCATIONS which are
         # named with the name of the exception bin specifically.
-        new_matrix = []
-        hierarchy_score: int = 0
         # Order the rules by high and low order, and sort.
         #
         # v is a dict: {"location": ['*'], "type": ['*'], "affected": 0, "alert": 3}
@@ -346,45 +1172,14 @@ class ConfigGenerator:
         for rule in self.matrix:
             rule: dict
             for key, value in rule.items():
-                if key == "REJECT":
-                    value['score'] = round(value['alert'], 2) * 100.0
-                    continue
-                # Count how many rules and compute 'score' where higher scores put rules higher in the matrix.
-                hierarchy_score = 0
-                for k, v in value.items():
-                    # the rule that has item rules will get double points.
-                    if k == 'type':
-                        hierarchy_score += round(len(v) * 2, 2)
-                    elif k == 'location':
-                        # The complexity of the location rules counts one-for-one.
-                        hierarchy_score += round(len(v), 2)
-                    elif k == 'affected':
-                        # The more items are affected, the lower in the matrix they go so less gregarious rules have
-                        # a chance to fire before the really big gregarious rules.
-                        try:
-                            hierarchy_score += round((1.0 / v) * 100.0, 2)
-                        except ZeroDivisionError:
-                            # "REJECT" rules have an effect on 0 known items.
-                            hierarchy_score += round(100.0, 2)
-                value['score'] = hierarchy_score
-
-        # * Order dictionaries by score.
-        for rule in self.matrix:
-            rule: dict
-            for key, value in rule.items():
-                for i in range(len(new_matrix)):
-                    for k, v in new_matrix[i].items():
-                        if v['score'] <= value['score']:
-                            new_matrix.insert(i, rule)
-                            break
-                    else:
-                        continue
-                    break
-                else:
-                    continue
-                break
-            else:
-                new_matrix.append(rule)
+                value['score'] = self._score_rule_(key, value)
+
+        # * Order dictionaries by score. Each rule goes above the first rule already placed with the same or a lower
+        #   score, so rules with equal scores end up in the reverse of their order in the matrix. A stable sort of
+        #   the reversed matrix, highest score first, gives the same order in one pass.
+        # * Other orderings rank the rules the same way, by the items they sort, fewest first for 'narrow' and most
+        #   first for 'wide', or by bin. See _rule_rank_().
+        new_matrix = sorted(reversed(self.matrix), key=self._rule_rank_, reverse=True)
         # Add rules to reject materials for other branches or ILL holds.
         hold_rule = dict(REJECT={
             "location": ['*'], "type": ['*'], "callnum": ['*'], "affected": 0, "alert": self.HOLD_TYPE['ill']})
@@ -402,6 +1197,143 @@ class ConfigGenerator:
                 print("{} ==> {}".format(key, value))
         self.matrix = new_matrix
 
+    # Scores a rule for _order_rules_(), before its names are compressed. Higher scores put rules higher in the
+    # matrix.
+    # param:  key name of the rule, like 'R1' or 'REJECT'.
+    # param:  value dictionary of the rule's 'location' and 'type' lists, and 'affected' items, or 'alert' for REJECT.
+    # return: the score.
+    def _score_rule_(self, key, value):
+        if key == "REJECT":
+            return round(value['alert'], 2) * 100.0
+        # Count how many rules and compute 'score' where higher scores put rules higher in the matrix.
+        hierarchy_score = 0
+        for k, v in value.items():
+            # the rule that has item rules will get double points.
+            if k == 'type':
+                hierarchy_score += round(len(v) * 2, 2)
+            elif k == 'location':
+                # The complexity of the location rules counts one-for-one.
+                hierarchy_score += round(len(v), 2)
+            elif k == 'affected':
+                # The more items are affected, the lower in the matrix they go so less gregarious rules have
+                # a chance to fire before the really big gregarious rules.
+                try:
+                    hierarchy_score += round((1.0 / v) * 100.0, 2)
+                except ZeroDivisionError:
+                    # "REJECT" rules have an effect on 0 known items.
+                    hierarchy_score += round(100.0, 2)
+        return hierarchy_score
+
+    # Ranks a scored rule for the ordering, the higher the rank the higher the rule goes in the matrix.
+    # param:  rule dictionary of the rule's name to its value.
+    # return: the rank.
+    def _rule_rank_(self, rule):
+        for key, value in rule.items():
+            if self.ordering == 'narrow':
+                return -value['affected']
+            if self.ordering == 'wide':
+                return value['affected']
+            if self.ordering == 'bin':
+                return -int(key[1:]) if key[1:].isdigit() else 0
+            return value['score']
+
+    # Lists the rules of the matrix as sortemu.py reads them, with '|' between the columns.
+    # return: list of strings, in the order of the matrix.
+    def rule_lines(self):
+        lines = []
+        for line in self.matrix:
+            for bin_name, rule_dict in line.items():
+                columns = dict([(column, '*') for column in sortemu.CONFIG_COL_ORDER])
+                columns['TargetRouteName'] = bin_name
+                if 'alert' in rule_dict:
+                    columns['Alert'] = 'Y'
+                    columns['AlertType'] = str(rule_dict['alert'])
+                columns['PermanentLocation'] = ','.join(rule_dict.get('location', '*'))
+                columns['DestinationLocation'] = rule_dict.get('destination', '*')
+                columns['LibraryId'] = rule_dict.get('library', '*')
+                columns['CollectionCode'] = ','.join(rule_dict.get('type', '*'))
+                columns['CallNumber'] = ','.join(rule_dict.get('callnum', '*'))
+                lines.append('|'.join([columns[column] for column in sortemu.CONFIG_COL_ORDER]))
+        return lines
+
+    # Routes every row of the spread sheet through the matrix with sortemu.RuleEngine, the way the sorter would, to
+    # find where the items really go once rules are globbed and reordered. Rows are routed with the compiled rules,
+    # once for each distinct location, item type and call number, and weighted by their counts. Rows without a bin,
+    # or with an invalid one, and rows in BAD_LOCATIONS or BAD_TYPES, should end up in the exception bin.
+    # return: dictionary of 'requested' and 'routed', the items for each bin that staff asked for and that the matrix
+    #   sorts there, and 'mismatches', a list of (count, location, type, requested bin, routed bin, rule line) of the
+    #   rows that go somewhere else, most items first, where rule line is 0 if no rule matched.
+    def verify_matrix(self):
+        stage_start = time.time()
+        rule_engine = sortemu.RuleEngine()
+        for line in self.rule_lines():
+            rule_engine.load_rule(line)
+        expected = [(ss_item, round(ss_item['bin'], None)) for ss_item in self.all_count_locn_type_cnum_binnum]
+        expected += [(ss_item, self.exception_bin)
+                     for ss_item in self.unhandled_rule + self.malformed_rule + self.rejected_rule]
+        verification = {'requested': {}, 'routed': {}, 'mismatches': []}
+        routes = {}
+        for ss_item, bin_number in expected:
+            item_count = self._get_integer_(ss_item['count'])
+            key = (str(ss_item['location']), str(ss_item['type']), str(ss_item['callnum']) or '*')
+            try:
+                (destination, line_number) = routes[key]
+            except KeyError:
+                result = rule_engine.route(['', key[0], '*', key[1], key[2]])
+                (destination, line_number) = (self.exception_bin, 0)
+                if result and sortemu.bin_name(result[1]).isdigit():
+                    (destination, line_number) = (int(sortemu.bin_name(result[1])), result[0])
+                routes[key] = (destination, line_number)
+            verification['requested'][bin_number] = verification['requested'].get(bin_number, 0) + item_count
+            verification['routed'][destination] = verification['routed'].get(destination, 0) + item_count
+            if destination != bin_number:
+                verification['mismatches'].append((item_count, key[0], key[1], bin_number, destination, line_number))
+        verification['mismatches'].sort(key=lambda mismatch: (-mismatch[0], mismatch[1:]))
+        self.verification = verification
+        self._time_stage_('verify', stage_start)
+        return verification
+
+    # Scores the matrix by where the rows of the spread sheet really go, see verify_matrix().
+    # return: dictionary of the 'rows' and 'names' in the matrix, not counting the rules for holds, the 'coverage',
+    #   the percent of the items staff gave a bin that reach it, and the 'misrouted' items and 'misrouted_pairs'.
+    def score_matrix(self):
+        verification = self.verify_matrix()
+        score = {'rows': 0, 'names': 0, 'coverage': 0.0, 'misrouted': 0, 'misrouted_pairs': 0}
+        for line in self.matrix:
+            for bin_name, rule_dict in line.items():
+                if 'alert' not in rule_dict:
+                    score['rows'] += 1
+                    score['names'] += len(rule_dict.get('location', [])) + len(rule_dict.get('type', []))
+        assigned_items = sum([item_count for (bin_number, item_count) in verification['requested'].items()
+                              if bin_number != self.exception_bin])
+        missed_items = sum([mismatch[0] for mismatch in verification['mismatches']
+                            if mismatch[3] != self.exception_bin])
+        score['misrouted'] = sum([mismatch[0] for mismatch in verification['mismatches']])
+        score['misrouted_pairs'] = len(verification['mismatches'])
+        if assigned_items:
+            score['coverage'] = (assigned_items - missed_items) * 100.0 / assigned_items
+        return score
+
+    # Prints how many items each bin gets from the matrix against what staff asked for, and the rows that go to
+    # another bin, see verify_matrix().
+    def report_verification(self):
+        verification = self.verification
+        sys.stdout.write("\nVerified by routing the spread sheet through the matrix:\n")
+        sys.stdout.write("  {:>4} {:>12} {:>12} {:>12}\n".format('bin', 'requested', 'routed', 'difference'))
+        for bin_number in sorted(set(verification['requested']) | set(verification['routed'])):
+            requested = verification['requested'].get(bin_number, 0)
+            routed = verification['routed'].get(bin_number, 0)
+            sys.stdout.write("  {:>4} {:>12} {:>12} {:>+12}{}\n".format(
+                bin_number, requested, routed, routed - requested,
+                ' (exception)' if bin_number == self.exception_bin else ''))
+        mismatches = verification['mismatches']
+        sys.stdout.write("{} row(s), {} items, go to a bin other than the one requested:\n"
+                         .format(len(mismatches), sum([mismatch[0] for mismatch in mismatches])))
+        for (item_count, location, item_type, requested, routed, line_number) in mismatches:
+            sys.stdout.write("  {:>10} {} / {}: bin {} -> {}, {}\n".format(
+                item_count, location, item_type, requested, routed,
+                "rule {}".format(line_number) if line_number else "no rule matched"))
+
     # Writes the proposed matrix to the spread sheet. A new sheet is created at the end fo the
     # document with the proposed rules written in columns.
     def write_matrix_to_csv(self, file_name):
@@ -428,7 +1360,7 @@ class ConfigGenerator:
                 # "PermanentLocation",  # 'location'
                 f.write("\"{}\",".format(', '.join(rule_dict.get('location', '*'))))
                 # "DestinationLocation",
-                f.write("{},".format('*'))
+                f.write("{},".format(rule_dict.get('destination', '*')))
                 # "CollectionCode",  # 'type'
                 f.write("\"{}\",".format(', '.join(rule_dict.get('type', '*'))))
                 # "CallNumber",  # 'callnum'
@@ -437,8 +1369,8 @@ class ConfigGenerator:
                 f.write("{},".format('*'))
                 # "BranchId",
                 f.write("{},".format('*'))
-                # "LibraryId", ## This may change because the user can specify a library on command line.
-                f.write("{},".format('*'))
+                # "LibraryId", the library code of the branch, if there is one.
+                f.write("{},".format(rule_dict.get('library', '*')))
                 # "CheckInResult",
                 f.write("{},".format('*'))
                 # "CustomTagData",
@@ -473,7 +1405,7 @@ class ConfigGenerator:
                 # "PermanentLocation",  # 'location'
                 f.write("    <PermanentLocation>{}</PermanentLocation>\n".format(', '.join(rule_dict.get('location', '*'))))
                 # "DestinationLocation",
-                f.write("    <DestinationLocation>*</DestinationLocation>\n")
+                f.write("    <DestinationLocation>{}</DestinationLocation>\n".format(rule_dict.get('destination', '*')))
                 # "CollectionCode",  # 'type'
                 f.write("    <CollectionCode>{}</CollectionCode>\n".format(', '.join(rule_dict.get('type', '*'))))
                 # "CallNumber",  # 'callnum'
@@ -482,8 +1414,8 @@ class ConfigGenerator:
                 f.write("    <SortBin>*</SortBin>\n")
                 # "BranchId",
                 f.write("    <BranchId>*</BranchId>\n")
-                # "LibraryId", ## This may change because the user can specify a library on command line.
-                f.write("    <LibraryId>*</LibraryId>\n")
+                # "LibraryId", the library code of the branch, if there is one.
+                f.write("    <LibraryId>{}</LibraryId>\n".format(rule_dict.get('library', '*')))
                 # "CheckInResult",
                 f.write("    <CheckInResult>*</CheckInResult>\n")
                 # "CustomTagData",
@@ -537,6 +1469,17 @@ class ConfigGenerator:
             rule_count += 1
         return True
 
+    # Makes the sorting rules branch specific: they only match items of the branch's library that are destined for
+    # it. Items in transit to other branches match no rule and go to the exception bin. The rules for holds are
+    # left alone.
+    def _set_branch_(self):
+        for rule in self.matrix:
+            rule: dict
+            for key, value in rule.items():
+                if 'alert' not in value:
+                    value['library'] = self.library_code
+                    value['destination'] = self.library_code
+
     # Cleans adds '*' fields to empty arrays.
     def _tidy_(self, use_3M_names=False):
         for rule in self.matrix:
@@ -546,6 +1489,13 @@ class ConfigGenerator:
                     if len(value) < 1:
                         value.append('*')
 
+    # Prints how long each stage of the compilation took.
+    def report_timings(self):
+        sys.stdout.write("Stage timings:\n")
+        for stage, seconds in self.timings:
+            sys.stdout.write("  {:<18} {:0.3f}s\n".format(stage, seconds))
+        sys.stdout.write("  {:<18} {:0.3f}s\n".format('total', sum([seconds for stage, seconds in self.timings])))
+
     # Prints out useful information about how well staff covered the majority of items from the spreadsheet.
     def report(self):
         if debug:
@@ -569,6 +1519,35 @@ class ConfigGenerator:
                              "spread sheet are invalid. See below.\n".format(self.malformed_rule_item_count))
             for bad_bin, ss_row in self.malformed_rule_name_row.items():
                 sys.stdout.write("  Invalid bin assignment '{}' on row {}.\n".format(bad_bin, ss_row))
+        if self.balancer:
+            # The planned loads are the balanced sheet's; the routed loads are what the matrix really does with it.
+            planned = self.balancer.loads()
+            routed = (self.verification or self.verify_matrix())['routed']
+            sys.stdout.write("\nBin loads, in items, and items for the bin's capacity:\n")
+            sys.stdout.write("  {:>4} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}\n"
+                             .format('bin', 'capacity', 'before', 'filled', 'planned', 'routed', 'filled'))
+            for bin_number in self.balancer.bins:
+                capacity = self.balancer.capacities[bin_number]
+                routed_items = routed.get(bin_number, 0)
+                sys.stdout.write("  {:>4} {:>8.2f} {:>10} {:>10.0f} {:>10} {:>10} {:>10.0f}\n".format(
+                    bin_number, capacity, self.balancer.before[bin_number],
+                    self.balancer.before[bin_number] / capacity if capacity else 0.0,
+                    planned[bin_number], routed_items, routed_items / capacity if capacity else 0.0))
+            sys.stdout.write("{} location / item type group(s) moved:\n".format(len(self.balancer.moves)))
+            for location, item_type, from_bin, to_bin in self.balancer.moves:
+                sys.stdout.write("  {} / {}: bin {} -> {}\n".format(location, item_type, from_bin, to_bin))
+        if self.synthesizer:
+            (rows, names, bin_rows, bin_names) = self.synthesizer.size()
+            sys.stdout.write("\nMinimized matrix: {} rule(s) with {} location(s) and item type(s), found in {:0.3f}s. "
+                             "One rule per bin would need {} rule(s) with {}.\n"
+                             .format(rows, names, self.synthesizer.seconds, bin_rows, bin_names))
+            if self.synthesizer.conflicts:
+                sys.stdout.write("**WARN: {} location / item type pair(s) were put in more than one bin, so {} items "
+                                 "will go to a bin some staff didn't choose.\n"
+                                 .format(self.synthesizer.conflicts, self.synthesizer.conflict_items))
+            for location, item_type in self.synthesizer.oversize:
+                sys.stdout.write("**WARN: rule for '{}' and '{}' is longer than the field or row limit.\n"
+                                 .format(location, item_type))
         for view_item in self.matrix:
             sys.stdout.write("RULE -->: {}\n".format(view_item))
         # Output the rules as they would look in the web interface
@@ -591,7 +1570,7 @@ class ConfigGenerator:
                 # "PermanentLocation",  # 'location'
                 sys.stdout.write("{}, ".format('|'.join(rule_dict.get('location', '*'))))
                 # "DestinationLocation",
-                sys.stdout.write("{}, ".format('*'))
+                sys.stdout.write("{}, ".format(rule_dict.get('destination', '*')))
                 # "CollectionCode",  # 'type'
                 sys.stdout.write("{}, ".format('|'.join(rule_dict.get('type', '*'))))
                 # "CallNumber",  # 'callnum'
@@ -600,8 +1579,8 @@ class ConfigGenerator:
                 sys.stdout.write("{}, ".format('*'))
                 # "BranchId",
                 sys.stdout.write("{}, ".format('*'))
-                # "LibraryId", ## This may change because the user can specify a library on command line.
-                sys.stdout.write("{}, ".format('*'))
+                # "LibraryId", the library code of the branch, if there is one.
+                sys.stdout.write("{}, ".format(rule_dict.get('library', '*')))
                 # "CheckInResult",
                 sys.stdout.write("{}, ".format('*'))
                 # "CustomTagData",
@@ -610,32 +1589,664 @@ class ConfigGenerator:
                 sys.stdout.write("{}{}\n".format('*', '}'))
 
 
+# Keeps a compiled ConfigGenerator in memory so staff can try out bin assignments. When the rows of a location and
+# item type are moved to another bin, added or removed, only the rules of the bins involved are compiled, compressed
+# and scored again, and moved to their new place in the order, rather than running the whole compilation. The
+# matrix, rule_index, rows and coverage counts of the generator are kept up to date, so its report(), verify_matrix()
+# and writers work on the edited matrix.
+# The exception bin stays the one the sheet was compiled with, and names stay in the vocabulary the globs are made
+# from even if their last row is removed, since the sorter still knows them. Minimized matrices aren't supported,
+# as a MatrixSynthesizer has to search all the bins together.
+class WhatIfSession:
+    # Commands of interact(), and what they take.
+    COMMANDS = {'move': 'LOCATION TYPE BIN', 'add': 'LOCATION TYPE COUNT BIN', 'unassign': 'LOCATION TYPE',
+                'remove': 'LOCATION TYPE', 'rules': '', 'coverage': '', 'verify': '', 'write': 'FILE.3SC',
+                'csv': 'FILE.csv', 'help': '', 'quit': ''}
+
+    # param:  generator ConfigGenerator that compiled the sheet one rule per bin.
+    def __init__(self, generator):
+        self.generator = generator
+        # The assigned rows of each bin, by id(), and how many of them name each location and item type, and their
+        # items, so a bin's rule is compiled again without going through its rows.
+        self.bin_rows = {}
+        self.bin_names = {}
+        self.bin_items = {}
+        # All the rows, assigned or not, of each location and item type, except those rejected outright.
+        self.pair_rows = {}
+        # Position of each row on the sheet, by id(), so the rules keep the order a recompilation would give them,
+        # and the position of the first row of each bin, see _order_key_().
+        self.row_order = {}
+        self.first_row = {}
+        self.next_row = 0
+        # Where each row is in the generator's list of assigned, unhandled or malformed rows, by id(), so it can be
+        # taken out without searching the list.
+        self.slot = {}
+        # Key of each rule in self.order_keys, by the id() of the rule, and the keys, sorted like generator.matrix
+        # below the rules for holds.
+        self.rule_keys = {}
+        self.order_keys = []
+        # Seconds taken by the last edit.
+        self.seconds = 0.0
+        for rows in (generator.all_count_locn_type_cnum_binnum, generator.unhandled_rule, generator.malformed_rule):
+            for position, ss_item in enumerate(rows):
+                self.slot[id(ss_item)] = position
+                self.row_order[id(ss_item)] = self.next_row
+                self.next_row += 1
+                self.pair_rows.setdefault((str(ss_item['location']), str(ss_item['type'])), []).append(ss_item)
+        for ss_item in generator.all_count_locn_type_cnum_binnum:
+            self._count_row_(ss_item, round(ss_item['bin'], None), 1)
+        self.holds = len([rule for rule in generator.matrix for value in rule.values() if 'alert' in value])
+        for rule in generator.matrix[self.holds:]:
+            key = self._order_key_(rule)
+            self.rule_keys[id(rule)] = key
+            self.order_keys.append(key)
+
+    # Adds a row to the counts of its bin, or takes it off.
+    # param:  ss_item the row.
+    # param:  bin_number its bin.
+    # param:  sign 1 to add the row, -1 to take it off.
+    def _count_row_(self, ss_item, bin_number, sign):
+        rows = self.bin_rows.setdefault(bin_number, {})
+        (locations, types) = self.bin_names.setdefault(bin_number, ({}, {}))
+        for names, name in ((locations, "{}".format(ss_item['location'])), (types, "{}".format(ss_item['type']))):
+            names[name] = names.get(name, 0) + sign
+            if not names[name]:
+                del names[name]
+        self.bin_items[bin_number] = self.bin_items.get(bin_number, 0) + sign * round(ss_item['count'], None)
+        order = self.row_order[id(ss_item)]
+        if sign > 0:
+            rows[id(ss_item)] = ss_item
+            self.first_row[bin_number] = min(self.first_row.get(bin_number, order), order)
+        else:
+            del rows[id(ss_item)]
+            if order == self.first_row[bin_number] and rows:
+                self.first_row[bin_number] = min([self.row_order[row_id] for row_id in rows])
+
+    # Puts a row at the end of one of the generator's lists of rows.
+    def _put_(self, rows, ss_item):
+        self.slot[id(ss_item)] = len(rows)
+        rows.append(ss_item)
+
+    # Takes a row out of one of the generator's lists of rows, moving the last row into its place. Nothing depends
+    # on the order of those lists once the rules are compiled.
+    def _take_(self, rows, ss_item):
+        position = self.slot.pop(id(ss_item))
+        last = rows.pop()
+        if last is not ss_item:
+            rows[position] = last
+            self.slot[id(last)] = position
+
+    # Where a rule goes in the order: _order_rules_() ranks the reversed matrix, so a rule ranks above others with
+    # the same rank if its bin's first row comes later on the sheet. The rule for BAD_LOCATIONS is added last.
+    # param:  rule dictionary of the rule's name to its value.
+    # return: tuple that sorts in the order of the matrix.
+    def _order_key_(self, rule):
+        for name, value in rule.items():
+            if self.generator.rule_index.get(name) is rule:
+                return -self.generator._rule_rank_(rule), -self.first_row[int(name[1:])]
+            return -self.generator._rule_rank_(rule), -float('inf')
+
+    # Takes a rule out of the matrix.
+    def _unplace_(self, rule):
+        key = self.rule_keys.pop(id(rule))
+        position = bisect.bisect_left(self.order_keys, key)
+        while self.generator.matrix[self.holds + position] is not rule:
+            position += 1
+        del self.order_keys[position]
+        del self.generator.matrix[self.holds + position]
+
+    # Puts a rule into the matrix in its place in the order.
+    def _place_(self, rule):
+        key = self._order_key_(rule)
+        position = bisect.bisect_right(self.order_keys, key)
+        self.order_keys.insert(position, key)
+        self.generator.matrix.insert(self.holds + position, rule)
+        self.rule_keys[id(rule)] = key
+
+    # Compiles, scores and compresses the rule of a bin again from the counts of its rows, the way _compile_rules_(),
+    # _order_rules_(), _compress_rules_() and _set_branch_() would, and moves it to its place in the matrix.
+    # param:  bin_number the bin.
+    def _recompile_(self, bin_number):
+        generator = self.generator
+        name = "R{}".format(bin_number)
+        rule = generator.rule_index.get(name)
+        if rule is not None:
+            self._unplace_(rule)
+        if not self.bin_rows.get(bin_number):
+            for counts in (self.bin_rows, self.bin_names, self.bin_items, self.first_row, generator.bins):
+                counts.pop(bin_number, None)
+            generator.rule_index.pop(name, None)
+            return
+        value = {'location': [], 'type': [], 'affected': self.bin_items[bin_number]}
+        for field, names in zip(('location', 'type'), self.bin_names[bin_number]):
+            for word, rows in names.items():
+                value[field].extend([word] * rows)
+        value['score'] = generator._score_rule_(name, value)
+        value['location'] = generator.__compress__(value['location'], generator.compression,
+                                                   generator.location_vocabulary)
+        value['type'] = generator.__compress__(value['type'], generator.compression, generator.type_vocabulary)
+        if generator.library_code:
+            value['library'] = generator.library_code
+            value['destination'] = generator.library_code
+        if rule is None:
+            rule = {name: value}
+            generator.rule_index[name] = rule
+        else:
+            rule[name] = value
+        generator.bins[bin_number] = len(self.bin_rows[bin_number])
+        self._place_(rule)
+
+    # Adds names to the vocabulary the globs are made from. A glob of another bin that would now catch the new name
+    # has to be compressed again.
+    # return: set of the bins whose rules catch a new name.
+    def _learn_names_(self, location, item_type):
+        generator = self.generator
+        new_names = []
+        if location not in generator.location_vocabulary:
+            generator.location_vocabulary.add(location)
+            new_names.append(('location', location))
+        if item_type not in generator.type_vocabulary:
+            generator.type_vocabulary.add(item_type)
+            new_names.append(('type', item_type))
+        stale_bins = set()
+        for bin_number in self.bin_rows:
+            value = generator.rule_index["R{}".format(bin_number)]["R{}".format(bin_number)]
+            for field, new_name in new_names:
+                if [glob for glob in value[field] if glob.endswith('*') and new_name.startswith(glob[:-1])]:
+                    stale_bins.add(bin_number)
+        return stale_bins
+
+    # Takes the rows of a location and item type off the sheet's counts, wherever they are now. Rows without a bin,
+    # or marked REJECT, are unhandled, and rows with any other text in the bin are malformed.
+    # return: set of the bins they were assigned to.
+    def _detach_(self, rows):
+        generator = self.generator
+        bins = set()
+        for ss_item in rows:
+            item_count = generator._get_integer_(ss_item['count'])
+            if isinstance(ss_item['bin'], (int, float)):
+                bin_number = round(ss_item['bin'], None)
+                self._count_row_(ss_item, bin_number, -1)
+                self._take_(generator.all_count_locn_type_cnum_binnum, ss_item)
+                generator.handled_by_rule_count -= item_count
+                bins.add(bin_number)
+            elif str(ss_item['bin']).upper() in ('', 'REJECT'):
+                self._take_(generator.unhandled_rule, ss_item)
+                generator.unhandled_items_count -= item_count
+            else:
+                self._take_(generator.malformed_rule, ss_item)
+                generator.malformed_rule_item_count -= item_count
+                if ss_item['bin'] not in [other['bin'] for other in generator.malformed_rule]:
+                    generator.malformed_rule_name_row.pop(ss_item['bin'], None)
+        return bins
+
+    # Puts rows on the sheet's counts, in a bin, or without one if bin_number is None.
+    def _attach_(self, rows, bin_number):
+        generator = self.generator
+        for ss_item in rows:
+            item_count = generator._get_integer_(ss_item['count'])
+            if bin_number is None:
+                ss_item['bin'] = ''
+                self._put_(generator.unhandled_rule, ss_item)
+                generator.unhandled_items_count += item_count
+            else:
+                ss_item['bin'] = float(bin_number)
+                self._count_row_(ss_item, bin_number, 1)
+                self._put_(generator.all_count_locn_type_cnum_binnum, ss_item)
+                generator.handled_by_rule_count += item_count
+
+    # Checks a bin is one the sorter has.
+    # return: the bin, or None with a message if it isn't.
+    def _check_bin_(self, bin_text):
+        try:
+            bin_number = int(float(bin_text))
+        except ValueError:
+            bin_number = 0
+        if bin_number < 1 or bin_number > self.generator.exception_bin:
+            sys.stdout.write("**error: bin '{}' isn't between 1 and the exception bin {}.\n"
+                             .format(bin_text, self.generator.exception_bin))
+            return None
+        return bin_number
+
+    # Checks a location and item type can be edited.
+    # return: True if they can, and False with a message if they are rejected outright.
+    def _check_pair_(self, location, item_type):
+        if location in self.generator.BAD_LOCATIONS or item_type in self.generator.BAD_TYPES:
+            sys.stdout.write("**error: '{}' / '{}' is always rejected to the exception bin.\n".format(location,
+                                                                                                 item_type))
+            return False
+        return True
+
+    # Applies an edit and recompiles the bins it touched.
+    # param:  location the location of the rows.
+    # param:  item_type the item type of the rows.
+    # param:  bin_number the bin the rows go to, or None for no bin.
+    # param:  new_row row to add to the location and item type, if any. Otherwise the rows already there move.
+    # param:  keep False to take the rows off the sheet altogether.
+    # return: list of the bins whose rules changed.
+    def _edit_(self, location, item_type, bin_number, new_row=None, keep=True):
+        start = time.time()
+        rows = self.pair_rows.setdefault((location, item_type), [])
+        if new_row is None:
+            bins = self._detach_(rows)
+            moving = list(rows)
+        else:
+            bins = self._learn_names_(location, item_type)
+            moving = [new_row]
+            self.row_order[id(new_row)] = self.next_row
+            self.next_row += 1
+            rows.append(new_row)
+        if keep:
+            self._attach_(moving, bin_number)
+            if bin_number is not None:
+                bins.add(bin_number)
+        else:
+            for ss_item in rows:
+                del self.row_order[id(ss_item)]
+            del self.pair_rows[(location, item_type)]
+        for changed_bin in sorted(bins):
+            self._recompile_(changed_bin)
+        self.seconds = time.time() - start
+        return sorted(bins)
+
+    # Moves every row of a location and item type to a bin.
+    # return: list of the bins whose rules changed, or None if the edit wasn't made.
+    def move(self, location, item_type, bin_text):
+        bin_number = self._check_bin_(bin_text)
+        if bin_number is None or not self._check_pair_(location, item_type):
+            return None
+        if not self.pair_rows.get((location, item_type)):
+            sys.stdout.write("**error: no rows for '{}' / '{}', use add.\n".format(location, item_type))
+            return None
+        return self._edit_(location, item_type, bin_number)
+
+    # Adds a row to the sheet.
+    # return: list of the bins whose rules changed, or None if the edit wasn't made.
+    def add(self, location, item_type, count_text, bin_text):
+        bin_number = self._check_bin_(bin_text)
+        if bin_number is None or not self._check_pair_(location, item_type):
+            return None
+        try:
+            item_count = float(count_text)
+        except ValueError:
+            sys.stdout.write("**error: invalid count '{}'.\n".format(count_text))
+            return None
+        ss_item = dict(zip(self.generator.header_row, [item_count, location, item_type, '*', '']))
+        ss_item.update([(column_name, ['*']) for column_name in self.generator.ALT_SORT_CRITERIA])
+        return self._edit_(location, item_type, bin_number, ss_item)
+
+    # Leaves the rows of a location and item type without a bin, so they go to the exception bin.
+    # return: list of the bins whose rules changed, or None if the edit wasn't made.
+    def unassign(self, location, item_type):
+        if not self.pair_rows.get((location, item_type)):
+            sys.stdout.write("**error: no rows for '{}' / '{}'.\n".format(location, item_type))
+            return None
+        return self._edit_(location, item_type, None)
+
+    # Takes the rows of a location and item type off the sheet.
+    # return: list of the bins whose rules changed, or None if the edit wasn't made.
+    def remove(self, location, item_type):
+        if not self.pair_rows.get((location, item_type)):
+            sys.stdout.write("**error: no rows for '{}' / '{}'.\n".format(location, item_type))
+            return None
+        return self._edit_(location, item_type, None, keep=False)
+
+    # return: dictionary of the 'items' on the sheet, the items 'assigned' a bin, the percent of items sorted,
+    #   'sorted', and the items each bin was assigned, by bin, under 'bins'.
+    def coverage(self):
+        generator = self.generator
+        coverage = {'items': generator.handled_by_rule_count + generator.unhandled_items_count,
+                    'assigned': generator.handled_by_rule_count, 'sorted': 0.0, 'bins': dict(self.bin_items)}
+        if coverage['items']:
+            coverage['sorted'] = generator.handled_by_rule_count * 100.0 / coverage['items']
+        return coverage
+
+    # Prints the rules that changed, where they are now, and the coverage.
+    # param:  bins the bins whose rules changed.
+    # param:  before coverage() before the edit.
+    def report_edit(self, bins, before):
+        after = self.coverage()
+        for bin_number in bins:
+            rule = self.generator.rule_index.get("R{}".format(bin_number))
+            if rule is None:
+                sys.stdout.write("  R{}: no rows left, rule removed.\n".format(bin_number))
+                continue
+            for name, value in rule.items():
+                sys.stdout.write("  {} (rule {}): {} / {}\n".format(name, self.generator.matrix.index(rule) + 1,
+                                                                    ','.join(value['location']),
+                                                                    ','.join(value['type'])))
+            sys.stdout.write("    {} -> {} items\n".format(before['bins'].get(bin_number, 0),
+                                                         after['bins'].get(bin_number, 0)))
+        sys.stdout.write("  {:0.1f}% of {} items sorted ({:+0.1f}%), {} rule(s), in {:0.2f}ms.\n".format(
+            after['sorted'], after['items'], after['sorted'] - before['sorted'],
+            len(self.generator.matrix), self.seconds * 1000.0))
+
+    # Lists the commands of interact().
+    def _help_(self):
+        for name, usage in self.COMMANDS.items():
+            sys.stdout.write("  {}\n".format(' '.join([name, usage]).strip()))
+
+    # Reads edits and other commands, one a line, until 'quit' or the end of the input, see COMMANDS. Location and
+    # item type names are upper case, as on the sheet.
+    # param:  in_stream where to read the commands. Default: stdin.
+    def interact(self, in_stream=sys.stdin):
+        generator = self.generator
+        prompt = in_stream.isatty()
+        while True:
+            if prompt:
+                sys.stdout.write("what-if> ")
+                sys.stdout.flush()
+            line = in_stream.readline()
+            if not line:
+                break
+            words = line.split()
+            if not words:
+                continue
+            (command, arguments) = (words[0].lower(), words[1:])
+            usage = self.COMMANDS.get(command)
+            if usage is None or len(arguments) != len(usage.split()):
+                sys.stdout.write("**error: expected one of:\n")
+                self._help_()
+                continue
+            if command == 'quit':
+                break
+            elif command == 'help':
+                self._help_()
+            elif command == 'rules':
+                for rule_line in generator.rule_lines():
+                    sys.stdout.write("  {}\n".format(rule_line))
+            elif command == 'coverage':
+                coverage = self.coverage()
+                for bin_number in sorted(coverage['bins']):
+                    sys.stdout.write("  bin {:>3}: {:>10} items\n".format(bin_number, coverage['bins'][bin_number]))
+                sys.stdout.write("  {:0.1f}% of {} items sorted.\n".format(coverage['sorted'], coverage['items']))
+            elif command == 'verify':
+                generator.verify_matrix()
+                generator.report_verification()
+            elif command == 'write':
+                generator.write_config_file(arguments[0])
+            elif command == 'csv':
+                generator.write_matrix_to_csv(arguments[0])
+            else:
+                before = self.coverage()
+                (location, item_type) = (arguments[0].upper(), arguments[1].upper())
+                if command == 'move':
+                    bins = self.move(location, item_type, arguments[2])
+                elif command == 'add':
+                    bins = self.add(location, item_type, arguments[2], arguments[3])
+                elif command == 'unassign':
+                    bins = self.unassign(location, item_type)
+                else:
+                    bins = self.remove(location, item_type)
+                if bins is not None:
+                    self.report_edit(bins, before)
+
+
+# Rows of the staff sheet and the settings shared with the worker processes of a sweep, see share_sweep().
+sweep_rows = []
+sweep_settings = {}
+
+
+# Makes the rows of the sheet, read once, and the settings for ConfigGenerator, available to build_candidate() in
+# this process. Used as the pool's initializer.
+# param:  rows list of (row, cells) from ConfigGenerator.read_rows().
+# param:  settings dictionary of arguments for ConfigGenerator, other than compression, ordering and rows.
+# param:  debug_on debug of the process that started the sweep.
+def share_sweep(rows, settings, debug_on=False):
+    global debug
+    debug = debug_on
+    sweep_rows[:] = rows
+    sweep_settings.clear()
+    sweep_settings.update(settings)
+
+
+# Builds and scores the matrix for one compression level and ordering. The output of the compilation is captured
+# rather than interleaved with that of other candidates.
+# param:  candidate (compression, ordering).
+# return: dictionary with the compression, ordering, the score from ConfigGenerator.score_matrix(), the
+#   ConfigGenerator as 'generator', its captured 'output', the seconds it took and any error that stopped it.
+def build_candidate(candidate):
+    (compression, ordering) = candidate
+    result = {'compression': compression, 'ordering': ordering, 'error': '', 'seconds': 0.0}
+    start = time.time()
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            generator = ConfigGenerator(compression=compression, ordering=ordering, rows=sweep_rows,
+                                        **sweep_settings)
+            result.update(generator.score_matrix())
+            result['generator'] = generator
+    except SystemExit:
+        result['error'] = 'the spread sheet has errors'
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    result['output'] = output.getvalue()
+    return result
+
+
+# Builds a matrix for every compression level and ordering, in parallel if there is more than one job, and ranks
+# them: fewest misrouted items first, then the best coverage, then fewest rules, and fewest names.
+# param:  candidates list of (compression, ordering).
+# param:  rows list of (row, cells) from ConfigGenerator.read_rows().
+# param:  settings dictionary of arguments for ConfigGenerator, other than compression, ordering and rows.
+# param:  jobs number of worker processes.
+# return: list of results from build_candidate(), best first.
+def sweep(candidates, rows, settings, jobs=1):
+    if jobs <= 1 or len(candidates) <= 1:
+        share_sweep(rows, settings, debug)
+        results = [build_candidate(candidate) for candidate in candidates]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=share_sweep,
+                                                    initargs=(rows, settings, debug)) as pool:
+            results = list(pool.map(build_candidate, candidates))
+    return sorted(results, key=lambda result: (result['error'] != '', result.get('misrouted', 0),
+                                               -result.get('coverage', 0.0), result.get('rows', 0),
+                                               result.get('names', 0), candidates.index(
+                                                   (result['compression'], result['ordering']))))
+
+
+# Prints the ranked results of a sweep.
+# param:  results list from sweep().
+def report_sweep(results):
+    sys.stdout.write("{:>4} {:>11} {:<8} {:>5} {:>6} {:>9} {:>10} {:>8}\n".format(
+        'rank', 'compression', 'ordering', 'rules', 'names', 'coverage', 'misrouted', 'seconds'))
+    for rank, result in enumerate(results, 1):
+        if result['error']:
+            sys.stdout.write("{:>4} {:>11} {:<8} error: {}\n".format(rank, result['compression'], result['ordering'],
+                                                                     result['error']))
+            continue
+        sys.stdout.write("{:>4} {:>11} {:<8} {:>5} {:>6} {:>8.1f}% {:>10} {:>8.3f}\n".format(
+            rank, result['compression'], result['ordering'], result['rows'], result['names'], result['coverage'],
+            result['misrouted'], result['seconds']))
+
+
+# Settings shared with the worker processes of a batch, see share_batch().
+batch_settings = {}
+
+
+# Makes the settings for ConfigGenerator available to build_branch() in this process. Used as the pool's initializer.
+# param:  settings dictionary of arguments for ConfigGenerator, other than file, index and library_code, and the
+#   'out_dir' to write the matrices to.
+# param:  debug_on debug of the process that started the batch.
+def share_batch(settings, debug_on=False):
+    global debug
+    debug = debug_on
+    batch_settings.clear()
+    batch_settings.update(settings)
+
+
+# Builds the matrix for one branch, writes it as '<branch>.3SC' and '<branch>.csv' in the output directory, and
+# scores it, see ConfigGenerator.score_matrix(). The output of the compilation is captured rather than interleaved
+# with that of other branches.
+# param:  job (branch, file, sheet index).
+# return: dictionary with the branch, file, sheet, the files written, the items on the sheet and the percent staff
+#   gave a bin, the score, the seconds it took and any error that stopped it.
+def build_branch(job):
+    (branch, file, index) = job
+    settings = dict(batch_settings)
+    out_dir = settings.pop('out_dir', '.')
+    result = {'branch': branch, 'file': file, 'sheet': index, 'out_file': os.path.join(out_dir, branch + '.3SC'),
+              'csv_file': os.path.join(out_dir, branch + '.csv'), 'items': 0, 'sheet_coverage': 0.0, 'error': '',
+              'seconds': 0.0}
+    start = time.time()
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            generator = ConfigGenerator(file, index, library_code=branch, **settings)
+            generator.write_config_file(result['out_file'])
+            generator.write_matrix_to_csv(result['csv_file'])
+            result.update(generator.score_matrix())
+        result['items'] = generator.handled_by_rule_count + generator.unhandled_items_count
+        if result['items']:
+            result['sheet_coverage'] = generator.handled_by_rule_count * 100.0 / result['items']
+    except SystemExit:
+        result['error'] = 'the spread sheet has errors'
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+# Builds the matrices for branches, in parallel if there is more than one job.
+# param:  jobs list of (branch, file, sheet index).
+# param:  settings dictionary for share_batch().
+# param:  workers number of worker processes.
+# return: list of results from build_branch(), in the order of jobs.
+def batch(jobs, settings, workers=1):
+    if workers <= 1 or len(jobs) <= 1:
+        share_batch(settings, debug)
+        return [build_branch(job) for job in jobs]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=share_batch,
+                                                initargs=(settings, debug)) as pool:
+        return list(pool.map(build_branch, jobs))
+
+
+# Prints one coverage report for all the branches of a batch.
+# param:  results list from batch().
+def report_batch(results):
+    sys.stdout.write("{:<10} {:>5} {:>6} {:>12} {:>9} {:>9} {:>10} {:>8}\n".format(
+        'branch', 'rules', 'names', 'items', 'assigned', 'verified', 'misrouted', 'seconds'))
+    for result in results:
+        if result['error']:
+            sys.stdout.write("{:<10} error: {}\n".format(result['branch'], result['error']))
+            continue
+        sys.stdout.write("{:<10} {:>5} {:>6} {:>12} {:>8.1f}% {:>8.1f}% {:>10} {:>8.3f}\n".format(
+            result['branch'], result['rows'], result['names'], result['items'], result['sheet_coverage'],
+            result['coverage'], result['misrouted'], result['seconds']))
+    built = [result for result in results if not result['error']]
+    items = sum([result['items'] for result in built])
+    misrouted = sum([result['misrouted'] for result in built])
+    sys.stdout.write("{} of {} branches built, {} items, {} misrouted.\n".format(len(built), len(results), items,
+                                                                              misrouted))
+    for result in built:
+        sys.stdout.write("  {}: {}, {}\n".format(result['branch'], result['out_file'], result['csv_file']))
+
+
 # Staff should be given a spreadsheet whose first sheet includes the header 'Count, Locations, iTypes, Bin #".
 
 if __name__ == "__main__":
     csv_name: str = "__UNSET__"
-    parser = argparse.ArgumentParser(description="Generates optimized sorter config from a Microsoft XSLS file.")
+    parser = argparse.ArgumentParser(description="Generates optimized sorter config from a Microsoft XSLS file, "
+                                                 "or a CSV, TSV or pipe-delimited file.")
+    parser.add_argument("-a", "--all_branches", action="store_true", default=False, required=False,
+                        help="Build a matrix for every sheet of the workbook in --in_file, in parallel, taking the "
+                             "branch's library code from the sheet's name. Each is written to --out_dir as "
+                             "'<branch>.3SC' and '<branch>.csv', with one coverage report for all the branches.")
+    parser.add_argument("-b", "--balance", action="store_true", default=False, required=False,
+                        help="Move location and item type groups between bins, using the spread sheet's counts, so "
+                             "the bins fill evenly. Groups in --pins, and the exception bin, don't move. Turns on "
+                             "--minimize, so the matrix routes the groups that moved, not every location and item "
+                             "type of their new bin.")
+    parser.add_argument("--branches", default="", action="store", type=str, required=False,
+                        help="Like --all_branches, for a list of library codes, like 'EPLIDY,EPLMNA'. Each is the "
+                             "name of a sheet of the workbook, or, if --in_file is a CSV, TSV or pipe-delimited file "
+                             "name with '{branch}' in it, like 'staff_{branch}.csv', the branch's own file.")
+    parser.add_argument("--capacities", default="", action="store", type=str, required=False,
+                        help="With --balance, the capacity of bins, like '1:2,7:0.5' for a bin 1 twice the usual "
+                             "size. Other bins have a capacity of 1, and a bin of capacity 0 gets only pinned groups.")
     parser.add_argument("-c", "--compression", default=3, action="store", type=int, required=False,
                         help="Sets the compression level when wildcard-ing locations and item types. For example, "
                              "'JUVFIC' and 'JUVCOMIC' will be wildcard-ed to 'JUV*' with compression of 3, and "
-                             "'JU*' if 2 is selected. If 0 is selected only duplicate locations and item types, "
+                             "'JU*' if 2 is selected, as long as no other location or item type starts the same "
+                             "way. If 0 is selected only duplicate locations and item types, "
                              "will be removed, and no wildcards will be used.")
     parser.add_argument("-d", "--debug", default="False", action="store", type=str, required=False,
                         help="Turns on diagnostic debug information about the compilation process.")
+    parser.add_argument("-e", "--what_if", action="store_true", default=False, required=False,
+                        help="After the matrix is built, read edits to the bin assignments from stdin, like "
+                             "'move JUVFIC JBOOK 3', and show the rules that change and the coverage straight away, "
+                             "without compiling the whole sheet again. Type 'help' for the commands.")
+    parser.add_argument("-f", "--format", default="", action="store", type=str, required=False,
+                        choices=['xlsx', 'csv', 'tsv', 'pipe'],
+                        help="Format of the input file. By default it is taken from the file name, and files that "
+                             "aren't .xls, .xlsx, .csv or .tsv, and stdin, are read as pipe-delimited.")
     # Required input for the name of the XSLS file.
     parser.add_argument("-i", "--in_file", action="store", type=str, required=True,
-                        help="The path and name of the XSLS file to read staff selections from.")
+                        help="The path and name of the XSLS file to read staff selections from, or a CSV, TSV or "
+                             "pipe-delimited file with 'count|location|type|bin' rows. Use '-' to read stdin.")
+    parser.add_argument("-j", "--jobs", default=os.cpu_count() or 1, action="store", type=int, required=False,
+                        help="With --sweep, --all_branches or --branches, the number of worker processes. Default "
+                             "is one per CPU.")
     parser.add_argument("-l", "--library_code", action="store", type=str, required=False,
                         help="Specifies code of the library code where the sorter operates. "
                              "For example EPLIDY for Idylwylde branch. If not used no branch specific "
                              "rules will be added.")
+    parser.add_argument("--levels", default="0,1,2,3,4,5", action="store", type=str, required=False,
+                        help="With --sweep, the compression levels to try. Default: '0,1,2,3,4,5'.")
+    parser.add_argument("--location_db", default="location.db", action="store", type=str, required=False,
+                        help="Table of every location, as used by sortemu.py, so wildcards never match a location "
+                             "that belongs in another bin. Default: 'location.db'.")
+    parser.add_argument("-m", "--minimize", action="store_true", default=False, required=False,
+                        help="Search for the matrix with the fewest rules and names that sorts every location and "
+                             "item type pair on the sheet into its bin, rather than making one rule for each bin.")
+    parser.add_argument("--field_limit", default=0, action="store", type=int, required=False,
+                        help="With --minimize, the most characters the web interface takes in a location or item type "
+                             "field. Default: 0, no limit.")
+    parser.add_argument("--row_limit", default=0, action="store", type=int, required=False,
+                        help="With --minimize, the most characters in the location and item type fields of a rule "
+                             "together. Default: 0, no limit.")
+    parser.add_argument("--time_budget", default=1.0, action="store", type=float, required=False,
+                        help="With --minimize, the seconds to search for a smaller matrix. Default: 1.0.")
+    parser.add_argument("-n", "--no_cache", action="store_true", default=False, required=False,
+                        help="Read the workbook again even if it hasn't changed, rather than from the rows cached "
+                             "next to it in '<in_file>.<sheet_index>.rows'.")
+    parser.add_argument("--ordering", default="score", action="store", type=str, required=False,
+                        choices=ConfigGenerator.ORDERINGS,
+                        help="How to order the rules: by the usual score, the rules that sort the fewest items "
+                             "first ('narrow') or the most ('wide'), or by bin. Default: 'score'.")
+    parser.add_argument("--orderings", default=','.join(ConfigGenerator.ORDERINGS), action="store", type=str,
+                        required=False, help="With --sweep, the orderings to try. Default: all of them.")
     parser.add_argument("-o", "--out_file", action="store", type=str, required=False,
                         help="Specifies the name (and path) of the .3SC file that can be uploaded to each of "
                              "the induction units on the sorter.")
+    parser.add_argument("--out_dir", default=".", action="store", type=str, required=False,
+                        help="With --all_branches or --branches, the directory to write the matrices to. Default: '.'.")
+    parser.add_argument("-p", "--pins", default="", action="store", type=str, required=False,
+                        help="With --balance, a file of 'location|type|bin' lines of groups that must go to a bin. "
+                             "The location or type can be '*' to pin all of them.")
+    parser.add_argument("--profile", default="", action="store", type=str, required=False,
+                        help="Profile store of catalog counts kept by sortemu.py -P. Its locations and item types "
+                             "are added to those of --location_db and --type_db.")
+    parser.add_argument("--recount", action="store_true", default=False, required=False,
+                        help="With --profile, use the profile's counts of each row's location, item type and call "
+                             "numbers instead of the spread sheet's, so the matrix is weighed by the catalog as it "
+                             "is now.")
     # The sheet number where the data to compile is located. Sheets are zero-indexed. The default sheet index is '0'.
     parser.add_argument("-s", "--sheet_index", default=0, action="store", type=int, required=False,
                         help="The zero-based index of the staff-selection sheet within the XSLS file. "
                              "Default 0, or the first sheet in the spreadsheet.")
+    parser.add_argument("--sweep", action="store_true", default=False, required=False,
+                        help="Build the matrix for every compression level in --levels and ordering in --orderings, "
+                             "in parallel, rank them by misrouted items, coverage, rules and names, and keep the best.")
+    parser.add_argument("-t", "--timing", action="store_true", default=False, required=False,
+                        help="Show how long each stage of the compilation took.")
+    parser.add_argument("--type_db", default="type.db", action="store", type=str, required=False,
+                        help="Table of every item type, as used by sortemu.py. Default: 'type.db'.")
+    parser.add_argument("-v", "--verify", action="store_true", default=False, required=False,
+                        help="Route every row of the spread sheet through the generated matrix, as the sorter "
+                             "would, and report the items each bin really gets, and the rows that go to a bin "
+                             "other than the one requested.")
     parser.add_argument("-w", "--write_csv", action="store", type=str,
                         required=False,
                         help="Output the resultant configuration file as a CSV.")
@@ -643,9 +2254,7 @@ if __name__ == "__main__":
     # The path/spread_sheet.xsls
     input_file = args.in_file
     # The minimum glob string length.
-    compression = 3
-    if args.compression:
-        compression = args.compression
+    compression = args.compression
     # The index of the sheet which has the rules staff specified.
     # The first sheet (default) is the '0' or zero-th sheet.
     if args.sheet_index:
@@ -656,7 +2265,7 @@ if __name__ == "__main__":
     # See help for more details.
     branch = ""
     if args.library_code:
-        branch = args.library_code.uc()
+        branch = args.library_code.upper()
     # Turn on debugging
     debug = False
     if args.debug == "True":
@@ -666,7 +2275,76 @@ if __name__ == "__main__":
         sys.stdout.write("input_file: {0}\n".format(input_file))
         sys.stdout.write("sheet_index: {0}\n".format(sheet_index))
 
-    sorter_configurator = ConfigGenerator(input_file, sheet_index)
+    settings = dict(file=input_file, index=sheet_index, file_format=args.format, use_cache=not args.no_cache,
+                    location_db=args.location_db, type_db=args.type_db, minimize=args.minimize,
+                    field_limit=args.field_limit, row_limit=args.row_limit, time_budget=args.time_budget,
+                    balance=args.balance, capacities=args.capacities, pins=args.pins, profile=args.profile,
+                    recount=args.recount)
+    if args.all_branches or args.branches:
+        # One matrix per branch. The sheet, file and library code come from the branch, not the arguments.
+        for name in ('file', 'index'):
+            del settings[name]
+        settings.update(compression=compression, ordering=args.ordering, out_dir=args.out_dir)
+        sheets = []
+        if '{branch}' not in input_file:
+            if xlrd is None:
+                sys.stderr.write("**error: xlrd is needed to read the sheets of '{}'.\n".format(input_file))
+                sys.exit(2)
+            sheets = xlrd.open_workbook(input_file).sheet_names()
+        jobs = []
+        if args.branches:
+            names = dict([(sheet.upper(), sheet_number) for (sheet_number, sheet) in enumerate(sheets)])
+            for code in [code.strip().upper() for code in args.branches.split(',') if code.strip()]:
+                if '{branch}' in input_file:
+                    jobs.append((code, input_file.replace('{branch}', code), 0))
+                elif code in names:
+                    jobs.append((code, input_file, names[code]))
+                else:
+                    sys.stderr.write("**error: '{}' has no sheet for branch '{}'.\n".format(input_file, code))
+                    sys.exit(2)
+        else:
+            jobs = [(sheet.strip().upper(), input_file, sheet_number) for (sheet_number, sheet) in enumerate(sheets)]
+        if not jobs:
+            sys.stderr.write("**error: no branches to build from '{}'.\n".format(input_file))
+            sys.exit(2)
+        if not os.path.isdir(args.out_dir):
+            os.makedirs(args.out_dir)
+        results = batch(jobs, settings, args.jobs)
+        report_batch(results)
+        sys.exit(0 if all([not result['error'] for result in results]) else 1)
+    if args.what_if and (args.minimize or args.balance or input_file == '-'):
+        sys.stderr.write("**error: --what_if reads edits from stdin, and can't be used with --minimize, --balance "
+                         "or --in_file=-.\n")
+        sys.exit(2)
+    settings['library_code'] = branch
+    if args.sweep:
+        # Read the sheet once for all the candidates.
+        rows = list(ConfigGenerator.read_rows(input_file, sheet_index, args.format, not args.no_cache))
+        try:
+            levels = [int(level) for level in args.levels.split(',') if level.strip()]
+        except ValueError:
+            sys.stderr.write("**error: invalid compression levels '{}'.\n".format(args.levels))
+            sys.exit(2)
+        orderings = [name.strip() for name in args.orderings.split(',') if name.strip()]
+        for name in orderings:
+            if name not in ConfigGenerator.ORDERINGS:
+                sys.stderr.write("**error: unknown ordering '{}', expected one of {}.\n"
+                                 .format(name, ', '.join(ConfigGenerator.ORDERINGS)))
+                sys.exit(2)
+        results = sweep([(level, name) for level in levels for name in orderings], rows, settings, args.jobs)
+        report_sweep(results)
+        if results[0]['error']:
+            sys.stderr.write("**error: no matrix could be built, {}.\n".format(results[0]['error']))
+            sys.exit(2)
+        compression = results[0]['compression']
+        ordering = results[0]['ordering']
+        sys.stdout.write("Best: compression {}, ordering '{}'.\n\n".format(compression, ordering))
+        # Keep the generator that was ranked rather than building it again. A minimized or balanced matrix depends
+        # on how far the search got, and its report should describe the search that found it.
+        sys.stdout.write(results[0]['output'])
+        sorter_configurator = results[0]['generator']
+    else:
+        sorter_configurator = ConfigGenerator(compression=compression, ordering=args.ordering, **settings)
     # Output xml file if requested.
     if args.out_file:
         xml_config = args.out_file
@@ -674,4 +2352,12 @@ if __name__ == "__main__":
     if args.write_csv:
         csv_path_file = args.write_csv
         sorter_configurator.write_matrix_to_csv(csv_path_file)
+    if args.verify:
+        sorter_configurator.verify_matrix()
     sorter_configurator.report()
+    if args.verify:
+        sorter_configurator.report_verification()
+    if args.timing:
+        sorter_configurator.report_timings()
+    if args.what_if:
+        WhatIfSession(sorter_configurator).interact()
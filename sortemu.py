@@ -24,6 +24,20 @@
 # Author:  Andrew Nisbet, Edmonton Public Library
 # Created: Fri Dec 18 10:23:18 MST 2015
 # Rev:
+#          2.7.00 - Why-not query for one item against the rules above the one that fired.
+#          2.6.00 - Serve routes over TCP, for check-in stations and sortload.py.
+#          2.5.00 - Compiled matrix file that routing worker processes map read-only.
+#          2.4.00 - Catalog profile store kept up to date from the changes between item dumps.
+#          2.3.01 - trace_item() can route quietly, as the reference for sortfuzz.py.
+#          2.3.00 - Checks return results, reusable XML matrix parsing, for sortlint.py.
+#          2.2.00 - Immutable rules with pre-split tokens, shared item column values.
+#          2.1.00 - Reorder rules to lower the number evaluated per item.
+#          2.0.00 - Hold-aware routing from a holds snapshot.
+#          1.9.00 - Index rule tokens, optionally normalize call numbers as items are read.
+#          1.8.00 - JSON Lines, CSV and TSV output of route results.
+#          1.7.00 - Fast item parsing, CSV/TSV and columnar item files.
+#          1.6.00 - Resolve barcode only items from a local item snapshot index.
+#          1.5.00 - Quarantine malformed item lines instead of exiting.
 #          1.4.00 - Fetch XML versions of config files.
 #          1.3.00 - Add parsing of S-Series matrix.
 #          1.2.03 - Bug fix in -e during screen scraping.
@@ -42,15 +56,47 @@ import sys
 import getopt
 import os
 import re
+import mmap
+import struct
+import csv
+import io
+import json
+import gzip
+import asyncio
+import difflib
+import bisect
+from array import array
 from itertools import product # Produces product of vector of rules for analysis
 import urllib.request, urllib.error, urllib.parse
 import xml.etree.ElementTree # For XML parsing of config files.
 
-version = '1.4.00'
+version = '2.7.00'
 # Ensure the order of columns is consistent. XML doesn't guarantee order of tags.
 CONFIG_COL_ORDER = ['TargetRouteName', 'Alert', 'AlertType', 'MagneticMedia', 'MediaType', 'PermanentLocation',
             'DestinationLocation', 'CollectionCode', 'CallNumber', 'SortBin', 'BranchId', 'LibraryId', 'CheckInResult',
             'CustomTagData', 'DetectionSource']
+# Item lines are 'item_id|home_location|destination_library|item_type|call_number', see RuleEngine.test_item().
+ITEM_COLS = 5
+# Item column of each rule column the ILS supplies, after the item id.
+ITEM_COL_POSITION = {5: 1, 6: 2, 7: 3, 8: 4}
+# Item column of the Alert and AlertType rule columns, after the 5 item columns, when routing with holds.
+HOLD_COL_POSITION = {1: 5, 2: 6}
+# Alert and alert type of items that aren't in the holds snapshot.
+NO_HOLD = ('N', '*')
+# Item file formats read by ItemReader.
+ITEM_FORMATS = ('pipe', 'csv', 'tsv', 'columnar')
+# Checks run by RuleEngine.test_rules(), in order.
+LINT_CHECKS = ('bins', 'duplicates', 'order', 'locations', 'itypes')
+# Output formats written by RouteSink.
+SINK_FORMATS = ('text', 'jsonl', 'csv', 'tsv')
+# Reason codes written to the quarantine file in front of each rejected item line.
+QUARANTINE_REASONS = {
+    'EMPTY': 'blank line',
+    'SHORT': 'too few columns',
+    'LONG': 'too many columns, likely call number sub fields',
+    'UNKNOWN': 'barcode not found in the item snapshot',
+    'TIME': 'check-in timestamp could not be read',
+}
 # Manages the retrieval of the sorter's configuration. The class screen-scrapes the configuration
 # from a given sorter's web interface, logging in as required.
 # param:  password string of the password for the sorter you want to grab the config for.
@@ -67,22 +113,7 @@ class ConfigFetcher:
     # Parse XML into this format:
     #  R7 * * * * JUVPIC, JUVCONCEPT, JUVGRAPHIC, JUVICANRD * JBOOK, CD * * * * * * *
     def _parse_sort_matrix_XML_(self, page, explain):
-        lines = page.split('\n')
-        config = open('sorter.xml', 'w')
-        config.writelines(lines)
-        config.close()
-        e = xml.etree.ElementTree.parse('sorter.xml').getroot()
-        for atype in e.findall('SortRouteCriteria'):
-            line = ''
-            element_dict = {} # Store all keys and values and then order them as expected.
-            for child in atype:
-                element_dict[child.tag] = child.text
-            for col in CONFIG_COL_ORDER:
-                line = line + ' ' + element_dict[col]
-            line = line.replace(', ', ',')
-            if explain:
-                sys.stdout.write('LINE:"{0}"\n'.format(line))
-            self.rules.append(line)
+        self.rules.extend(parse_sort_matrix_xml(page, explain))
         return True
 
     # Manages logging into the sorter's web page. Not meant to be called outside of the class.
@@ -152,6 +183,30 @@ class ConfigFetcher:
             sys.exit(-3)
 
 
+# Reads the rules of an XML sort matrix, as exported by the sorter or fetched by ConfigFetcher, into lines that
+# RuleEngine.load_rule() reads, like:
+#  R7 * * * * JUVPIC,JUVCONCEPT,JUVGRAPHIC,JUVICANRD * JBOOK,CD * * * * * * *
+# XML doesn't guarantee the order of tags, so columns are put in CONFIG_COL_ORDER, and missing or empty ones are '*'.
+# param:  text string of the XML document.
+# param:  explain boolean, True to show each line as it is read.
+# return: list of rule lines.
+def parse_sort_matrix_xml(text, explain=False):
+    rules = []
+    root = xml.etree.ElementTree.fromstring(text)
+    for criteria in root.iter('SortRouteCriteria'):
+        element_dict = {} # Store all keys and values and then order them as expected.
+        for child in criteria:
+            element_dict[child.tag] = child.text
+        line = ''
+        for col in CONFIG_COL_ORDER:
+            line = line + ' ' + (str.strip(element_dict.get(col) or '') or '*')
+        line = line.replace(', ', ',')
+        if explain:
+            sys.stdout.write('LINE:"{0}"\n'.format(line))
+        rules.append(line)
+    return rules
+
+
 # Allows testing of item locations from the ILS.
 class Location:
     def __init__(self, explain=False):
@@ -307,18 +362,914 @@ class Itype:
             return True
 
 
-# A rule is a object that encapsulates a single AND operation, so represents data from a single column within
-# a configuration file. If a rule is provided as a string it is assumed to be either a single rule or a rule set
-# Where different values are permitted if separated by a ',' and optional space. In either case the rule is stored
-# and query-able.
-# Accepts either a string with optional ',', or a list.
+# Collects item lines that can't be routed because they don't have the expected number of columns. Symphony
+# separates call number sub fields with '|', so a line like '31221...|JUVFIC|EPLMNA|JBOOK|E PIC|v.1|' arrives with
+# too many columns. Rather than abandon the run, these lines are written to a reject file prefixed with a reason code
+# from QUARANTINE_REASONS, or optionally repaired by joining the extra call number sub fields back into one column.
+# param:  reject_file_name name of the file to write rejected lines to, or '' to just count them.
+# param:  repair boolean, True to re-join extra call number sub fields and keep routing the item.
+class ItemQuarantine:
+    def __init__(self, reject_file_name='', repair=False):
+        self.repair = repair
+        self.reject_file = None
+        if reject_file_name:
+            self.reject_file = open(reject_file_name, 'w')
+        self.quarantined = 0
+        self.repaired = 0
+        self.reasons = {}
+        # Reason the last line was quarantined, for callers that answer for each line.
+        self.last_reason = ''
+
+    # Checks an item's columns, repairing or quarantining it as required.
+    # param:  item_columns list of the item's columns, already split on '|'.
+    # param:  item_line the original line, written to the reject file as is.
+    # return: the list of columns to route, or None if the item was quarantined.
+    def check(self, item_columns, item_line):
+        if len(item_columns) == ITEM_COLS:
+            return item_columns
+        if len(item_columns) == 1 and item_columns[0] == '':
+            reason = 'EMPTY'
+        elif len(item_columns) < ITEM_COLS:
+            reason = 'SHORT'
+        else:
+            if self.repair:
+                self.repaired += 1
+                # Everything past the item type belongs to the call number.
+                return item_columns[:ITEM_COLS - 1] + [' '.join(item_columns[ITEM_COLS - 1:])]
+            reason = 'LONG'
+        self.reject(reason, item_line)
+        return None
+
+    # Quarantines an item line.
+    # param:  reason code, one of the keys of QUARANTINE_REASONS.
+    # param:  item_line the original line, written to the reject file as is.
+    def reject(self, reason, item_line):
+        self.quarantined += 1
+        self.last_reason = reason
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        if self.reject_file:
+            self.reject_file.write('{0}|{1}\n'.format(reason, item_line))
+
+    # Closes the reject file if one was opened.
+    def close(self):
+        if self.reject_file:
+            self.reject_file.close()
+            self.reject_file = None
+
+    # Writes the number of quarantined and repaired lines, by reason.
+    def report(self):
+        sys.stdout.write('quarantined {0} item line(s).\n'.format(self.quarantined))
+        for reason in sorted(self.reasons):
+            sys.stdout.write('  {0}: {1} ({2})\n'.format(reason, self.reasons[reason], QUARANTINE_REASONS[reason]))
+        if self.repair:
+            sys.stdout.write('repaired {0} item line(s) with call number sub fields.\n'.format(self.repaired))
+
+
+# A sorted, memory-mapped index of item routing columns keyed by barcode, so items can be given as barcodes
+# alone and resolved locally instead of with a selitem | selcallnum round trip per item. The index is built from
+# a bulk dump of the catalog produced with:
+# selitem -oNBlyt | selcallnum -iN -oSA >items.dump
+# which has lines like '31221106625838  |DAISY|EPLCLV|JDAISYTB|DAISY J 364.1523  DON HEN|'.
+# The file is laid out as a header, a table of fixed width (barcode, offset, length) entries sorted by barcode,
+# then the routing columns 'DAISY|EPLCLV|JDAISYTB|DAISY J 364.1523  DON HEN' for each entry.
+# param:  index_file_name name of an index built with ItemSnapshot.build().
+class ItemSnapshot:
+    MAGIC = b'SESNAP01'
+    # magic, record count, key width.
+    HEADER = struct.Struct('<8sIH')
+    # offset and length of the record's routing columns.
+    POINTER = struct.Struct('<II')
+
+    def __init__(self, index_file_name):
+        self.index_file = open(index_file_name, 'rb')
+        self.map = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.count, self.key_width) = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            sys.stderr.write("** error: {0} is not an item snapshot index.\n".format(index_file_name))
+            sys.exit(-1)
+        self.entry_width = self.key_width + self.POINTER.size
+        self.table_start = self.HEADER.size
+
+    # Finds the routing columns for a barcode.
+    # param:  barcode string.
+    # return: the routing columns as a pipe-delimited string, or None if the barcode isn't in the snapshot.
+    def lookup(self, barcode):
+        key = barcode.strip().encode().ljust(self.key_width, b'\0')
+        if len(key) > self.key_width:
+            return None
+        index_map = self.map
+        entry_width = self.entry_width
+        key_width = self.key_width
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) >> 1
+            start = self.table_start + middle * entry_width
+            if index_map[start:start + key_width] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count:
+            return None
+        start = self.table_start + low * entry_width
+        if index_map[start:start + key_width] != key:
+            return None
+        (offset, length) = self.POINTER.unpack_from(index_map, start + key_width)
+        return index_map[offset:offset + length].decode()
+
+    # Iterates over all the records in barcode order.
+    # return: generator of (barcode, routing_columns) as bytes.
+    def records(self):
+        for i in range(self.count):
+            start = self.table_start + i * self.entry_width
+            key = self.map[start:start + self.key_width].rstrip(b'\0')
+            (offset, length) = self.POINTER.unpack_from(self.map, start + self.key_width)
+            yield key, self.map[offset:offset + length]
+
+    def close(self):
+        self.map.close()
+        self.index_file.close()
+
+    # Builds, or rebuilds, an index from a bulk item dump. If the index already exists the dump is merged with it
+    # so only records that were added, changed or removed are re-encoded, and an unchanged dump leaves the index
+    # file untouched.
+    # param:  dump_file_name name of the selitem | selcallnum dump.
+    # param:  index_file_name name of the index to create or update.
+    # param:  changes optional function called with (old_columns, new_columns) for each record that was added, with
+    #   old_columns None, changed, or removed, with new_columns None. See ProfileStore.apply().
+    # return: dictionary of counts of 'added', 'changed', 'removed' and 'unchanged' records.
+    @staticmethod
+    def build(dump_file_name, index_file_name, changes=None):
+        dump = {}
+        with open(dump_file_name, 'rb') as dump_file:
+            for line in dump_file:
+                line = line.strip()
+                if line.endswith(b'|'):
+                    line = line[:-1]
+                fields = line.split(b'|', 1)
+                if len(fields) < 2 or not fields[0].strip():
+                    continue
+                dump[fields[0].strip()] = fields[1]
+        counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        records = []
+        old_snapshot = None
+        if os.path.isfile(index_file_name):
+            old_snapshot = ItemSnapshot(index_file_name)
+            for (barcode, columns) in old_snapshot.records():
+                new_columns = dump.pop(barcode, None)
+                if new_columns is None:
+                    counts['removed'] += 1
+                elif new_columns == columns:
+                    counts['unchanged'] += 1
+                    records.append((barcode, columns))
+                    continue
+                else:
+                    counts['changed'] += 1
+                    records.append((barcode, new_columns))
+                if changes:
+                    changes(columns, new_columns)
+        counts['added'] = len(dump)
+        if changes:
+            for columns in dump.values():
+                changes(None, columns)
+        if old_snapshot and counts['added'] + counts['changed'] + counts['removed'] == 0:
+            old_snapshot.close()
+            return counts
+        records.extend(dump.items())
+        records.sort()
+        key_width = max([len(barcode) for (barcode, columns) in records] + [1])
+        data_start = ItemSnapshot.HEADER.size + len(records) * (key_width + ItemSnapshot.POINTER.size)
+        temp_file_name = index_file_name + '.tmp'
+        with open(temp_file_name, 'wb') as index_file:
+            index_file.write(ItemSnapshot.HEADER.pack(ItemSnapshot.MAGIC, len(records), key_width))
+            offset = data_start
+            for (barcode, columns) in records:
+                index_file.write(barcode.ljust(key_width, b'\0'))
+                index_file.write(ItemSnapshot.POINTER.pack(offset, len(columns)))
+                offset += len(columns)
+            for (barcode, columns) in records:
+                index_file.write(columns)
+        if old_snapshot:
+            old_snapshot.close()
+        os.replace(temp_file_name, index_file_name)
+        return counts
+
+
+# Counts of catalog items by home location, item type and call number class, the weights that analyses of a matrix
+# need, without a fresh full catalog extract. Rather than being rebuilt by hand like loc.itype.db, the store is kept up
+# to date from the records that change between successive bulk item dumps, as found when the dump is merged into an
+# ItemSnapshot. The call number class is the class number of the normalized call number, up to 3 digits, as in
+# '364' for 'DAISY J 364.1523  DON HEN', which is what call number rules like '3*' or '36*' test, or the first word
+# of call numbers without one, like 'FIC'.
+# Layout: header, the '\n' separated names of the locations, item types and classes, then a table of 4 unsigned
+# integers for each profile: the indexes of its location, item type and class in the names, and its item count.
+# param:  file_name name of the store, read if it exists.
+class ProfileStore:
+    MAGIC = b'SEPROF01'
+    # magic, length of the names, number of profiles.
+    HEADER = struct.Struct('<8sII')
+
+    def __init__(self, file_name=''):
+        self.file_name = file_name
+        # (location, item type, call number class) to the number of items.
+        self.counts = {}
+        # The counts by class of each location and item type, built by count() when first needed.
+        self.classes = None
+        if file_name and os.path.isfile(file_name):
+            with open(file_name, 'rb') as store_file:
+                data = store_file.read()
+            if data[:len(self.MAGIC)] != self.MAGIC:
+                sys.stderr.write("** error: {0} is not a profile store.\n".format(file_name))
+                sys.exit(-1)
+            (magic, names_length, count) = self.HEADER.unpack_from(data, 0)
+            offset = self.HEADER.size
+            names = data[offset:offset + names_length].decode().split('\n')
+            table = array('I')
+            table.frombytes(data[offset + names_length:offset + names_length + 16 * count])
+            for i in range(0, len(table), 4):
+                self.counts[(names[table[i]], names[table[i + 1]], names[table[i + 2]])] = table[i + 3]
+
+    # Reports if a file is a profile store, rather than a text table like loc.itype.db.
+    # param:  file_name name of the file.
+    # return: True if the file starts with the store's magic and False otherwise.
+    @staticmethod
+    def is_store(file_name):
+        try:
+            with open(file_name, 'rb') as store_file:
+                return store_file.read(len(ProfileStore.MAGIC)) == ProfileStore.MAGIC
+        except OSError:
+            return False
+
+    # Finds the class of a call number, see the class comment.
+    # param:  call_number string.
+    # return: the class, or '' if there is no call number.
+    @staticmethod
+    def call_number_class(call_number):
+        words = normalize_call_number(call_number).split()
+        if not words:
+            return ''
+        if words[0][:1].isdigit():
+            return re.match(r'\d{1,3}', words[0]).group()
+        return words[0]
+
+    # Finds the profile of an item's routing columns.
+    # param:  columns the routing columns, 'location|library|item_type|call_number', as bytes from an ItemSnapshot.
+    # return: (location, item type, call number class).
+    def _key_(self, columns):
+        fields = [field.strip() for field in columns.decode(errors='replace').split('|')]
+        fields += [''] * (ITEM_COLS - 1 - len(fields))
+        # Call number sub fields separated by '|' belong to the call number, as ItemQuarantine repairs them.
+        return fields[0], fields[2], self.call_number_class(' '.join(fields[3:]))
+
+    # Adds items to a profile, or takes them off with a negative count.
+    # param:  key (location, item type, call number class).
+    # param:  count number of items.
+    def add(self, key, count=1):
+        self.classes = None
+        count += self.counts.get(key, 0)
+        if count > 0:
+            self.counts[key] = count
+        else:
+            self.counts.pop(key, None)
+
+    # Applies one record's change between dumps. Used as the changes function of ItemSnapshot.build().
+    # param:  old_columns the record's routing columns in the last dump, or None if it is new.
+    # param:  new_columns the record's routing columns in this dump, or None if it was removed.
+    def apply(self, old_columns, new_columns):
+        if old_columns is not None:
+            self.add(self._key_(old_columns), -1)
+        if new_columns is not None:
+            self.add(self._key_(new_columns))
+
+    # Counts every record of a snapshot, to start a store for a snapshot that was built without one.
+    # param:  snapshot ItemSnapshot.
+    def add_snapshot(self, snapshot):
+        for (barcode, columns) in snapshot.records():
+            self.add(self._key_(columns))
+
+    # Writes the store, replacing the file in one step so a reader never sees half of it.
+    # param:  file_name name of the store. Default: the file it was read from.
+    def save(self, file_name=''):
+        file_name = file_name or self.file_name
+        names = {}
+        table = array('I')
+        for key in sorted(self.counts):
+            for name in key:
+                table.append(names.setdefault(name, len(names)))
+            table.append(self.counts[key])
+        names_data = '\n'.join([name.replace('\n', ' ') for name in names]).encode()
+        temp_file_name = file_name + '.tmp'
+        with open(temp_file_name, 'wb') as store_file:
+            store_file.write(self.HEADER.pack(self.MAGIC, len(names_data), len(self.counts)))
+            store_file.write(names_data)
+            store_file.write(table.tobytes())
+        os.replace(temp_file_name, file_name)
+
+    # Totals the items of each location and item type, over all call number classes.
+    # return: dictionary of location to a dictionary of item type to items.
+    def pairs(self):
+        pairs = {}
+        for ((location, item_type, call_class), count) in self.counts.items():
+            types = pairs.setdefault(location, {})
+            types[item_type] = types.get(item_type, 0) + count
+        return pairs
+
+    # Counts the items of a location and item type whose call number class a call number column matches, with
+    # tokens like '3*' or '364', or '*' for all of them.
+    # param:  location name of the location.
+    # param:  item_type name of the item type.
+    # param:  call_numbers the call number column of a rule or spread sheet row. Default: '*'.
+    # return: number of items.
+    def count(self, location, item_type, call_numbers='*'):
+        if self.classes is None:
+            self.classes = {}
+            for ((other_location, other_type, call_class), count) in self.counts.items():
+                self.classes.setdefault((other_location, other_type), {})[call_class] = count
+        tokens = compile_tokens(call_numbers)
+        column = (0,) + tokens
+        total = 0
+        for (call_class, count) in self.classes.get((location, item_type), {}).items():
+            if tokens[3] or match_compiled([column], [call_class]):
+                total += count
+        return total
+
+    # return: the number of profiles and of items in the store.
+    def totals(self):
+        return len(self.counts), sum(self.counts.values())
+
+
+# The hold state of items, read from a bulk snapshot of holds rather than asked of the ILS item by item, and joined
+# to items as they are read. Each line is 'item_id|alert_type' or 'item_id|alert|alert_type', where the alert type
+# is 01 for a hold, 02 for a hold for another branch and 03 for ILL, as in the sorter's REJECT rules. Items that
+# aren't in the snapshot have no alert.
+# param:  file_name name of the holds snapshot.
+class HoldSnapshot:
+    def __init__(self, file_name):
+        self.holds = {}
+        with open(file_name, 'r') as holds_file:
+            for line in holds_file:
+                fields = [str.strip(field) for field in line.strip().rstrip('|').split('|')]
+                if len(fields) == 2:
+                    (item_id, alert, alert_type) = (fields[0], 'Y', fields[1])
+                elif len(fields) == 3:
+                    (item_id, alert, alert_type) = fields
+                else:
+                    continue
+                if alert_type.isdigit():
+                    alert_type = alert_type.zfill(2)
+                self.holds[item_id] = (alert, alert_type)
+
+    # Adds the Alert and AlertType columns to an item.
+    # param:  item_columns list of the item's 5 columns.
+    # return: the same list with the 2 alert columns appended.
+    def join(self, item_columns):
+        item_columns.extend(self.holds.get(item_columns[0].strip(), NO_HOLD))
+        return item_columns
+
+
+# Reads item files for RuleEngine.route(). Pipe-delimited files are read as bytes and only the columns the compiled
+# rules actually test are decoded. Columns no rule tests are handed on as '*', which passes every rule just as the
+# real value would. CSV and TSV files must have the same 5 columns as the pipe-delimited files. Lines that need a
+# snapshot lookup or have the wrong number of columns go through RuleEngine.parse_item() as usual.
+# param:  rule_engine RuleEngine to read items for.
+# param:  file_format one of 'pipe', 'csv' or 'tsv'. Columnar files are read with ColumnarItems.
+# param:  all_columns boolean, True to decode every column, say to convert the file to another format.
+class ItemReader:
+    def __init__(self, rule_engine, file_format='pipe', all_columns=False):
+        self.rule_engine = rule_engine
+        self.file_format = file_format
+        if all_columns:
+            used = set(range(1, ITEM_COLS))
+        else:
+            used = rule_engine.item_columns_used()
+        self.decode_column = [i in used for i in range(ITEM_COLS)]
+
+    # Reads the items in a file.
+    # param:  file_name name of the item file.
+    # return: generator of lists of the 5 item columns.
+    def read(self, file_name):
+        if self.file_format == 'pipe':
+            return self._read_pipe_(file_name)
+        return self._read_delimited_(file_name, '\t' if self.file_format == 'tsv' else ',')
+
+    def _read_pipe_(self, file_name):
+        (unused, use_location, use_library, use_type, use_callnum) = self.decode_column
+        normalize = self.rule_engine.normalize_call_numbers
+        holds = self.rule_engine.holds
+        values = self.rule_engine.values
+        with open(file_name, 'rb') as i_file:
+            for line in i_file:
+                line = line.strip()
+                if line.endswith(b'|'):
+                    line = line[:-1]
+                fields = line.split(b'|')
+                if len(fields) != ITEM_COLS:
+                    item_columns = self.rule_engine.parse_item(line.decode(errors='replace'))
+                    if item_columns is not None:
+                        yield item_columns
+                    continue
+                if use_callnum:
+                    call_number = fields[4].decode(errors='replace')
+                    if normalize:
+                        call_number = normalize_call_number(call_number)
+                else:
+                    call_number = '*'
+                item_columns = [fields[0].decode(errors='replace'),
+                                fields[1].decode(errors='replace') if use_location else '*',
+                                fields[2].decode(errors='replace') if use_library else '*',
+                                fields[3].decode(errors='replace') if use_type else '*',
+                                call_number]
+                if holds:
+                    holds.join(item_columns)
+                if values:
+                    values.intern_item(item_columns)
+                yield item_columns
+
+    def _read_delimited_(self, file_name, delimiter):
+        with open(file_name, 'r', newline='') as i_file:
+            for row in csv.reader(i_file, delimiter=delimiter):
+                if len(row) > ITEM_COLS and row[-1] == '':
+                    row.pop()
+                if len(row) != ITEM_COLS:
+                    item_columns = self.rule_engine.parse_item('|'.join(row))
+                    if item_columns is not None:
+                        yield item_columns
+                    continue
+                row[0] = row[0].lstrip()
+                row[-1] = row[-1].rstrip()
+                for i in range(1, ITEM_COLS):
+                    if not self.decode_column[i]:
+                        row[i] = '*'
+                if self.decode_column[4] and self.rule_engine.normalize_call_numbers:
+                    row[4] = normalize_call_number(row[4])
+                if self.rule_engine.holds:
+                    self.rule_engine.holds.join(row)
+                if self.rule_engine.values:
+                    self.rule_engine.values.intern_item(row)
+                yield row
+
+
+# A compact binary item file that can be memory-mapped and routed without parsing any lines. Each of the 5 item
+# columns is dictionary-encoded: the distinct values are stored once, and each item is a row of 4 byte codes into
+# those dictionaries. Since the codes identify every distinct combination of values, each combination is routed
+# once and the result reused for every other item that shares it.
+# Layout: header, then each column's dictionary as a count, a byte length and the '\n' separated values padded to
+# 4 bytes, then each column's codes.
+# param:  file_name name of a file written with ColumnarItems.write().
+class ColumnarItems:
+    MAGIC = b'SECOLS01'
+    # magic, byte order, item count.
+    HEADER = struct.Struct('<8s1sI')
+    DICTIONARY = struct.Struct('<II')
+
+    def __init__(self, file_name):
+        self.items_file = open(file_name, 'rb')
+        self.map = mmap.mmap(self.items_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, byte_order, self.count) = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC or byte_order != sys.byteorder[0].encode():
+            sys.stderr.write("** error: {0} is not a columnar item file for this machine.\n".format(file_name))
+            sys.exit(-1)
+        offset = self.HEADER.size
+        self.dictionaries = []
+        for col in range(ITEM_COLS):
+            (size, length) = self.DICTIONARY.unpack_from(self.map, offset)
+            offset += self.DICTIONARY.size
+            if size:
+                self.dictionaries.append(self.map[offset:offset + length].decode().split('\n'))
+            else:
+                self.dictionaries.append([])
+            offset += (length + 3) & ~3
+        view = memoryview(self.map)
+        self.codes = []
+        for col in range(ITEM_COLS):
+            self.codes.append(view[offset:offset + 4 * self.count].cast('I'))
+            offset += 4 * self.count
+
+    def close(self):
+        self.codes = []
+        self.map.close()
+        self.items_file.close()
+
+    # Routes every item in the file.
+    # param:  rule_engine RuleEngine to route with.
+    # return: generator of (item_id, result) where result is as returned by RuleEngine.route().
+    def route_all(self, rule_engine):
+        used = sorted([col for col in rule_engine.item_columns_used() if col < ITEM_COLS])
+        holds = rule_engine.holds
+        ids = self.dictionaries[0]
+        dictionaries = list(self.dictionaries)
+        if rule_engine.normalize_call_numbers:
+            # Each distinct call number only needs normalizing once.
+            dictionaries[4] = [normalize_call_number(call_number) for call_number in dictionaries[4]]
+        routes = {}
+        if used:
+            keys = zip(*[self.codes[col] for col in used])
+        else:
+            keys = [()] * self.count
+        for (id_code, key) in zip(self.codes[0], keys):
+            if holds:
+                key = key + holds.holds.get(ids[id_code].strip(), NO_HOLD)
+            try:
+                result = routes[key]
+            except KeyError:
+                item_columns = ['*'] * ITEM_COLS
+                for (col, code) in zip(used, key):
+                    item_columns[col] = dictionaries[col][code]
+                if holds:
+                    item_columns.extend(key[-2:])
+                result = routes[key] = rule_engine.route(item_columns)
+            yield ids[id_code], result
+
+    # Writes items to a columnar file.
+    # param:  items iterable of lists of the 5 item columns, like ItemReader.read() produces.
+    # param:  file_name name of the file to write.
+    # return: the number of items written.
+    @staticmethod
+    def write(items, file_name):
+        values = [{} for col in range(ITEM_COLS)]
+        codes = [array('I') for col in range(ITEM_COLS)]
+        for item_columns in items:
+            for col in range(ITEM_COLS):
+                value = item_columns[col].replace('\n', ' ')
+                code = values[col].get(value)
+                if code is None:
+                    code = values[col][value] = len(values[col])
+                codes[col].append(code)
+        count = len(codes[0])
+        with open(file_name, 'wb') as columnar_file:
+            columnar_file.write(ColumnarItems.HEADER.pack(ColumnarItems.MAGIC, sys.byteorder[0].encode(), count))
+            for col in range(ITEM_COLS):
+                blob = '\n'.join(values[col]).encode()
+                columnar_file.write(ColumnarItems.DICTIONARY.pack(len(values[col]), len(blob)))
+                columnar_file.write(blob.ljust((len(blob) + 3) & ~3, b'\0'))
+            for col in range(ITEM_COLS):
+                codes[col].tofile(columnar_file)
+        return count
+
+
+# Writes route results, either as the original text sentences or as JSON Lines, CSV or TSV records with the fields
+# item_id, bin, rule, line and matched. Results are collected and written in batches rather than a write per item,
+# and files whose names end in '.gz', or any file if compress is set, are gzip compressed.
+# param:  file_name name of the file to write to, or '' for stdout.
+# param:  sink_format one of SINK_FORMATS.
+# param:  compress boolean, True to gzip the output file.
+# param:  batch_size number of results to collect before writing them out.
+class RouteSink:
+    FIELDS = ['item_id', 'bin', 'rule', 'line', 'matched']
+
+    def __init__(self, file_name='', sink_format='text', compress=False, batch_size=1000):
+        self.sink_format = sink_format
+        self.batch_size = batch_size
+        self.batch = []
+        if not file_name:
+            self.out = sys.stdout
+        elif compress or file_name.endswith('.gz'):
+            self.out = gzip.open(file_name, 'wt', newline='')
+        else:
+            self.out = open(file_name, 'w', newline='')
+        self.csv_buffer = None
+        if sink_format in ('csv', 'tsv'):
+            self.csv_buffer = io.StringIO()
+            self.csv_writer = csv.writer(self.csv_buffer, delimiter='\t' if sink_format == 'tsv' else ',',
+                                         lineterminator='\n')
+            self.csv_writer.writerow(self.FIELDS)
+
+    # Formats and queues one result.
+    # param:  item_id string.
+    # param:  result the (line_no, rule_name, matched_tokens) from RuleEngine.route(), or None if no rule matched.
+    # param:  explain boolean, True to add the matching tokens again at the end of text lines.
+    def write(self, item_id, result, explain=False):
+        if self.sink_format == 'text':
+            if result:
+                (rule_index, rule_name, matched) = result
+                line = "{0}->bin {3} ({2}, line {1}) matches on {4}".format(item_id, rule_index, rule_name, bin_name(rule_name), matched)
+                if explain:
+                    line += ", matched on rule '{0}'.\n".format(matched)
+                else:
+                    line += "\n"
+            else:
+                line = "line --: {0}->bin E (R-) no rule matches.\n".format(item_id)
+            self.batch.append(line)
+        else:
+            record = self.record(item_id, result)
+            if self.csv_buffer:
+                record[4] = ','.join(record[4])
+                self.csv_writer.writerow(record)
+            else:
+                self.batch.append(json.dumps(dict(zip(self.FIELDS, record))) + '\n')
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        elif self.csv_buffer and (self.batch_size == 1 or self.csv_buffer.tell() >= self.batch_size * 64):
+            # With a batch size of 1, as for -e, each record is written straight away to keep pace with the trace.
+            self.flush()
+
+    # Gets the fields of one result as they are written to jsonl, csv and tsv files.
+    # param:  item_id string.
+    # param:  result the (line_no, rule_name, matched_tokens) from RuleEngine.route(), or None if no rule matched.
+    # return: list of the values of FIELDS.
+    @staticmethod
+    def record(item_id, result):
+        if result:
+            (rule_index, rule_name, matched) = result
+            return [item_id.strip(), bin_name(rule_name), rule_name, rule_index, matched]
+        return [item_id.strip(), 'E', None, None, []]
+
+    # Writes out any queued results.
+    def flush(self):
+        if self.csv_buffer:
+            self.out.write(self.csv_buffer.getvalue())
+            self.csv_buffer.seek(0)
+            self.csv_buffer.truncate()
+        if self.batch:
+            self.out.write(''.join(self.batch))
+            self.batch = []
+        self.out.flush()
+
+    def close(self):
+        if self.out is None:
+            return
+        self.flush()
+        if self.out is not sys.stdout:
+            self.out.close()
+        self.out = None
+
+# Serves routes over TCP, so check-in stations, or sortload.py, can ask where items go. Each line a client sends is an
+# item line as in an -i file, or just a barcode if there is a snapshot, and each is answered with one JSON line with
+# the fields of a jsonl result, or the item id and the quarantine reason code as 'error' if it can't be routed.
+# Bytes that aren't UTF-8 are replaced rather than dropping the connection, and a line longer than the stream's limit
+# is answered with 'OVERSIZE' as its error and skipped.
+# Each connection stands for an induction slot, and asyncio serves them concurrently. Items are routed in the event
+# loop itself, since a route takes microseconds.
+# param:  rule_engine RuleEngine with the matrix loaded.
+class RouteServer:
+    def __init__(self, rule_engine):
+        self.rule_engine = rule_engine
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+
+    # Routes one request.
+    # param:  line item line, without the line end.
+    # return: dictionary of the reply.
+    def reply(self, line):
+        self.requests += 1
+        item_columns = self.rule_engine.parse_item(line)
+        if item_columns is None:
+            self.errors += 1
+            return {'item_id': line.split('|')[0].strip(), 'error': self.rule_engine.quarantine.last_reason}
+        return dict(zip(RouteSink.FIELDS, RouteSink.record(item_columns[0], self.rule_engine.route(item_columns))))
+
+    async def _serve_client_(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    # The last line without a line end, or nothing at the end of the stream.
+                    line = e.partial
+                except asyncio.LimitOverrunError as e:
+                    self.requests += 1
+                    self.errors += 1
+                    writer.write((json.dumps({'item_id': '', 'error': 'OVERSIZE'}) + '\n').encode())
+                    await writer.drain()
+                    await self._skip_line_(reader, e.consumed)
+                    continue
+                if not line:
+                    break
+                writer.write((json.dumps(self.reply(line.decode(errors='replace').rstrip('\r\n'))) + '\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # Throws away the rest of a line longer than the stream's limit, so the next line can be served.
+    # param:  reader StreamReader of the connection.
+    # param:  consumed bytes of the line already in the stream's buffer, from the LimitOverrunError.
+    async def _skip_line_(self, reader, consumed):
+        try:
+            while True:
+                await reader.readexactly(consumed)
+                try:
+                    await reader.readuntil(b'\n')
+                    return
+                except asyncio.LimitOverrunError as e:
+                    consumed = e.consumed
+        except asyncio.IncompleteReadError:
+            pass
+
+    # Serves until the process is stopped.
+    # param:  host name or address to listen on, '' for all.
+    # param:  port number.
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._serve_client_, host or None, port)
+        for sock in server.sockets:
+            sys.stdout.write('serving routes on {0}:{1}.\n'.format(*sock.getsockname()[:2]))
+        sys.stdout.flush()
+        async with server:
+            await server.serve_forever()
+
+    def report(self):
+        sys.stdout.write('served {0} request(s) on {1} connection(s), {2} error(s).\n'.format(
+            self.requests, self.connections, self.errors))
+
+
+# Gets the bin number from a sort route name like 'R7', leaving other names like 'REJECT' as they are.
+# param:  rule_name string.
+# return: the bin as a string.
+def bin_name(rule_name):
+    if rule_name[:1] == 'R' and rule_name[1:].isdigit():
+        return rule_name[1:]
+    return rule_name
+
+
+# Compiles the comma separated tokens of one rule column, like '00*,01*,02*,7*,800,900', so an item's value can be
+# tested in a few dictionary lookups however many tokens there are. is_rule_match() tries the tokens left to right
+# and stops at the first one that matches, or at a '*' which lets anything through, so tokens after a '*' can never
+# be reached. Each token keeps its position so the first of several that match is the one reported.
+# param:  column string from the rule.
+# return: (exact, prefixes, lengths, has_star) where exact maps whole values, and prefixes maps the part before the
+#   trailing '*', to (position, token); lengths are the distinct prefix lengths, and has_star is True if the column
+#   lets unmatched values through.
+def compile_tokens(column):
+    exact = {}
+    prefixes = {}
+    has_star = False
+    position = 0
+    for token in column.split(','):
+        token = str.strip(token)
+        if token == '*':
+            has_star = True
+            break
+        if token.endswith('*'):
+            prefixes.setdefault(token[:-1], (position, token))
+        else:
+            exact.setdefault(token, (position, token))
+        position += 1
+    lengths = tuple(sorted(set([len(prefix) for prefix in prefixes])))
+    return exact, prefixes, lengths, has_star
+
+
+# Finds the token of a compiled rule column that comes closest to a value it didn't match, like 'JTALKINGBK' for
+# 'JTALKBK'. Prefix tokens like '36*' are compared with as much of the value as they would test.
+# param:  value string from the item.
+# param:  exact whole value tokens of the column, see compile_tokens().
+# param:  prefixes prefix tokens of the column.
+# param:  cutoff similarity, from 0 to 1, below which a token isn't close.
+# return: the closest token, the first in the rule if several are as close, or None if none is close.
+def nearest_token(value, exact, prefixes, cutoff=0.6):
+    candidates = [(position, token, token, value) for (token, (position, token)) in exact.items()]
+    candidates.extend([(position, token, prefix, value[:len(prefix)]) for (prefix, (position, token)) in prefixes.items()])
+    nearest = None
+    for (position, token, compared, with_value) in sorted(candidates):
+        ratio = difflib.SequenceMatcher(None, compared, with_value).ratio()
+        if ratio > cutoff or (ratio == cutoff and nearest is None):
+            (cutoff, nearest) = (ratio, token)
+    return nearest
+
+
+# Tests one rule compiled by RuleEngine.compile_rules() against an item, the same way RuleEngine.route() does for
+# each rule in turn. route() keeps its own copy of the loop since it runs once per rule per item.
+# param:  columns list of the rule's compiled (item_col, exact, prefixes, lengths, has_star) columns.
+# param:  item_columns list of the item's columns.
+# return: list of the matching tokens, empty if the rule doesn't fire.
+def match_compiled(columns, item_columns):
+    matched = []
+    for (item_col, exact, prefixes, lengths, has_star) in columns:
+        value = item_columns[item_col]
+        if value == '*':
+            continue
+        best = exact.get(value)
+        for length in lengths:
+            hit = prefixes.get(value[:length])
+            if hit is not None and (best is None or hit[0] < best[0]):
+                best = hit
+        if best is None:
+            if has_star:
+                continue
+            return []
+        matched.append(best[1])
+    return matched
+
+
+# Tests if some value could pass two compiled rule columns, see compile_tokens(). A column that lets unmatched values
+# through, or that a rule doesn't test at all (None), passes every value.
+# param:  column compiled (exact, prefixes, lengths, has_star) of one rule, or None.
+# param:  other compiled column of another rule, or None.
+# return: True if the columns overlap and False if no value can pass both.
+def columns_overlap(column, other):
+    if column is None or other is None or column[3] or other[3]:
+        return True
+    (exact, prefixes) = column[:2]
+    (other_exact, other_prefixes) = other[:2]
+    for value in exact:
+        if value in other_exact:
+            return True
+        for prefix in other_prefixes:
+            if value.startswith(prefix):
+                return True
+    for value in other_exact:
+        for prefix in prefixes:
+            if value.startswith(prefix):
+                return True
+    for prefix in prefixes:
+        for other_prefix in other_prefixes:
+            if prefix.startswith(other_prefix) or other_prefix.startswith(prefix):
+                return True
+    return False
+
+
+# Symphony call numbers often start with collection prefixes, as in 'DAISY J 364.1523  DON HEN' or 'J 796.332 GRE',
+# and can have runs of spaces, while call number rules like '3*' are written for the class number. This drops the
+# words in front of the first word that starts with a digit and single spaces the rest, so 'DAISY J 364.1523  DON HEN'
+# becomes '364.1523 DON HEN'. Call numbers without a class number, like fiction, are only re-spaced.
+# param:  call_number string.
+# return: the normalized call number.
+def normalize_call_number(call_number):
+    words = call_number.split()
+    for i in range(len(words)):
+        if words[i][:1].isdigit():
+            return ' '.join(words[i:])
+    return ' '.join(words)
+
+
+# A rule is one line of the sort matrix: the sort route name followed by the columns that must all match for the
+# route to fire. Each column is kept as written, like 'NONFICTION,REFERENCE', and also pre-split into its stripped
+# tokens, ('NONFICTION', 'REFERENCE'), so they aren't split again for every item. Rules can't be changed once made,
+# and index, iterate and compare like the lists of column strings they are made from, so rule[5] is still the
+# permanent location column.
+# param:  columns list of the rule's column strings, starting with the sort route name.
 class Rule:
-    def __init__(self, rules):
-        # parse the rules depending on the type of input. String or list.
-        self.rule = []
-        assert isinstance(rules, list)
-        for rule in rules:
-            sys.stdout.write(rule)
+    __slots__ = ('columns', 'tokens')
+
+    def __init__(self, columns):
+        assert isinstance(columns, (list, tuple))
+        object.__setattr__(self, 'columns', tuple([sys.intern(column) for column in columns]))
+        object.__setattr__(self, 'tokens', tuple([tuple([sys.intern(str.strip(token)) for token in column.split(',')])
+                                                  for column in columns]))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('rules can\'t be changed')
+
+    def __getitem__(self, index):
+        return self.columns[index]
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __eq__(self, other):
+        if isinstance(other, Rule):
+            return self.columns == other.columns
+        return list(self.columns) == other
+
+    def __hash__(self):
+        return hash(self.columns)
+
+    def __str__(self):
+        return str(list(self.columns))
+
+    def __repr__(self):
+        return 'Rule({0})'.format(list(self.columns))
+
+
+# Shares one copy of each distinct item column value, like 'NONFICTION' or 'BOOK', between all the items read, rather
+# than a new string for every line. Holding a day's or a collection's items in memory then costs little more than the
+# lists themselves. The pool starts with the names in the reference tables, see Location and Itype, and picks up any
+# other values, call numbers included, as they are first seen.
+# param:  names iterable of values to start the pool with.
+class ValuePool:
+    def __init__(self, names=()):
+        self.values = {}
+        for name in names:
+            self.intern(name)
+
+    # Builds a pool from the location and item type reference tables.
+    # param:  locations Location already loaded, like a RuleEngine's after test_rules(), or None to load one.
+    # param:  itypes Itype already loaded, or None to load one.
+    # return: ValuePool.
+    @staticmethod
+    def from_reference_tables(locations=None, itypes=None):
+        locations = locations or Location()
+        itypes = itypes or Itype()
+        return ValuePool(list(locations.locations) + list(itypes.types))
+
+    # Gets the shared copy of a value.
+    # param:  value string.
+    # return: the shared string equal to value.
+    def intern(self, value):
+        return self.values.setdefault(value, value)
+
+    # Interns the columns of an item after the item id, in place.
+    # param:  item_columns list of the item's columns.
+    # return: the same list.
+    def intern_item(self, item_columns):
+        for i in range(1, len(item_columns)):
+            item_columns[i] = self.values.setdefault(item_columns[i], item_columns[i])
+        return item_columns
 
 
 # Rule engine reads and stores rules, then tests can be run against arbitrary items.
@@ -356,6 +1307,28 @@ class RuleEngine:
         self.rule_table = []
         self.location_itype_db = "loc.itype.db"
         self.valid_location_itypes = {}
+        # Location and Itype reference tables, loaded when first needed unless shared from elsewhere.
+        self.locations = None
+        self.itypes = None
+        # Malformed item lines are diverted here rather than stopping the run.
+        self.quarantine = ItemQuarantine()
+        # Optional ItemSnapshot used to resolve items given as barcodes only.
+        self.snapshot = None
+        # Where route results are written, text to stdout unless main() is told otherwise.
+        self.sink = RouteSink()
+        # Optional HoldSnapshot. With holds, the alert rules are tested in matrix order instead of being skipped.
+        self.holds = None
+        # Line numbers of Alert=Y rules, so items they divert for holds can be counted.
+        self.alert_lines = set()
+        self.hold_count = 0
+        # True to normalize call numbers as items are read, see normalize_call_number().
+        self.normalize_call_numbers = False
+        # Optional ValuePool that item column values are shared through, for runs that keep items in memory.
+        self.values = None
+        # Built by compile_rules() the first time an item is routed.
+        self.compiled_rules = None
+        self.item_count = 0
+        self.exception_count = 0
 
     # Tests if a dictionary has a key that matches the supplied string. The matching accounts for
     # globular naming. For example, if a dictionary has a key of 'TEENCOLL', supplying 'TEEN*' will
@@ -370,11 +1343,19 @@ class RuleEngine:
                 return dictionary[key]
         return {}
 
-    # Opens the db file and reads all the combinations of locations and item types.
+    # Opens the db file and reads all the combinations of locations and item types. The db file can also be a
+    # ProfileStore, kept up to date from item dumps, rather than the flat loc.itype.db.
     # param:
     def get_master_rule_map(self, db_file_name, explain=False):
         return_hash = {}
-        if not os.path.isfile(db_file_name):
+        if self.valid_location_itypes:
+            # Already loaded, or shared from another engine.
+            return return_hash
+        if ProfileStore.is_store(db_file_name):
+            sys.stdout.write("loading profiles {0}.\n".format(db_file_name))
+            for (location, item_counts) in ProfileStore(db_file_name).pairs().items():
+                self.valid_location_itypes[location] = dict([(itype, itype) for itype in item_counts])
+        elif not os.path.isfile(db_file_name):
             sys.stderr.write("* warn: location itype file {0} does not exist.\n".format(self.location_itype_db))
             sys.stderr.write("* A new one can be generated from the ILS with the following.\n")
             sys.stderr.write("selitem -olt | sort | uniq | pipe.pl -oc0,c1 >loc.itype.db\n")
@@ -400,11 +1381,14 @@ class RuleEngine:
         return return_hash
 
     # Tests for duplicate rule entries.
+    # param:  explain boolean, True to show every combination of values the rules cover.
+    # return: True if no two rules cover the same combination and False otherwise.
     def test_duplicates(self, explain=True):
         # Create a hash map into which we put keys made of the strings
         # of all combinations of rules on a given line,  and-ed together.
         # Once done, if the key appears twice it is has an identical twin.
         count = 0
+        is_unique = True
         master_rule_map = self.get_master_rule_map(self.location_itype_db)
         if len(master_rule_map) > 0:
             # Rules are in lists like:
@@ -438,8 +1422,8 @@ class RuleEngine:
         # "['R2', '*', '*', '*', '*', 'TEENCOLL,TEENGRAPHC,TEENFIC', '*', 'JBOOK,JPBK', '*', '*', '*', '*', '*', '*', '*']"
         for line in self.rule_table:
             my_item_list = []
-            rule_name = line.pop(0)
-            for item_entry in line:
+            rule_name = line[0]
+            for item_entry in line[1:]:
                 if item_entry[0] == '*':
                     continue
                 elif item_entry.find(','):
@@ -461,16 +1445,18 @@ class RuleEngine:
                 # Add each new name as a key into a hashmap with the rule name as the value.
                 if rule_string in master_rule_map:
                     sys.stdout.write("** Warning duplicate rule detected in rule {0} and {1}->{2}\n".format(master_rule_map[rule_string], rule_name, rule_string.split('.')))
+                    is_unique = False
                 else:
                     master_rule_map[rule_string] = rule_name
-            # Put the route name back on the list for reference later during item check.
-            line.insert(0, rule_name)
+        return is_unique
 
     # Tests if the locations entered in the permanent location column are all valid locations at the library.
     # param:  none
     # return: True if all locations entered are valid and false otherwise.
     def test_valid_location(self):
-        location_lookup = Location()
+        if self.locations is None:
+            self.locations = Location()
+        location_lookup = self.locations
         result = True
         line_no = 1
         for line in self.rule_table:
@@ -489,12 +1475,15 @@ class RuleEngine:
             sys.stdout.write('pass.\n')
         else:
             sys.stdout.write('fail.\n')
+        return result
 
     # Tests if the locations entered in the permanent location column are all valid locations at the library.
     # param:  none
     # return: True if all locations entered are valid and false otherwise.
     def test_valid_itypes(self):
-        type_lookup = Itype()
+        if self.itypes is None:
+            self.itypes = Itype()
+        type_lookup = self.itypes
         result = True
         line_no = 1
         for line in self.rule_table:
@@ -506,11 +1495,26 @@ class RuleEngine:
                     result = False
                 if my_type[-1] == '#':
                     sys.stdout.write("** error item type {0} on line {1} contains a trailing space\n".format(my_type, line_no))
+                    result = False
             line_no += 1
         if result:
             sys.stdout.write('pass.\n')
         else:
             sys.stdout.write('fail.\n')
+        return result
+
+    # Loads all the rules in a config file, pipe-delimited, screen-scraped or XML.
+    # param:  config_file name of the file.
+    def load_config(self, config_file):
+        c_file = open(config_file, 'r')
+        text = c_file.read()
+        c_file.close()
+        if text.lstrip().startswith('<'):
+            for line in parse_sort_matrix_xml(text):
+                self.load_rule(line)
+        else:
+            for line in text.splitlines(True):
+                self.load_rule(line)
 
     # Loads a rule from the config file, adjusting to 2 different types of formatting. The config file can be created
     # by hand separating the columns with pipes, but that got boring so the method can also parse values that are cut
@@ -531,7 +1535,8 @@ class RuleEngine:
             for col in this_line_list:
                 if col != '\n': # Sometimes Symphony users will include a trailing '|' which will cause and empty field.
                     new_list.append(col)
-            self.rule_table.append(new_list)
+            self.rule_table.append(Rule(new_list))
+            self.compiled_rules = None
             # sys.stdout.write("****{0}\n".format(new_list))
         else:
             sys.stderr.write('** "{0}" not enough rules, ignoring.'.format(rule_line))
@@ -620,23 +1625,28 @@ class RuleEngine:
     # In the second case we search similar rules by cherry picking the '*' candidates and determine if there are rules
     # that follow the current rule that are more refined.
     # grep DVD* in [DVD21,JCD,JDVD]
+    # return: dictionary of check name, one of LINT_CHECKS, to True if it passed and False otherwise.
     def test_rules(self, explain=False):
         # now we want to expand all the lists within a line so that each member creates a new list.
+        results = {}
         sys.stdout.write('testing bins.\n')
-        self.check_bins(explain)
+        results['bins'] = self.check_bins(explain)
         sys.stdout.write('done.\n')
         sys.stdout.write('testing for redundant rules.\n')
-        self.test_duplicates(explain)
+        results['duplicates'] = self.test_duplicates(explain)
         sys.stdout.write('done.\n')
         sys.stdout.write('rule order: \n')
-        if self.is_check_rule_order(explain):
+        results['order'] = self.is_check_rule_order(explain)
+        if results['order']:
             sys.stdout.write('pass.\n')
         sys.stdout.write('valid locations: \n')
-        self.test_valid_location()
+        results['locations'] = self.test_valid_location()
         sys.stdout.write('valid item types: \n')
-        self.test_valid_itypes()
+        results['itypes'] = self.test_valid_itypes()
+        return results
 
     # Checks if all the bins are utilized.
+    # return: True if the matrix routes to at least one bin and False otherwise.
     def check_bins(self, explain=False):
         bins = []
         for i in range(0, len(self.rule_table)):
@@ -657,6 +1667,7 @@ class RuleEngine:
         bin_key_list.sort()
         for name in bin_key_list:
             sys.stdout.write('bin #{0} has {1} rule(s).\n'.format(name, bin_dict[name]))
+        return len(bin_key_list) > 0
 
     # Tests an items data from the ILS and returns a list of the [ item_id, is_match, rule# ]
     # param:  single rule line from the matrix.
@@ -669,8 +1680,9 @@ class RuleEngine:
         # TODO Find out why this fails with IDY Staff induction.
         if len(line_items) != len(rule):
             # This can occur if the call number includes sub fields on volumes, Symphony uses '|' for this purpose.
-            sys.stdout.write('columns don\'t match item cols:{0}, rule cols:{1}, do the items have enough data?\n'.format(len(line_items), len(rule)))
-            sys.exit(1)
+            # test_item() quarantines such items, so getting here means the rule itself has the wrong column count.
+            sys.stderr.write('columns don\'t match item cols:{0}, rule cols:{1}, do the items have enough data?\n'.format(len(line_items), len(rule)))
+            return [line_items[0], False, rule[0], []]
         # Since we do a side by side comparison of config columns to item columns
         # we need to ensure that the item_line has the same number of columns.
         # The data arrives from
@@ -681,13 +1693,13 @@ class RuleEngine:
         match_count = 1 # the first col of a rule and of the item don't have to match.
         matched_rules = []
         for index in range(1, len(line_items)):
-            regexes = rule[index].split(',') # regexes can look like BOOK,PBK*
+            regexes = rule.tokens[index] # regexes can look like BOOK,PBK*
             test_col = line_items[index]
             no_match_count = 0
             if explain:
                 sys.stdout.write('\n=== new test sequence ===\n')
             for reg in regexes:
-                regex = str.strip(reg)
+                regex = reg
                 if explain:
                     sys.stdout.write('"{0}" <=> "{1}", '.format(reg, test_col))
                 if regex == '*': # That was a star so everything automatically matches.
@@ -727,49 +1739,656 @@ class RuleEngine:
     # '31221115689585  |PBKMYS|EPLSTR|BOOK|870.44|'
     def test_item(self, item, explain=True):
         # the rules must match top down
+        item_columns = self.parse_item(item)
+        if item_columns is None:
+            return
+        if explain:
+            result = self.trace_item(item_columns)
+        else:
+            result = self.route(item_columns)
+        self.report_route(item_columns[0], result, explain)
+
+    # Splits an item line into its columns, resolving barcode only lines from the snapshot, if there is one, and
+    # quarantining lines that don't have the right number of columns.
+    # param:  item line as read from the item file.
+    # return: list of the item's 5 columns, or None if the line was quarantined.
+    def parse_item(self, item):
         my_item = str.strip(item)
         if my_item.endswith('|'):
             my_item = my_item[:-1]
-        item_columns = my_item.split('|')
-        # The script just works on the general case of assuming there are no holds for these items, to see where
-        # they would theoretically fall into.
-        # sys.stdout.write('item_array:{0}\n'.format(item_columns))
-        for i in range(1, len(CONFIG_COL_ORDER)): # instead of sort route we have an item id.
-            if i < 5: # put stars in the following positions to match rule columns.
-                item_columns.insert(i, '*')
-            if i > 8:
-                item_columns.append('*')
+        if self.snapshot and my_item and '|' not in my_item:
+            routing_columns = self.snapshot.lookup(my_item)
+            if routing_columns is None:
+                self.quarantine.reject('UNKNOWN', my_item)
+                return None
+            my_item = my_item + '|' + routing_columns
+        item_columns = self.quarantine.check(my_item.split('|'), my_item)
+        if item_columns is not None:
+            if self.normalize_call_numbers:
+                item_columns[4] = normalize_call_number(item_columns[4])
+            if self.holds:
+                self.holds.join(item_columns)
+            if self.values:
+                self.values.intern_item(item_columns)
+        return item_columns
+
+    # Reports which bin an item was routed to.
+    # param:  item_id string.
+    # param:  result the (line_no, rule_name, matched_tokens) from route(), or None if no rule matched.
+    # param:  explain boolean, True to add the matching tokens again at the end of the line.
+    def report_route(self, item_id, result, explain=False):
+        self.item_count += 1
+        if not result:
+            self.exception_count += 1
+        elif result[0] in self.alert_lines:
+            self.hold_count += 1
+        self.sink.write(item_id, result, explain)
+
+    # Routes an item through is_rule_match() one rule at a time, showing how each column compared. This is the
+    # reference that faster ways of routing, like route(), must agree with, see sortfuzz.py.
+    # param:  item_columns list of the item's 5 columns.
+    # param:  explain boolean, False to route quietly.
+    # return: the (line_no, rule_name, matched_tokens) of the rule that fired, or None if no rule matched.
+    def trace_item(self, item_columns, explain=True):
+        # Without a holds snapshot the script just works on the general case of assuming there are no holds for these
+        # items, to see where they would theoretically fall into. Put stars in the columns we don't get from the ILS
+        # to match rule columns.
+        padded_columns = ['*'] * len(CONFIG_COL_ORDER)
+        padded_columns[0] = item_columns[0]
+        for (rule_col, item_col) in self._item_col_position_().items():
+            padded_columns[rule_col] = item_columns[item_col]
         # Convert back to string
-        item_string = '|'.join(item_columns)
+        item_string = '|'.join(padded_columns)
         # Test print item with complete columns.
         if explain:
             sys.stdout.write('item_string:{0}\n'.format(item_string))
-        rule_index = 1
-        rule_match = False
-        for rule in self.rule_table:
-            # TODO: fix so we can optionally handle material with holds.
-            # This skips the first three special rules for handling materials with holds. Just look at the general case
-            # for a given item.
-            if rule[1] == 'Y' or rule[1] == 'N':
-                rule_index += 1
-                continue
+        for (rule_index, rule) in self._rule_order_():
             result = self.is_rule_match(rule, item_string, explain)
-            # result = self.is_rule_match(rule, item_string)
             if result[1]:
-                sys.stdout.write("{0}->bin {3} ({2}, line {1}) matches on {4}".format(item_columns[0], rule_index, result[2], result[2][1:], result[3]))
-                if explain:
-                    sys.stdout.write(", matched on rule '{0}'.\n".format(result[3]))
+                return rule_index, result[2], result[3]
+        return None
+
+    # Lists the rules in the order they are tested, with their line numbers. Without holds the alert rules for
+    # materials with holds are skipped, to look at the general case for a given item. With holds they are tested
+    # where they are in the matrix, top down like every other rule, as the sorter does.
+    # return: list of (line_no, rule).
+    def _rule_order_(self):
+        rules = []
+        rule_index = 0
+        for rule in self.rule_table:
+            rule_index += 1
+            if (rule[1] == 'Y' or rule[1] == 'N') and not self.holds:
+                continue
+            rules.append((rule_index, rule))
+        return rules
+
+    # Maps rule columns to item columns, including the alert columns when routing with holds.
+    # return: dictionary of rule column to item column.
+    def _item_col_position_(self):
+        if self.holds:
+            positions = dict(HOLD_COL_POSITION)
+            positions.update(ITEM_COL_POSITION)
+            return positions
+        return ITEM_COL_POSITION
+
+    # Compiles the rule table for route(). Each rule keeps only the columns that can fail or match an item, with its
+    # tokens stripped once here rather than for every item. Columns whose first token is '*' always pass, as do
+    # columns the ILS doesn't supply since the item has '*' there, so neither needs testing. Alert rules are skipped
+    # without holds, see _rule_order_(), and rules with the wrong number of columns can never match. Only the
+    # Alert=Y rules divert items with holds; Alert=N rules match items without one.
+    def compile_rules(self):
+        self.compiled_rules = []
+        self.alert_lines = set()
+        positions = self._item_col_position_()
+        for (rule_index, rule) in self._rule_order_():
+            if rule[1] == 'Y':
+                self.alert_lines.add(rule_index)
+            if len(rule) != len(CONFIG_COL_ORDER):
+                continue
+            columns = []
+            for (rule_col, item_col) in positions.items():
+                (exact, prefixes, lengths, has_star) = compile_tokens(rule[rule_col])
+                if exact or prefixes:
+                    columns.append((item_col, exact, prefixes, lengths, has_star))
+            self.compiled_rules.append((rule_index, rule[0], columns))
+
+    # Reports which item columns the compiled rules look at. Columns no rule tests don't need to be read at all.
+    # return: set of item column indexes.
+    def item_columns_used(self):
+        if self.compiled_rules is None:
+            self.compile_rules()
+        used = set()
+        for (rule_index, rule_name, columns) in self.compiled_rules:
+            for column in columns:
+                used.add(column[0])
+        return used
+
+    # Finds the first rule that matches an item, with the same results as is_rule_match() but without building,
+    # joining and re-splitting a padded copy of the item for every rule, or testing tokens one by one.
+    # param:  item_columns list of the item's 5 columns.
+    # return: the (line_no, rule_name, matched_tokens) of the rule that fired, or None if no rule matched.
+    def route(self, item_columns):
+        if self.compiled_rules is None:
+            self.compile_rules()
+        for (rule_index, rule_name, columns) in self.compiled_rules:
+            matched = []
+            for (item_col, exact, prefixes, lengths, has_star) in columns:
+                value = item_columns[item_col]
+                if value == '*': # Item has starred field, so any rule passes.
+                    continue
+                best = exact.get(value)
+                for length in lengths:
+                    hit = prefixes.get(value[:length])
+                    if hit is not None and (best is None or hit[0] < best[0]):
+                        best = hit
+                if best is None:
+                    if has_star:
+                        continue
+                    break
+                matched.append(best[1])
+            else:
+                # Like is_rule_match(), a rule only fires if at least one column matched on a token.
+                if matched:
+                    return rule_index, rule_name, matched
+        return None
+
+    # Finds where an item goes and, for each rule tested before the one that fired, why it didn't take the item, from
+    # the compiled rules in one pass rather than the column by column trace of -e. A rule fails at its first column
+    # that doesn't match and has no '*', or, with every column passed, because none of them matched on a token.
+    # Rules that can never match, with the wrong number of columns, and alert rules without holds, aren't tested.
+    # param:  item_columns list of the item's 5 columns.
+    # return: (result, misses) where result is as from route(), and misses has (line_no, rule_name, column_name,
+    #   value, nearest) for each rule tested before it: the column that failed, the item's value there and the
+    #   rule's closest token, see nearest_token(). column_name, value and nearest are None if no column matched.
+    def why_not(self, item_columns):
+        if self.compiled_rules is None:
+            self.compile_rules()
+        column_names = dict([(item_col, CONFIG_COL_ORDER[rule_col])
+                             for (rule_col, item_col) in self._item_col_position_().items()])
+        misses = []
+        for (rule_index, rule_name, columns) in self.compiled_rules:
+            matched = []
+            failed = None
+            for (item_col, exact, prefixes, lengths, has_star) in columns:
+                value = item_columns[item_col]
+                if value == '*':
+                    continue
+                best = exact.get(value)
+                for length in lengths:
+                    hit = prefixes.get(value[:length])
+                    if hit is not None and (best is None or hit[0] < best[0]):
+                        best = hit
+                if best is None:
+                    if has_star:
+                        continue
+                    failed = (column_names[item_col], value, nearest_token(value, exact, prefixes))
+                    break
+                matched.append(best[1])
+            if failed is None and matched:
+                return (rule_index, rule_name, matched), misses
+            misses.append((rule_index, rule_name) + (failed or (None, None, None)))
+        return None, misses
+
+    # Writes the answer of why_not() for an item.
+    # param:  item_id string.
+    # param:  result from why_not().
+    # param:  misses from why_not().
+    def report_why_not(self, item_id, result, misses):
+        if result:
+            (rule_index, rule_name, matched) = result
+            sys.stdout.write('{0}->bin {1} ({2}, line {3}) matches on {4}\n'.format(
+                item_id, bin_name(rule_name), rule_name, rule_index, matched))
+        else:
+            sys.stdout.write('{0}->bin E (R-) no rule matches.\n'.format(item_id))
+        for (rule_index, rule_name, column_name, value, nearest) in misses:
+            sys.stdout.write('  line {0} ({1}): '.format(rule_index, rule_name))
+            if column_name is None:
+                sys.stdout.write('no column matched on a token.\n')
+            elif nearest is None:
+                sys.stdout.write('{0} \'{1}\' not in the rule.\n'.format(column_name, value))
+            else:
+                sys.stdout.write('{0} \'{1}\' not in the rule, nearest \'{2}\'.\n'.format(column_name, value, nearest))
+
+    # Finishes writing route results, then writes a summary of the items routed, including any lines that were
+    # quarantined.
+    def report_items(self):
+        self.sink.close()
+        sys.stdout.write('routed {0} item(s), {1} to the exception bin.\n'.format(self.item_count, self.exception_count))
+        if self.holds:
+            sys.stdout.write('{0} item(s) diverted by alert rules for holds.\n'.format(self.hold_count))
+        self.quarantine.report()
+
+
+# A matrix compiled by RuleEngine.compile_rules(), flattened into one file that any number of worker processes can
+# map read-only and route with, rather than each loading and compiling the matrix, or being sent a pickled copy of
+# the compiled rules. The pages are shared between the processes through the page cache, so it doesn't matter how
+# many workers, or matrices, there are. A file on /dev/shm never touches the disk.
+# The rule names and every token are kept once, sorted, in a vocabulary, and the tokens of each rule column as sorted
+# vocabulary indexes, so an item's value is found with a binary search of the vocabulary and then of the column.
+# Values found in the vocabulary are remembered for the process, since most items share their location and item
+# type, so the memory used is bounded by the vocabulary. Values that aren't there, like most call numbers and their
+# prefixes, are searched for each time rather than filling the process with every value ever seen.
+# Routes exactly as RuleEngine.route() does, holds included if the engine had them when it was written.
+# Layout: header, the vocabulary as count + 1 offsets and the strings padded to 4 bytes, then tables of unsigned
+# integers: 4 for each rule (line number, name, first column, column count), 7 for each column (item column, has
+# star, first token, exact count, prefix count, first length, length count), each column's exact then prefix tokens
+# with their positions in a second table, and the distinct prefix lengths.
+# param:  file_name name of a file written with CompiledMatrix.write().
+class CompiledMatrix:
+    MAGIC = b'SEMATX01'
+    # magic, byte order, holds, vocabulary, rule, column, token and length counts.
+    HEADER = struct.Struct('<8s1s?IIIII')
+
+    def __init__(self, file_name):
+        self.matrix_file = open(file_name, 'rb')
+        self.map = mmap.mmap(self.matrix_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, byte_order, self.holds, self.word_count, self.rule_count, column_count, token_count,
+         length_count) = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC or byte_order != sys.byteorder[0].encode():
+            sys.stderr.write("** error: {0} is not a compiled matrix for this machine.\n".format(file_name))
+            sys.exit(-1)
+        view = memoryview(self.map)
+        offset = self.HEADER.size
+        self.offsets = view[offset:offset + 4 * (self.word_count + 1)].cast('I')
+        offset += 4 * (self.word_count + 1)
+        self.words_start = offset
+        offset += (self.offsets[self.word_count] + 3) & ~3
+        tables = []
+        for size in (4 * self.rule_count, 7 * column_count, token_count, token_count, length_count):
+            tables.append(view[offset:offset + 4 * size].cast('I'))
+            offset += 4 * size
+        (self.rules, self.columns, self.tokens, self.positions, self.lengths) = tables
+        # Vocabulary index of values this process has found, and the text of the words.
+        self.ids = {}
+        self.words = {}
+        # Read from the rule and column tables the first time an item is routed.
+        self.compiled_rules = None
+
+    def close(self):
+        self.offsets = self.rules = self.columns = self.tokens = self.positions = self.lengths = None
+        self.compiled_rules = None
+        self.map.close()
+        self.matrix_file.close()
+
+    # Gets a word of the vocabulary.
+    # param:  index of the word.
+    # return: the word as a string.
+    def word(self, index):
+        try:
+            return self.words[index]
+        except KeyError:
+            start = self.words_start + self.offsets[index]
+            word = self.words[index] = self.map[start:start + self.offsets[index + 1] - self.offsets[index]].decode()
+            return word
+
+    # Finds a value in the vocabulary.
+    # param:  value string.
+    # return: the index of the value, or -1 if no rule has it.
+    def lookup(self, value):
+        try:
+            return self.ids[value]
+        except KeyError:
+            pass
+        key = value.encode()
+        offsets = self.offsets
+        index_map = self.map
+        words_start = self.words_start
+        low = 0
+        high = self.word_count
+        while low < high:
+            middle = (low + high) >> 1
+            if index_map[words_start + offsets[middle]:words_start + offsets[middle + 1]] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.word_count or index_map[words_start + offsets[low]:words_start + offsets[low + 1]] != key:
+            return -1
+        self.ids[value] = low
+        return low
+
+    # Finds a token among a column's sorted tokens.
+    # param:  word vocabulary index of the value.
+    # param:  start of the column's exact or prefix tokens.
+    # param:  end of them.
+    # return: index of the token, or -1 if the column doesn't have it.
+    def _find_(self, word, start, end):
+        if word < 0 or start == end:
+            return -1
+        index = bisect.bisect_left(self.tokens, word, start, end)
+        if index < end and self.tokens[index] == word:
+            return index
+        return -1
+
+    # Reads the rule and column tables, which are small next to the tokens, into tuples for route().
+    # return: list of (line_no, rule_name, columns) where each column is (item_col, has_star, start of the exact
+    #   tokens, end of the exact tokens, end of the prefix tokens, prefix lengths).
+    def _rule_table_(self):
+        rule_table = []
+        for rule in range(0, 4 * self.rule_count, 4):
+            (rule_index, name, first_column, column_count) = self.rules[rule:rule + 4]
+            columns = []
+            for column in range(7 * first_column, 7 * (first_column + column_count), 7):
+                (item_col, has_star, start, exact_count, prefix_count, first_length,
+                 length_count) = self.columns[column:column + 7]
+                columns.append((item_col, has_star, start, start + exact_count, start + exact_count + prefix_count,
+                                tuple(self.lengths[first_length:first_length + length_count])))
+            rule_table.append((rule_index, self.word(name), columns))
+        return rule_table
+
+    # Reports which item columns the compiled rules look at, as RuleEngine.item_columns_used() does.
+    # return: set of item column indexes.
+    def item_columns_used(self):
+        return set([self.columns[7 * column] for column in range(len(self.columns) // 7)])
+
+    # Finds the first rule that matches an item, see RuleEngine.route().
+    # param:  item_columns list of the item's 5 columns, and the 2 alert columns if the matrix was written with holds.
+    # return: the (line_no, rule_name, matched_tokens) of the rule that fired, or None if no rule matched.
+    def route(self, item_columns):
+        if self.compiled_rules is None:
+            self.compiled_rules = self._rule_table_()
+        lookup = self.lookup
+        find = self._find_
+        positions = self.positions
+        for (rule_index, rule_name, columns) in self.compiled_rules:
+            matched = []
+            for (item_col, has_star, start, exact_end, prefix_end, lengths) in columns:
+                value = item_columns[item_col]
+                if value == '*':
+                    continue
+                best = find(lookup(value), start, exact_end)
+                token = value
+                for length in lengths:
+                    hit = find(lookup(value[:length]), exact_end, prefix_end)
+                    if hit >= 0 and (best < 0 or positions[hit] < positions[best]):
+                        best = hit
+                        token = value[:length] + '*'
+                if best < 0:
+                    if has_star:
+                        continue
+                    break
+                matched.append(token)
+            else:
+                if matched:
+                    return rule_index, rule_name, matched
+        return None
+
+    # Writes the compiled rules of a matrix to a file.
+    # param:  rule_engine RuleEngine with the matrix loaded, and holds if the alert rules are to be tested.
+    # param:  file_name name of the file to write.
+    # return: the number of rules written.
+    @staticmethod
+    def write(rule_engine, file_name):
+        if rule_engine.compiled_rules is None:
+            rule_engine.compile_rules()
+        words = set()
+        for (rule_index, rule_name, columns) in rule_engine.compiled_rules:
+            words.add(rule_name.encode())
+            for (item_col, exact, prefixes, lengths, has_star) in columns:
+                words.update([value.encode() for value in exact])
+                words.update([prefix.encode() for prefix in prefixes])
+        words = sorted(words)
+        index = dict([(word, i) for (i, word) in enumerate(words)])
+        offsets = array('I', [0])
+        for word in words:
+            offsets.append(offsets[-1] + len(word))
+        rules = array('I')
+        column_table = array('I')
+        tokens = array('I')
+        positions = array('I')
+        length_table = array('I')
+        for (rule_index, rule_name, columns) in rule_engine.compiled_rules:
+            rules.extend([rule_index, index[rule_name.encode()], len(column_table) // 7, len(columns)])
+            for (item_col, exact, prefixes, lengths, has_star) in columns:
+                column_table.extend([item_col, 1 if has_star else 0, len(tokens), len(exact), len(prefixes),
+                                     len(length_table), len(lengths)])
+                for table in (exact, prefixes):
+                    for (word, value) in sorted([(index[value.encode()], value) for value in table]):
+                        tokens.append(word)
+                        positions.append(table[value][0])
+                length_table.extend(lengths)
+        blob = b''.join(words)
+        temp_file_name = file_name + '.tmp'
+        with open(temp_file_name, 'wb') as matrix_file:
+            matrix_file.write(CompiledMatrix.HEADER.pack(CompiledMatrix.MAGIC, sys.byteorder[0].encode(),
+                                                         bool(rule_engine.holds), len(words), len(rules) // 4,
+                                                         len(column_table) // 7, len(tokens), len(length_table)))
+            offsets.tofile(matrix_file)
+            matrix_file.write(blob + b'\0' * (-len(blob) % 4))
+            for table in (rules, column_table, tokens, positions, length_table):
+                table.tofile(matrix_file)
+        os.replace(temp_file_name, file_name)
+        return len(rules) // 4
+
+
+# Finds a cheaper order for the rules of an existing matrix. The sorter tests rules top down until one fires, so an
+# item's cost is the number of rules evaluated, and a matrix's cost is the average over the items it actually sees.
+# is_check_rule_order() only looks at how specific each rule is; this weighs each rule by how many items it catches,
+# taken from an item file or from location and item type counts.
+# Two rules may only change places if no item could fire both and land in different bins, so the bin of every item
+# stays the same. Rules for the same bin can always be swapped. Alert rules keep their place relative to every
+# other rule, as the sorter tests them in matrix order. Items with '*' in a column, like counts without call numbers, pass any
+# rule there, so overlap in that column is assumed.
+# The search places, top down, the rule that catches the most items not already caught by the rules above it, among
+# the rules whose required predecessors are placed, then swaps neighbouring rules while that lowers the cost.
+# param:  rule_engine RuleEngine with the matrix loaded.
+class RuleOrderOptimizer:
+    def __init__(self, rule_engine):
+        self.rule_engine = rule_engine
+        # Item routing columns, without the item id, to the number of items that have them.
+        self.frequencies = {}
+        self.star_columns = set()
+        self.item_count = 0
+
+    # Adds items to the frequencies.
+    # param:  item_columns list of the item's columns, including the item id.
+    # param:  count number of items with these columns.
+    def add_item(self, item_columns, count=1):
+        key = tuple(item_columns[1:])
+        self.frequencies[key] = self.frequencies.get(key, 0) + count
+        self.item_count += count
+        for i in range(len(key)):
+            if key[i] == '*':
+                self.star_columns.add(i + 1)
+
+    # Reads item frequencies from an item file, see ItemReader.
+    # param:  file_name name of the item file.
+    # param:  file_format one of 'pipe', 'csv' or 'tsv'.
+    def read_items(self, file_name, file_format='pipe'):
+        for item_columns in ItemReader(self.rule_engine, file_format).read(file_name):
+            self.add_item(item_columns)
+
+    # Reads item frequencies from a ProfileStore. Profiles don't have libraries, so that column is '*', and items
+    # are tested with the call number class, as if call numbers were normalized.
+    # param:  store ProfileStore.
+    def read_profile(self, store):
+        for ((location, item_type, call_class), count) in store.counts.items():
+            item_columns = ['', location, '*', item_type, call_class]
+            if self.rule_engine.holds:
+                item_columns.extend(NO_HOLD)
+            self.add_item(item_columns, count)
+
+    # Reads item frequencies from location and item type counts, as 'location|item_type|count' or, straight from
+    # selitem -olt | pipe.pl -dc0,c1 -A -P, 'count|location|item_type'. Counts don't have call numbers or libraries
+    # so those columns are '*'.
+    # param:  file_name name of the counts file.
+    def read_counts(self, file_name):
+        with open(file_name, 'r') as counts_file:
+            for line in counts_file:
+                fields = [str.strip(field) for field in line.strip().rstrip('|').split('|')]
+                if len(fields) != 3:
+                    continue
+                if fields[0].isdigit():
+                    (count, location, item_type) = fields
+                elif fields[2].isdigit():
+                    (location, item_type, count) = fields
                 else:
-                    sys.stdout.write("\n")
-                rule_match = True
+                    continue
+                item_columns = ['', location, '*', item_type, '*']
+                if self.rule_engine.holds:
+                    item_columns.extend(NO_HOLD)
+                self.add_item(item_columns, int(count))
+
+    # Computes the rules that fire for each distinct item, by rule table index.
+    # return: list of (count, set of rule indexes).
+    def _fired_rules_(self):
+        compiled = {}
+        for (rule_index, rule_name, columns) in self.rule_engine.compiled_rules:
+            compiled[rule_index - 1] = columns
+        items = []
+        for (key, count) in self.frequencies.items():
+            item_columns = ('',) + key
+            fired = set()
+            for (index, columns) in compiled.items():
+                if match_compiled(columns, item_columns):
+                    fired.add(index)
+            items.append((count, fired))
+        return items
+
+    # Finds, for each rule, the rules above it that must stay above it.
+    # return: list of sets of rule table indexes.
+    def _predecessors_(self):
+        table = self.rule_engine.rule_table
+        by_index = {}
+        for (rule_index, rule_name, columns) in self.rule_engine.compiled_rules:
+            by_index[rule_index - 1] = dict([(column[0], column[1:]) for column in columns])
+        tested = set()
+        for columns in by_index.values():
+            tested.update(columns)
+        predecessors = [set() for rule in table]
+        for j in range(len(table)):
+            for i in range(j):
+                if table[i][1] in ('Y', 'N') or table[j][1] in ('Y', 'N'):
+                    predecessors[j].add(i)
+                elif i not in by_index or j not in by_index:
+                    continue # Rules with the wrong number of columns never fire.
+                elif bin_name(table[i][0]) == bin_name(table[j][0]):
+                    continue
+                elif not (by_index[i] and by_index[j]):
+                    continue # Rules of all '*'s never fire.
+                else:
+                    overlap = True
+                    for item_col in tested:
+                        if item_col in self.star_columns:
+                            continue
+                        if not columns_overlap(by_index[i].get(item_col), by_index[j].get(item_col)):
+                            overlap = False
+                            break
+                    if overlap:
+                        predecessors[j].add(i)
+        return predecessors
+
+    # Computes the cost of an order, as the total number of rules evaluated for all the items.
+    # param:  order list of rule table indexes, top down.
+    # param:  items list of (count, set of fired rule indexes) from _fired_rules_().
+    # return: the total cost.
+    @staticmethod
+    def cost(order, items):
+        position = {}
+        for i in range(len(order)):
+            position[order[i]] = i + 1
+        total = 0
+        for (count, fired) in items:
+            if fired:
+                total += count * min([position[index] for index in fired])
+            else:
+                total += count * len(order)
+        return total
+
+    # Searches for the cheapest order of the rules that sends every item to the same bin.
+    # param:  max_passes limit on the passes of neighbouring swaps.
+    # return: (order, cost_before, cost_after) with order a list of rule table indexes, and costs as the average number
+    #   of rules evaluated per item, or None if there are no item frequencies.
+    def optimize(self, max_passes=100):
+        if self.rule_engine.compiled_rules is None:
+            self.rule_engine.compile_rules()
+        if not self.item_count:
+            return None
+        table = self.rule_engine.rule_table
+        items = self._fired_rules_()
+        predecessors = self._predecessors_()
+        catches = [[] for rule in table]
+        for k in range(len(items)):
+            for index in items[k][1]:
+                catches[index].append(k)
+        gain = [0] * len(table)
+        for index in range(len(table)):
+            gain[index] = sum([items[k][0] for k in catches[index]])
+        # Greedy placement.
+        order = []
+        placed = set()
+        caught = [False] * len(items)
+        while len(order) < len(table):
+            best = None
+            for index in range(len(table)):
+                if index in placed or not predecessors[index] <= placed:
+                    continue
+                if best is None or gain[index] > gain[best]:
+                    best = index
+            order.append(best)
+            placed.add(best)
+            for k in catches[best]:
+                if not caught[k]:
+                    caught[k] = True
+                    for index in items[k][1]:
+                        gain[index] -= items[k][0]
+        # Swap neighbours while it helps. Items caught at position i that don't fire the rule below move down one,
+        # and items caught by the rule below move up one.
+        first = {}
+        for k in range(len(items)):
+            if items[k][1]:
+                first.setdefault(min([order.index(index) for index in items[k][1]]), []).append(k)
+        for p in range(max_passes):
+            improved = False
+            for i in range(len(order) - 1):
+                (above, below) = (order[i], order[i + 1])
+                if above in predecessors[below]:
+                    continue
+                moved_down = [k for k in first.get(i, []) if below not in items[k][1]]
+                moved_up = first.get(i + 1, [])
+                if sum([items[k][0] for k in moved_down]) < sum([items[k][0] for k in moved_up]):
+                    order[i] = below
+                    order[i + 1] = above
+                    first[i] = [k for k in first.get(i, []) if below in items[k][1]] + moved_up
+                    first[i + 1] = moved_down
+                    improved = True
+            if not improved:
                 break
-            rule_index += 1
-        if not rule_match:
-            sys.stdout.write("line --: {0}->bin E (R-) no rule matches.\n".format(item_columns[0]))
+        # Every item must still land in the same bin. The precedence rules guarantee it, this is a safety net.
+        original = list(range(len(table)))
+        for (count, fired) in items:
+            if fired:
+                before = min(fired)
+                after = min(fired, key=order.index)
+                if bin_name(table[before][0]) != bin_name(table[after][0]):
+                    sys.stderr.write('** error: reordering would move items from bin {0} to {1}, keeping the original order.\n'.format(
+                        bin_name(table[before][0]), bin_name(table[after][0])))
+                    order = original
+                    break
+        return (order, float(self.cost(original, items)) / self.item_count,
+                float(self.cost(order, items)) / self.item_count)
+
+    # Writes the rules, pipe-delimited, in a new order.
+    # param:  order list of rule table indexes, from optimize().
+    # param:  file_name name of the config file to write.
+    def write_config(self, order, file_name):
+        with open(file_name, 'w') as config_file:
+            for index in order:
+                config_file.write('|'.join(self.rule_engine.rule_table[index]) + '\n')
+
+    # Shows where each rule moved, and the cost of the matrix before and after.
+    # param:  result the (order, cost_before, cost_after) from optimize().
+    def report(self, result):
+        (order, before, after) = result
+        table = self.rule_engine.rule_table
+        for i in range(len(order)):
+            if order[i] != i:
+                sys.stdout.write('line #{0}:({1}) moves to line #{2}.\n'.format(order[i] + 1, table[order[i]][0], i + 1))
+        sys.stdout.write('rules evaluated per item: {0:.2f} before, {1:.2f} after, over {2} item(s).\n'.format(
+            before, after, self.item_count))
 
 
 def usage():
-    sys.stdout.write('usage: python sortemu.py [-i<items>] [-c[config.file] | -m<machine.epl.ca> -p<password>] -e.\n')
+    sys.stdout.write('usage: python sortemu.py [-i<items>] [-c[config.file] | -m<machine.epl.ca> -p<password>] [-q<reject.file>] [-r] [-s<snapshot.idx> [-b<items.dump>]] [-P<profile.db>] [-F<format>] [-W<items.col>] [-o<results> [-f<format>] [-z]] [-n] [-H<holds>] [-O<reordered.cfg> [-K<counts>]] [-M<matrix.mtx>] [-S<[host:]port>] [-w<item>] -e.\n')
     sys.stdout.write('  Written by Andrew Nisbet for Edmonton Public Library.\n')
     sys.stdout.write('  See the source header for licensing restrictions.\n')
     sys.stdout.write('  -i file of items in the following pipe-delimited format: \n'
@@ -779,6 +2398,35 @@ def usage():
     sys.stdout.write('  -m In lieu of a config file you can get the sort matrix remotely by specifying the base URL\n'
                      '     of the target sorter machine. Use in conjunction with -p.\n')
     sys.stdout.write('  -p Password for the target sorter. Use in conjunction with -m.\n')
+    sys.stdout.write('  -q Quarantine file. Item lines with the wrong number of columns are written here, prefixed\n'
+                     '     with a reason code, instead of stopping the run.\n')
+    sys.stdout.write('  -s Item snapshot index. Item lines that are just a barcode are resolved to routing columns from it.\n')
+    sys.stdout.write('  -b Build or refresh the -s index from a bulk item dump, then carry on. The dump is made with:\n'
+                     '     selitem -oNBlyt | selcallnum -iN -oSA >items.dump\n')
+    sys.stdout.write('  -P Profile store of item counts by location, item type and call number class. With -b it is\n'
+                     '     updated from the records the dump adds, changes or removes in the -s index. It is read in\n'
+                     '     place of loc.itype.db, and -K can name it for the counts.\n')
+    sys.stdout.write('  -F Format of the -i file: pipe (default), csv, tsv or columnar. CSV and TSV files have the same\n'
+                     '     5 columns as pipe-delimited files.\n')
+    sys.stdout.write('  -W Write the -i items to a columnar file that can be routed later with -Fcolumnar, then carry on.\n')
+    sys.stdout.write('  -o Write route results to this file instead of stdout.\n')
+    sys.stdout.write('  -f Format of route results: text (default), jsonl, csv or tsv.\n')
+    sys.stdout.write('  -z Gzip the -o file. Names ending in .gz are always compressed.\n')
+    sys.stdout.write('  -H Holds snapshot of \'item_id|alert_type\' lines. Items are joined to their hold state and the\n'
+                     '     alert rules are tested in matrix order, as on the sorter, instead of being skipped.\n')
+    sys.stdout.write('  -n Normalize call numbers as items are read, so \'DAISY J 364.1523  DON HEN\' is tested as\n'
+                     '     \'364.1523 DON HEN\'.\n')
+    sys.stdout.write('  -O Write the matrix, reordered so fewer rules are evaluated per item, to this file. Rules are\n'
+                     '     weighed by the -i items, or -K counts. Every item still goes to the same bin.\n')
+    sys.stdout.write('  -K Counts of items by location and item type, as \'location|item_type|count\', or a -P profile\n'
+                     '     store, for -O.\n')
+    sys.stdout.write('  -M Write the compiled matrix to this file, for routing worker processes to map read-only, see\n'
+                     '     CompiledMatrix. With -H the alert rules are compiled in.\n')
+    sys.stdout.write('  -S Serve routes on this [host:]port until stopped. Each item line, or barcode with -s, sent\n'
+                     '     is answered with a JSON line like the -fjsonl results. See sortload.py.\n')
+    sys.stdout.write('  -w Show where one item line, or barcode with -s, goes and, for each rule above it, the first\n'
+                     '     column that failed and the rule\'s nearest token to the item\'s value.\n')
+    sys.stdout.write('  -r Repair item lines whose call number contains \'|\' sub fields by joining them into one column.\n')
     sys.stdout.write('  Version: {0} Copyright (c) 2017.\n'.format(version))
 
 
@@ -788,9 +2436,30 @@ def main(argv):
     items_file = ''
     machine = ''
     password = ''
+    quarantine_file = ''
+    repair = False
+    snapshot_file = ''
+    dump_file = ''
+    item_format = 'pipe'
+    columnar_file = ''
+    output_file = ''
+    output_format = 'text'
+    compress = False
+    normalize = False
+    holds_file = ''
+    optimized_file = ''
+    counts_file = ''
+    profile_file = ''
+    compiled_file = ''
+    serve_address = ''
+    why_not_item = ''
     explain = False
     try:
-        opts, args = getopt.getopt(argv, "c:ei:m:p:", ["config=", "items=", "machine="])
+        opts, args = getopt.getopt(argv, "b:c:eF:f:H:i:K:M:m:nO:o:P:p:q:rS:s:W:w:z", ["build=", "compiled=", "config=", "counts=", "format=",
+                                                                         "items=", "holds=", "machine=", "optimize=",
+                                                                         "output=", "output_format=", "profile=",
+                                                                         "quarantine=", "serve=", "snapshot=", "why_not=",
+                                                                         "write_columnar="])
     except getopt.GetoptError:
         usage()
         sys.exit()
@@ -811,19 +2480,116 @@ def main(argv):
             this_arg = arg.replace("'", '')
             this_arg = this_arg.replace('"', '')
             password = this_arg
+        elif opt in ("-q", "--quarantine"):
+            assert isinstance(arg, str)
+            quarantine_file = arg
+        elif opt in "-r":
+            repair = True
+        elif opt in ("-s", "--snapshot"):
+            assert isinstance(arg, str)
+            snapshot_file = arg
+        elif opt in ("-b", "--build"):
+            assert isinstance(arg, str)
+            dump_file = arg
+        elif opt in ("-F", "--format"):
+            assert isinstance(arg, str)
+            if arg not in ITEM_FORMATS:
+                sys.stderr.write("** error: item format must be one of {0}.\n".format(', '.join(ITEM_FORMATS)))
+                sys.exit(-1)
+            item_format = arg
+        elif opt in ("-W", "--write_columnar"):
+            assert isinstance(arg, str)
+            columnar_file = arg
+        elif opt in ("-o", "--output"):
+            assert isinstance(arg, str)
+            output_file = arg
+        elif opt in ("-f", "--output_format"):
+            assert isinstance(arg, str)
+            if arg not in SINK_FORMATS:
+                sys.stderr.write("** error: output format must be one of {0}.\n".format(', '.join(SINK_FORMATS)))
+                sys.exit(-1)
+            output_format = arg
+        elif opt in "-z":
+            compress = True
+        elif opt in "-n":
+            normalize = True
+        elif opt in ("-H", "--holds"):
+            assert isinstance(arg, str)
+            holds_file = arg
+        elif opt in ("-O", "--optimize"):
+            assert isinstance(arg, str)
+            optimized_file = arg
+        elif opt in ("-K", "--counts"):
+            assert isinstance(arg, str)
+            counts_file = arg
+        elif opt in ("-P", "--profile"):
+            assert isinstance(arg, str)
+            profile_file = arg
+        elif opt in ("-M", "--compiled"):
+            assert isinstance(arg, str)
+            compiled_file = arg
+        elif opt in ("-S", "--serve"):
+            assert isinstance(arg, str)
+            serve_address = arg
+        elif opt in ("-w", "--why_not"):
+            assert isinstance(arg, str)
+            why_not_item = arg
         elif opt in "-e":
             explain = True
 
+    if dump_file:
+        if not snapshot_file:
+            sys.stderr.write("** error: use -s to name the snapshot index to build from {0}.\n".format(dump_file))
+            sys.exit(-1)
+        if not os.path.isfile(dump_file):
+            sys.stderr.write("** error: item dump file {0} does not exist.\n".format(dump_file))
+            sys.exit(-1)
+        profile = None
+        changes = None
+        if profile_file:
+            profile = ProfileStore(profile_file)
+            changes = profile.apply
+            if not os.path.isfile(profile_file) and os.path.isfile(snapshot_file):
+                # Start from the records the snapshot already has, then apply the dump's changes.
+                snapshot = ItemSnapshot(snapshot_file)
+                profile.add_snapshot(snapshot)
+                snapshot.close()
+        counts = ItemSnapshot.build(dump_file, snapshot_file, changes)
+        sys.stdout.write('snapshot "{0}": {1} added, {2} changed, {3} removed, {4} unchanged.\n'.format(
+            snapshot_file, counts['added'], counts['changed'], counts['removed'], counts['unchanged']))
+        if profile:
+            if counts['added'] + counts['changed'] + counts['removed'] or not os.path.isfile(profile_file):
+                profile.save()
+            sys.stdout.write('profiles "{0}": {1} profiles of {2} items.\n'.format(profile_file, *profile.totals()))
+        if not config_file and not machine:
+            sys.exit(0)
+    if columnar_file:
+        if not items_file or item_format == 'columnar':
+            sys.stderr.write("** error: -W needs a pipe, csv or tsv item file specified with -i.\n")
+            sys.exit(-1)
+        converter = RuleEngine()
+        if snapshot_file:
+            converter.snapshot = ItemSnapshot(snapshot_file)
+        converter.quarantine = ItemQuarantine(quarantine_file, repair)
+        count = ColumnarItems.write(ItemReader(converter, item_format, True).read(items_file), columnar_file)
+        sys.stdout.write('wrote {0} item(s) to columnar file "{1}".\n'.format(count, columnar_file))
+        converter.quarantine.close()
+        converter.quarantine.report()
+        if not config_file and not machine:
+            sys.exit(0)
     rule_engine = RuleEngine()
+    rule_engine.normalize_call_numbers = normalize
+    if profile_file:
+        if not ProfileStore.is_store(profile_file):
+            sys.stderr.write("** error: {0} is not a profile store.\n".format(profile_file))
+            sys.exit(-1)
+        rule_engine.location_itype_db = profile_file
     if config_file:
         sys.stdout.write('configuration file is "{0}"\n'.format(config_file))
         if not os.path.isfile(config_file):
             sys.stderr.write("** error: configuration file {0} does not exist.\n".format(config_file))
             sys.exit(-1)
-        c_file = open(config_file, 'r')
-        for line in c_file:
-            rule_engine.load_rule(line)
-        c_file.close()
+        rule_engine.load_config(config_file)
     else: # Screen scrape it.
         if len(machine) > 0:
             if len(password) > 0:
@@ -841,16 +2607,106 @@ def main(argv):
     # rule_engine.check_rules(explain)
     rule_engine.test_rules(explain)
 
+    # Items routed here, served or compiled for workers are joined to their hold state.
+    if holds_file and (items_file or compiled_file or serve_address or why_not_item):
+        if not os.path.isfile(holds_file):
+            sys.stderr.write("** error: holds snapshot {0} does not exist.\n".format(holds_file))
+            sys.exit(-1)
+        rule_engine.holds = HoldSnapshot(holds_file)
+        rule_engine.compiled_rules = None
+    # Explain where one item goes, if asked.
+    if why_not_item:
+        if snapshot_file:
+            if not os.path.isfile(snapshot_file):
+                sys.stderr.write("** error: item snapshot {0} does not exist.\n".format(snapshot_file))
+                sys.exit(-1)
+            rule_engine.snapshot = ItemSnapshot(snapshot_file)
+        rule_engine.quarantine = ItemQuarantine(repair=repair)
+        item_columns = rule_engine.parse_item(why_not_item)
+        if item_columns is None:
+            sys.stderr.write("** error: can't route {0}: {1}.\n".format(
+                why_not_item, QUARANTINE_REASONS[rule_engine.quarantine.last_reason]))
+            sys.exit(-1)
+        rule_engine.report_why_not(item_columns[0], *rule_engine.why_not(item_columns))
     # Test the items file if user wants to check files.
     if items_file:
         sys.stdout.write('running file "{0}"\n'.format(items_file))
         if items_file and not os.path.isfile(items_file):
             sys.stderr.write("** error: item(s) file {0} does not exist.\n".format(items_file))
             sys.exit()
-        i_file = open(items_file, 'r')
-        for item in i_file:
-            rule_engine.test_item(item, explain)
-        i_file.close()
+        rule_engine.quarantine = ItemQuarantine(quarantine_file, repair)
+        # Trace output from -e is written as it happens, so results have to be written straight away too.
+        rule_engine.sink = RouteSink(output_file, output_format, compress, 1 if explain else 1000)
+        if snapshot_file:
+            if not os.path.isfile(snapshot_file):
+                sys.stderr.write("** error: item snapshot {0} does not exist.\n".format(snapshot_file))
+                sys.exit(-1)
+            rule_engine.snapshot = ItemSnapshot(snapshot_file)
+        if item_format == 'columnar':
+            columnar_items = ColumnarItems(items_file)
+            for (item_id, result) in columnar_items.route_all(rule_engine):
+                rule_engine.report_route(item_id, result)
+            columnar_items.close()
+        elif explain:
+            reader = ItemReader(rule_engine, item_format, True)
+            for item_columns in reader.read(items_file):
+                rule_engine.report_route(item_columns[0], rule_engine.trace_item(item_columns), explain)
+        else:
+            reader = ItemReader(rule_engine, item_format)
+            for item_columns in reader.read(items_file):
+                rule_engine.report_route(item_columns[0], rule_engine.route(item_columns))
+        rule_engine.quarantine.close()
+        rule_engine.report_items()
+    # Write the compiled matrix for worker processes, if asked.
+    if compiled_file:
+        count = CompiledMatrix.write(rule_engine, compiled_file)
+        sys.stdout.write('wrote {0} compiled rule(s) to "{1}".\n'.format(count, compiled_file))
+    # Answer route requests until stopped, if asked.
+    if serve_address:
+        (host, separator, port) = serve_address.rpartition(':')
+        if not port.isdigit():
+            sys.stderr.write("** error: -S expects [host:]port, not {0}.\n".format(serve_address))
+            sys.exit(-1)
+        rule_engine.quarantine = ItemQuarantine(quarantine_file, repair)
+        if snapshot_file and not rule_engine.snapshot:
+            if not os.path.isfile(snapshot_file):
+                sys.stderr.write("** error: item snapshot {0} does not exist.\n".format(snapshot_file))
+                sys.exit(-1)
+            rule_engine.snapshot = ItemSnapshot(snapshot_file)
+        server = RouteServer(rule_engine)
+        try:
+            asyncio.run(server.serve(host, int(port)))
+        except KeyboardInterrupt:
+            pass
+        rule_engine.quarantine.close()
+        server.report()
+        rule_engine.quarantine.report()
+    # Reorder the matrix for the items it sees, if asked.
+    if optimized_file:
+        optimizer = RuleOrderOptimizer(rule_engine)
+        if counts_file:
+            if not os.path.isfile(counts_file):
+                sys.stderr.write("** error: counts file {0} does not exist.\n".format(counts_file))
+                sys.exit(-1)
+            if ProfileStore.is_store(counts_file):
+                optimizer.read_profile(ProfileStore(counts_file))
+            else:
+                optimizer.read_counts(counts_file)
+        elif items_file and item_format != 'columnar':
+            # The items were counted once already.
+            rule_engine.quarantine = ItemQuarantine(repair=repair)
+            rule_engine.values = ValuePool.from_reference_tables(rule_engine.locations, rule_engine.itypes)
+            optimizer.read_items(items_file, item_format)
+        else:
+            sys.stderr.write("** error: -O needs a pipe, csv or tsv item file specified with -i, or counts with -K.\n")
+            sys.exit(-1)
+        result = optimizer.optimize()
+        if result is None:
+            sys.stderr.write("** error: no items to weigh the rules with.\n")
+            sys.exit(-1)
+        optimizer.report(result)
+        optimizer.write_config(result[0], optimized_file)
+        sys.stdout.write('wrote reordered matrix to "{0}".\n'.format(optimized_file))
     # Done.
     sys.exit(0)
 
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+####################################################
+#
+# Python source for project sorteremu_py
+#
+# Differential testing of sortemu routing engines against the reference is_rule_match().
+#    Copyright (C) 2026  Edmonton Public Library
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+#
+# Generates random sort matrices and item streams from the location and item type vocabularies, routes the items
+# with each candidate engine and with RuleEngine.trace_item(), which tests every rule with is_rule_match(), and
+# reports any item the two send somewhere different. Each disagreement is shrunk to the fewest rules, tokens and item
+# values that still show it.
+# The matrices cover the quirks of the reference: first match wins, '*' item values pass any rule column, tokens
+# ending in '*' match prefixes, tokens after a '*' are never reached, spaces after commas, rules that fire on no
+# token, and alert rules that are skipped, or tested in matrix order when there are holds.
+#
+# Typical use:
+#   python sortfuzz.py --matrices 100 --items 10000 --seed 42
+#   python sortfuzz.py --engines route,columnar --holds 0.5
+#
+####################################################
+import sys
+import os
+import io
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+import sortemu
+
+# Libraries items come from, since there is no reference table for them.
+LIBRARIES = ['EPLMNA', 'EPLCLV', 'EPLSTR', 'EPLLHL', 'EPLJPL', 'EPLWMC']
+# Alert types of holds, see HoldSnapshot.
+ALERT_TYPES = ['01', '02', '03']
+# Rule columns a matrix fills in, and the item column each is tested against. The rest are always '*'.
+FUZZ_COLUMNS = {5: 1, 6: 2, 7: 3, 8: 4}
+# Candidate engines by name, to (function, compare). The function takes a RuleEngine and a list of items of 5
+# columns and returns the route() style result of each item. compare is 'exact' if the line, rule and matching tokens
+# must agree with the reference, or 'bin' if only the bin must.
+ENGINES = {}
+
+
+# Adds a candidate engine to the harness.
+# param:  name of the engine, for --engines.
+# param:  function(rule_engine, items) returning a list of results, one per item.
+# param:  compare 'exact' or 'bin'.
+def register_engine(name, function, compare='exact'):
+    ENGINES[name] = (function, compare)
+
+
+# Adds the hold state to a copy of an item, as RuleEngine.parse_item() does.
+# param:  rule_engine RuleEngine.
+# param:  item_columns list of the item's 5 columns.
+# return: new list of the item's columns.
+def joined(rule_engine, item_columns):
+    item_columns = list(item_columns)
+    if rule_engine.holds:
+        rule_engine.holds.join(item_columns)
+    return item_columns
+
+
+# The reference: every rule tested in turn with is_rule_match(). Distinct items are only routed once.
+def reference_engine(rule_engine, items):
+    routes = {}
+    results = []
+    for item_columns in items:
+        item_columns = joined(rule_engine, item_columns)
+        key = tuple(item_columns[1:])
+        if key not in routes:
+            routes[key] = rule_engine.trace_item(item_columns, False)
+        results.append(routes[key])
+    return results
+
+
+def route_engine(rule_engine, items):
+    return [rule_engine.route(joined(rule_engine, item_columns)) for item_columns in items]
+
+
+def columnar_engine(rule_engine, items):
+    (handle, file_name) = tempfile.mkstemp(suffix='.col')
+    os.close(handle)
+    try:
+        sortemu.ColumnarItems.write(items, file_name)
+        columnar_items = sortemu.ColumnarItems(file_name)
+        results = [result for (item_id, result) in columnar_items.route_all(rule_engine)]
+        columnar_items.close()
+    finally:
+        os.remove(file_name)
+    return results
+
+
+# Routes with the matrix reordered by RuleOrderOptimizer for these very items, which must not change any bin.
+def reordered_engine(rule_engine, items):
+    optimizer = sortemu.RuleOrderOptimizer(rule_engine)
+    for item_columns in items:
+        optimizer.add_item(joined(rule_engine, item_columns))
+    with contextlib.redirect_stderr(io.StringIO()):
+        result = optimizer.optimize()
+    if result is None:
+        return route_engine(rule_engine, items)
+    reordered = sortemu.RuleEngine()
+    reordered.holds = rule_engine.holds
+    for index in result[0]:
+        reordered.load_rule('|'.join(rule_engine.rule_table[index]))
+    return route_engine(reordered, items)
+
+
+# Routes with the compiled matrix written to a file and mapped back, as worker processes would.
+def compiled_engine(rule_engine, items):
+    (handle, file_name) = tempfile.mkstemp(suffix='.mtx')
+    os.close(handle)
+    try:
+        sortemu.CompiledMatrix.write(rule_engine, file_name)
+        matrix = sortemu.CompiledMatrix(file_name)
+        results = [matrix.route(joined(rule_engine, item_columns)) for item_columns in items]
+        matrix.close()
+    finally:
+        os.remove(file_name)
+    return results
+
+
+register_engine('route', route_engine)
+register_engine('columnar', columnar_engine)
+register_engine('reordered', reordered_engine, 'bin')
+register_engine('compiled', compiled_engine)
+
+
+# Makes random matrices, items and holds from the location and item type vocabularies.
+# param:  seed for the random generator.
+# param:  locations list of location names.
+# param:  itypes list of item type names.
+class FuzzGenerator:
+    def __init__(self, seed, locations, itypes):
+        self.random = random.Random(seed)
+        self.vocabularies = {1: list(locations), 2: LIBRARIES, 3: list(itypes), 4: []}
+
+    # Starts a new matrix, with its own small set of call numbers so items share them.
+    def _call_numbers_(self):
+        call_numbers = []
+        for i in range(40):
+            kind = self.random.random()
+            if kind < 0.6:
+                call_numbers.append('{0:03d}.{1}'.format(self.random.randrange(1000), self.random.randrange(100)))
+            elif kind < 0.8:
+                call_numbers.append(self.random.choice(['FIC', 'E PIC', 'DVD', 'J FIC', 'PBK']) + ' ' +
+                                    self.random.choice(['SMI', 'DON HEN', 'ABC', 'Z']))
+            elif kind < 0.9:
+                call_numbers.append('J ' + '{0:03d}'.format(self.random.randrange(1000)))
+            else:
+                call_numbers.append(str(self.random.randrange(10)))
+        self.vocabularies[4] = call_numbers
+
+    # Makes a token for a rule column: a value, a prefix of a value with a trailing '*', or rarely something odd.
+    def _token_(self, item_col):
+        value = self.random.choice(self.vocabularies[item_col])
+        kind = self.random.random()
+        if kind < 0.55:
+            return value
+        if kind < 0.9:
+            return value[:self.random.randint(0, max(0, len(value) - 1))] + '*'
+        if kind < 0.95:
+            return '*'
+        return value + '*'
+
+    # Makes a rule column, '*' or a comma separated list of tokens.
+    def _column_(self, item_col):
+        if self.random.random() < 0.55:
+            return '*'
+        tokens = [self._token_(item_col) for i in range(self.random.randint(1, 5))]
+        separator = ', ' if self.random.random() < 0.2 else ','
+        return separator.join(tokens)
+
+    # Makes a matrix.
+    # param:  max_rules most rules in the matrix.
+    # return: list of pipe-delimited rule lines.
+    def matrix(self, max_rules=20):
+        self._call_numbers_()
+        lines = []
+        for i in range(self.random.randint(1, max_rules)):
+            columns = ['*'] * len(sortemu.CONFIG_COL_ORDER)
+            if self.random.random() < 0.1:
+                columns[0] = 'REJECT'
+                columns[1] = self.random.choice(['Y', 'N'])
+                columns[2] = self.random.choice(ALERT_TYPES + ['*', '01,02'])
+            else:
+                columns[0] = 'R{0}'.format(self.random.randint(1, 12))
+            for (rule_col, item_col) in FUZZ_COLUMNS.items():
+                columns[rule_col] = self._column_(item_col)
+            lines.append('|'.join(columns))
+        return lines
+
+    # Makes an item value, mostly from the vocabulary, sometimes '*', empty, unknown or a token-like value.
+    def _value_(self, item_col):
+        kind = self.random.random()
+        if kind < 0.9:
+            return self.random.choice(self.vocabularies[item_col])
+        if kind < 0.94:
+            return '*'
+        if kind < 0.96:
+            return ''
+        if kind < 0.98:
+            return 'XX' + str(self.random.randrange(10))
+        return self.random.choice(self.vocabularies[item_col])[:3] + '*'
+
+    # Makes items for the current matrix.
+    # param:  count number of items.
+    # return: list of lists of the item's 5 columns.
+    def items(self, count):
+        items = []
+        for i in range(count):
+            items.append(['3122{0:010d}'.format(i)] + [self._value_(item_col) for item_col in range(1, 5)])
+        return items
+
+    # Makes holds for some of the items.
+    # param:  items list from items().
+    # return: dictionary of item id to (alert, alert_type).
+    def holds(self, items):
+        holds = {}
+        for item_columns in items:
+            if self.random.random() < 0.2:
+                holds[item_columns[0]] = (self.random.choice(['Y', 'N']), self.random.choice(ALERT_TYPES))
+        return holds
+
+
+# Builds an engine for a matrix.
+# param:  lines list of pipe-delimited rule lines.
+# param:  holds dictionary of item id to (alert, alert_type), or None to route without holds.
+# return: RuleEngine.
+def new_engine(lines, holds=None):
+    rule_engine = sortemu.RuleEngine()
+    for line in lines:
+        rule_engine.load_rule(line)
+    if holds is not None:
+        (handle, file_name) = tempfile.mkstemp(suffix='.holds')
+        with os.fdopen(handle, 'w') as holds_file:
+            for (item_id, (alert, alert_type)) in holds.items():
+                holds_file.write('{0}|{1}|{2}\n'.format(item_id, alert, alert_type))
+        rule_engine.holds = sortemu.HoldSnapshot(file_name)
+        os.remove(file_name)
+    return rule_engine
+
+
+# Reduces a result to what an engine must agree with the reference on.
+# param:  result from route() or trace_item().
+# param:  compare 'exact' or 'bin'.
+# return: comparable value.
+def outcome(result, compare):
+    if not result:
+        return 'E'
+    if compare == 'bin':
+        return sortemu.bin_name(result[1])
+    return result[0], result[1], tuple(result[2])
+
+
+# Tests if an engine disagrees with the reference on one item.
+# param:  engine_name name from ENGINES.
+# param:  lines list of rule lines.
+# param:  item_columns list of the item's 5 columns.
+# param:  holds dictionary of holds, or None.
+# return: (expected, actual) if they disagree, or None.
+def disagreement(engine_name, lines, item_columns, holds):
+    (function, compare) = ENGINES[engine_name]
+    try:
+        expected = outcome(reference_engine(new_engine(lines, holds), [item_columns])[0], compare)
+        actual = outcome(function(new_engine(lines, holds), [item_columns])[0], compare)
+    except Exception as e:
+        return 'no error', '{0}: {1}'.format(type(e).__name__, e)
+    if expected != actual:
+        return expected, actual
+    return None
+
+
+# Shrinks a disagreement: drops rules, blanks columns, drops tokens and blanks item values for as long as the
+# engine still disagrees with the reference.
+# param:  engine_name name from ENGINES.
+# param:  lines list of rule lines.
+# param:  item_columns list of the item's 5 columns.
+# param:  holds dictionary of holds, or None.
+# return: (lines, item_columns, holds) of the smallest case found.
+def minimize(engine_name, lines, item_columns, holds):
+    def fails(candidate_lines, candidate_item, candidate_holds):
+        return disagreement(engine_name, candidate_lines, candidate_item, candidate_holds) is not None
+
+    lines = list(lines)
+    item_columns = list(item_columns)
+    if holds is not None:
+        holds = dict([(item_columns[0], holds[item_columns[0]])]) if item_columns[0] in holds else {}
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(lines) - 1, -1, -1):
+            candidate = lines[:i] + lines[i + 1:]
+            if candidate and fails(candidate, item_columns, holds):
+                lines = candidate
+                changed = True
+        for i in range(len(lines)):
+            columns = lines[i].split('|')
+            for col in range(1, len(columns)):
+                if columns[col] == '*':
+                    continue
+                tokens = columns[col].split(',')
+                options = ['*'] + [','.join(tokens[:t] + tokens[t + 1:]) for t in range(len(tokens)) if len(tokens) > 1]
+                for option in options:
+                    candidate_columns = list(columns)
+                    candidate_columns[col] = option
+                    candidate = lines[:i] + ['|'.join(candidate_columns)] + lines[i + 1:]
+                    if fails(candidate, item_columns, holds):
+                        lines = candidate
+                        columns = candidate_columns
+                        changed = True
+                        break
+        for col in range(1, len(item_columns)):
+            if item_columns[col] != '*':
+                candidate = list(item_columns)
+                candidate[col] = '*'
+                if fails(lines, candidate, holds):
+                    item_columns = candidate
+                    changed = True
+        if holds and fails(lines, item_columns, {}):
+            holds = {}
+            changed = True
+    return lines, item_columns, holds
+
+
+# Runs matrices and items through the engines and collects the disagreements.
+# param:  generator FuzzGenerator.
+# param:  engine_names list of names from ENGINES.
+# param:  matrices number of matrices to make.
+# param:  items_per_matrix number of items routed through each matrix.
+# param:  holds_chance chance of routing a matrix with holds.
+# param:  max_rules most rules in a matrix.
+# param:  max_failures stop after this many disagreements.
+# return: (items_routed, seconds by engine name, list of (engine_name, lines, item_columns, holds, expected, actual)).
+def fuzz(generator, engine_names, matrices=100, items_per_matrix=10000, holds_chance=0.3, max_rules=20, max_failures=5):
+    failures = []
+    seconds = dict([(name, 0.0) for name in ['reference'] + engine_names])
+    routed = 0
+    for m in range(matrices):
+        lines = generator.matrix(max_rules)
+        items = generator.items(items_per_matrix)
+        holds = generator.holds(items) if generator.random.random() < holds_chance else None
+        start = time.time()
+        expected = reference_engine(new_engine(lines, holds), items)
+        seconds['reference'] += time.time() - start
+        routed += len(items)
+        for name in engine_names:
+            (function, compare) = ENGINES[name]
+            start = time.time()
+            actual = function(new_engine(lines, holds), items)
+            seconds[name] += time.time() - start
+            for i in range(len(items)):
+                if outcome(expected[i], compare) != outcome(actual[i], compare):
+                    (small_lines, small_item, small_holds) = minimize(name, lines, items[i], holds)
+                    (small_expected, small_actual) = disagreement(name, small_lines, small_item, small_holds)
+                    failures.append((name, small_lines, small_item, small_holds, small_expected, small_actual))
+                    break
+            if len(failures) >= max_failures:
+                return routed, seconds, failures
+    return routed, seconds, failures
+
+
+# Writes the counterexamples and the time each engine took.
+def report(routed, seconds, failures):
+    for (name, lines, item_columns, holds, expected, actual) in failures:
+        sys.stdout.write('** {0} disagrees with the reference:\n'.format(name))
+        for line in lines:
+            sys.stdout.write('  rule:  {0}\n'.format(line))
+        sys.stdout.write('  item:  {0}|\n'.format('|'.join(item_columns)))
+        if holds is not None:
+            sys.stdout.write('  holds: {0}\n'.format(holds))
+        sys.stdout.write('  expected {0}, got {1}.\n'.format(expected, actual))
+    for name in sorted(seconds):
+        rate = routed / seconds[name] if seconds[name] else 0.0
+        sys.stdout.write('{0}: {1} item(s) in {2:.2f}s, {3:.0f} item(s) per second.\n'.format(
+            name, routed, seconds[name], rate))
+    sys.stdout.write('{0} disagreement(s).\n'.format(len(failures)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tests routing engines against the reference is_rule_match().")
+    parser.add_argument("--engines", default=','.join(sorted(ENGINES)), action="store", type=str, required=False,
+                        help="Comma separated engines to test. Default all of {0}.".format(', '.join(sorted(ENGINES))))
+    parser.add_argument("--matrices", default=100, action="store", type=int, required=False,
+                        help="Number of random matrices. Default 100.")
+    parser.add_argument("--items", default=10000, action="store", type=int, required=False,
+                        help="Items routed through each matrix. Default 10000.")
+    parser.add_argument("--rules", default=20, action="store", type=int, required=False,
+                        help="Most rules in a matrix. Default 20.")
+    parser.add_argument("--holds", default=0.3, action="store", type=float, required=False,
+                        help="Chance a matrix is routed with holds. Default 0.3.")
+    parser.add_argument("--seed", default=0, action="store", type=int, required=False,
+                        help="Random seed, so failures can be repeated. Default 0.")
+    parser.add_argument("--max_failures", default=5, action="store", type=int, required=False,
+                        help="Stop after this many disagreements. Default 5.")
+    args = parser.parse_args()
+
+    engine_names = [name.strip() for name in args.engines.split(',') if name.strip()]
+    for name in engine_names:
+        if name not in ENGINES:
+            sys.stderr.write("** error: unknown engine {0}, expected one of {1}.\n".format(name, ', '.join(sorted(ENGINES))))
+            sys.exit(-1)
+    # The reference tables announce themselves as they load.
+    with contextlib.redirect_stdout(io.StringIO()):
+        locations = sorted(sortemu.Location().locations)
+        itypes = sorted(sortemu.Itype().types)
+    fuzz_generator = FuzzGenerator(args.seed, locations, itypes)
+    (items_routed, engine_seconds, disagreements) = fuzz(fuzz_generator, engine_names, args.matrices, args.items,
+                                                         args.holds, args.rules, args.max_failures)
+    report(items_routed, engine_seconds, disagreements)
+    sys.exit(1 if disagreements else 0)
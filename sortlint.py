@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+####################################################
+#
+# Python source for project sorteremu_py
+#
+# Checks a directory of 3M sort matrices in one run.
+#    Copyright (C) 2026  Edmonton Public Library
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+#
+# Runs the checks of sortemu.py -c (bins, duplicates, rule order, locations and item types) over every .cfg and .xml
+# matrix in a directory. The reference tables location.db, type.db and loc.itype.db are read once, from the current
+# directory as sortemu.py does, and handed to a pool of worker processes that check the matrices in parallel. The
+# output of each check is captured rather than interleaved, and the results are written as one report, with the
+# checks that failed and the time taken for each file.
+#
+# Typical use:
+#   python sortlint.py matrices/ --jobs 4 --json lint.json
+#
+####################################################
+import sys
+import os
+import io
+import time
+import json
+import argparse
+import contextlib
+import concurrent.futures
+import sortemu
+
+# File name extensions of matrices to check.
+CONFIG_EXTENSIONS = ('.cfg', '.xml')
+# Reference tables shared by the checks in a worker process, see share_reference_tables().
+reference_tables = {}
+
+
+# Reads the reference tables once, for all the matrices.
+# return: dictionary with the Location, Itype and location item type map under 'locations', 'itypes' and
+#   'location_itypes'.
+def load_reference_tables():
+    tables = {}
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        tables['locations'] = sortemu.Location()
+        tables['itypes'] = sortemu.Itype()
+        rule_engine = sortemu.RuleEngine()
+        rule_engine.get_master_rule_map(rule_engine.location_itype_db)
+        tables['location_itypes'] = rule_engine.valid_location_itypes
+    return tables
+
+
+# Makes the reference tables available to lint_config() in this process. Used as the pool's initializer.
+# param:  tables dictionary from load_reference_tables().
+def share_reference_tables(tables):
+    reference_tables.update(tables)
+
+
+# Finds the matrices in a directory.
+# param:  directory name of the directory.
+# return: sorted list of file names.
+def find_configs(directory):
+    configs = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.path.splitext(name)[1].lower() in CONFIG_EXTENSIONS:
+            configs.append(path)
+    return configs
+
+
+# Runs the checks on one matrix.
+# param:  config_file name of the matrix.
+# return: dictionary with the file, whether it passed, the result of each check, the number of rules, the seconds
+#   taken, the captured output of the checks and any error that stopped them.
+def lint_config(config_file):
+    result = {'file': config_file, 'passed': False, 'checks': {}, 'rules': 0, 'seconds': 0.0, 'output': '',
+              'error': ''}
+    start = time.time()
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            rule_engine = sortemu.RuleEngine()
+            rule_engine.locations = reference_tables.get('locations')
+            rule_engine.itypes = reference_tables.get('itypes')
+            rule_engine.valid_location_itypes = reference_tables.get('location_itypes', {})
+            rule_engine.load_config(config_file)
+            result['rules'] = len(rule_engine.rule_table)
+            result['checks'] = rule_engine.test_rules()
+        result['passed'] = result['rules'] > 0 and all(result['checks'].values())
+        if not result['rules']:
+            result['error'] = 'no rules'
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    result['output'] = output.getvalue()
+    result['seconds'] = time.time() - start
+    return result
+
+
+# Checks matrices, in parallel if there is more than one job.
+# param:  configs list of matrix file names.
+# param:  jobs number of worker processes.
+# return: list of results from lint_config(), in the order of configs.
+def lint_configs(configs, jobs=1):
+    tables = load_reference_tables()
+    if jobs <= 1 or len(configs) <= 1:
+        share_reference_tables(tables)
+        return [lint_config(config_file) for config_file in configs]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=share_reference_tables,
+                                                initargs=(tables,)) as pool:
+        return list(pool.map(lint_config, configs))
+
+
+# Writes the results as text.
+# param:  results list from lint_configs().
+# param:  seconds the whole run took.
+# param:  verbose boolean, True to include the output of the checks for files that failed.
+def report(results, seconds, verbose=False):
+    for result in results:
+        failed = [check for check in sortemu.LINT_CHECKS if not result['checks'].get(check, False)]
+        sys.stdout.write('{0} {1} ({2} rule(s), {3:.3f}s)'.format(
+            'pass' if result['passed'] else 'FAIL', result['file'], result['rules'], result['seconds']))
+        if result['error']:
+            sys.stdout.write(' error: {0}'.format(result['error']))
+        elif failed:
+            sys.stdout.write(' failed: {0}'.format(', '.join(failed)))
+        sys.stdout.write('\n')
+        if verbose and not result['passed']:
+            for line in result['output'].splitlines():
+                sys.stdout.write('    {0}\n'.format(line))
+    passed = len([result for result in results if result['passed']])
+    sys.stdout.write('{0} of {1} matrices passed in {2:.3f}s.\n'.format(passed, len(results), seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks every sort matrix in a directory.")
+    parser.add_argument("directory", action="store", type=str,
+                        help="Directory of .cfg and .xml sort matrices.")
+    parser.add_argument("-j", "--jobs", default=os.cpu_count() or 1, action="store", type=int, required=False,
+                        help="Number of worker processes. Default is one per CPU.")
+    parser.add_argument("--json", default="", action="store", type=str, required=False,
+                        help="Also write the report as JSON to this file.")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, required=False,
+                        help="Show the output of the checks for matrices that fail.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        sys.stderr.write("** error: {0} is not a directory.\n".format(args.directory))
+        sys.exit(-1)
+    configs = find_configs(args.directory)
+    start = time.time()
+    results = lint_configs(configs, args.jobs)
+    seconds = time.time() - start
+    report(results, seconds, args.verbose)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'seconds': seconds, 'passed': len([result for result in results if result['passed']]),
+                       'files': results}, json_file, indent=2)
+    sys.exit(0 if all([result['passed'] for result in results]) else 1)
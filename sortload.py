@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+####################################################
+#
+# Python source for project sorteremu_py
+#
+# Load generator for sizing a sortemu routing service.
+#    Copyright (C) 2026  Edmonton Public Library
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+#
+# Replays items against a routing service started with sortemu.py -S, with one connection for each induction slot,
+# all sending at once. Items come from an item file, or are drawn at random from the location and item type pairs in
+# loc.itype.db. With a target rate each slot sends on a fixed schedule, and a reply's latency is counted from when
+# its request was due rather than when it was sent, so a service that falls behind shows it in the latency instead of
+# quietly lowering the rate. The report has the throughput, the p50, p95 and p99 latencies and the error rate.
+# With -c instead of --target the same items are routed in this process by sortemu.RuleEngine, to measure the
+# engine alone.
+#
+# Typical use:
+#   python sortemu.py -c clv.cfg -S 8080 &
+#   python sortload.py --target localhost:8080 -i items.lst --slots 16 --rate 2000 --requests 100000
+#   python sortload.py -c clv.cfg --synthetic --slots 16 --requests 100000
+#
+####################################################
+import sys
+import math
+import time
+import json
+import random
+import asyncio
+import argparse
+import sortemu
+
+# Percentiles of latency to report.
+PERCENTILES = (50, 95, 99)
+# Libraries and call numbers given to synthetic items, which loc.itype.db doesn't have.
+SYNTHETIC_LIBRARIES = ['EPLMNA', 'EPLCLV', 'EPLSTR', 'EPLWMC']
+SYNTHETIC_CALL_NUMBERS = ['FIC', 'J FIC', 'E PIC', 'DVD', 'CD', 'J 796.332', 'DAISY J 364.1523  DON HEN',
+                          '364.1523', '641.5', '971.23', '005.133', '823.914']
+
+
+# Reads the items to replay.
+# param:  file_name item file, or barcodes if the service has a snapshot. Lines are sent as they are.
+# return: list of item lines.
+def read_items(file_name):
+    with open(file_name, 'r') as item_file:
+        return [line.rstrip('\r\n') for line in item_file if line.strip()]
+
+
+# Makes items from the location and item type pairs of the reference table, with a random library and call number.
+# param:  db_file_name loc.itype.db, or a profile store.
+# param:  count number of items.
+# param:  seed for the random generator, so runs can be repeated.
+# return: list of item lines.
+def synthetic_items(db_file_name, count, seed=None):
+    generator = random.Random(seed)
+    rule_engine = sortemu.RuleEngine()
+    rule_engine.location_itype_db = db_file_name
+    rule_engine.get_master_rule_map(db_file_name)
+    pairs = [(location, item_type) for (location, item_types) in sorted(rule_engine.valid_location_itypes.items())
+             for item_type in sorted(item_types)]
+    if not pairs:
+        return []
+    items = []
+    for i in range(count):
+        (location, item_type) = generator.choice(pairs)
+        items.append('3122{0:010d}|{1}|{2}|{3}|{4}|'.format(i, location, generator.choice(SYNTHETIC_LIBRARIES),
+                                                           item_type, generator.choice(SYNTHETIC_CALL_NUMBERS)))
+    return items
+
+
+# The latencies and errors collected by the slots.
+# param:  slots number of induction slots.
+# param:  rate target requests per second for all the slots together, 0 to send as fast as replies come back.
+class LoadResult:
+    def __init__(self, slots, rate):
+        self.slots = slots
+        self.rate = rate
+        self.latencies = []
+        self.errors = 0
+        self.bins = {}
+        self.error_reasons = {}
+        self.seconds = 0.0
+
+    # Records one reply.
+    # param:  latency seconds from when the request was due to the reply.
+    # param:  reply dictionary from the service, or from RouteServer.reply(), None if there was no reply.
+    def add(self, latency, reply):
+        self.latencies.append(latency)
+        if reply is None or 'error' in reply:
+            self.errors += 1
+            reason = reply.get('error', '') if reply else 'NO_REPLY'
+            self.error_reasons[reason] = self.error_reasons.get(reason, 0) + 1
+        else:
+            self.bins[reply['bin']] = self.bins.get(reply['bin'], 0) + 1
+
+    # Gets a latency percentile.
+    # param:  percent from 0 to 100.
+    # return: the latency in seconds, by the nearest rank, or 0.0 with no replies.
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[max(1, int(math.ceil(percent / 100.0 * len(ordered)))) - 1]
+
+    # Summarizes the run.
+    # return: dictionary of the figures in the report.
+    def summary(self):
+        requests = len(self.latencies)
+        return {'slots': self.slots, 'target_rate': self.rate, 'requests': requests, 'seconds': self.seconds,
+                'throughput': requests / self.seconds if self.seconds else 0.0,
+                'latency': dict([('p{0}'.format(percent), self.percentile(percent)) for percent in PERCENTILES]),
+                'errors': self.errors, 'error_rate': float(self.errors) / requests if requests else 0.0,
+                'error_reasons': self.error_reasons, 'bins': self.bins}
+
+    def report(self):
+        summary = self.summary()
+        sys.stdout.write('{0} request(s) from {1} slot(s) in {2:.3f}s, {3:.1f} request(s) per second'.format(
+            summary['requests'], self.slots, self.seconds, summary['throughput']))
+        if self.rate:
+            sys.stdout.write(' (target {0:.1f})'.format(float(self.rate)))
+        sys.stdout.write('.\n')
+        sys.stdout.write('latency {0}.\n'.format(', '.join(['p{0} {1:.3f}ms'.format(
+            percent, 1000.0 * self.percentile(percent)) for percent in PERCENTILES])))
+        sys.stdout.write('{0} error(s), {1:.2%} of requests.\n'.format(self.errors, summary['error_rate']))
+        for reason in sorted(self.error_reasons):
+            sys.stdout.write('  {0}: {1}\n'.format(reason, self.error_reasons[reason]))
+
+
+# Replays items against a service, or a RuleEngine, from concurrent induction slots.
+# param:  items list of item lines. Slot n sends items n, n + slots, n + 2 * slots and so on, round the list again
+#   if there are more requests than items.
+# param:  requests total number of requests.
+# param:  slots number of induction slots.
+# param:  rate target requests per second for all the slots, 0 for as fast as possible.
+# param:  target (host, port) of the service, or None to route in this process.
+# param:  rule_engine RuleEngine to route with when there is no target.
+class LoadGenerator:
+    def __init__(self, items, requests, slots=8, rate=0.0, target=None, rule_engine=None):
+        self.items = items
+        self.requests = requests
+        self.slots = max(1, min(slots, requests))
+        self.rate = rate
+        self.target = target
+        # In this process, items are answered as the service would, without the network.
+        self.server = sortemu.RouteServer(rule_engine) if rule_engine else None
+
+    # Runs the load.
+    # return: LoadResult.
+    def run(self):
+        return asyncio.run(self._run_())
+
+    async def _run_(self):
+        result = LoadResult(self.slots, self.rate)
+        start = time.perf_counter()
+        await asyncio.gather(*[self._slot_(slot, start, result) for slot in range(self.slots)])
+        result.seconds = time.perf_counter() - start
+        return result
+
+    # Sends one slot's share of the requests.
+    # param:  slot number of the slot.
+    # param:  start perf_counter() time of the run.
+    # param:  result LoadResult to add the replies to.
+    async def _slot_(self, slot, start, result):
+        # Slots are staggered so they don't all send at once.
+        interval = self.slots / float(self.rate) if self.rate else 0.0
+        due = start + slot * interval / self.slots
+        reader = writer = None
+        if self.target:
+            try:
+                (reader, writer) = await asyncio.open_connection(*self.target)
+            except OSError as e:
+                sys.stderr.write("** error: slot {0} can't connect to {1}:{2}, {3}.\n".format(slot, self.target[0],
+                                                                                             self.target[1], e))
+                for request in range(slot, self.requests, self.slots):
+                    result.add(0.0, None)
+                return
+        try:
+            for request in range(slot, self.requests, self.slots):
+                line = self.items[request % len(self.items)]
+                if interval:
+                    wait = due - time.perf_counter()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                else:
+                    due = time.perf_counter()
+                if writer is None:
+                    reply = self.server.reply(line)
+                    result.add(time.perf_counter() - due, reply)
+                    # Let the other slots take a turn, as they would waiting on a socket, once the route is timed.
+                    await asyncio.sleep(0)
+                else:
+                    reply = None
+                    try:
+                        writer.write((line + '\n').encode())
+                        await writer.drain()
+                        answer = await reader.readline()
+                        if answer:
+                            reply = json.loads(answer)
+                    except (OSError, ValueError):
+                        reply = None
+                    result.add(time.perf_counter() - due, reply)
+                due += interval
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays items against a sortemu routing service.")
+    parser.add_argument("-t", "--target", default="", action="store", type=str, required=False,
+                        help="host:port of a service started with sortemu.py -S.")
+    parser.add_argument("-c", "--config", default="", action="store", type=str, required=False,
+                        help="Sort matrix to route with in this process, instead of a --target.")
+    parser.add_argument("-i", "--items", default="", action="store", type=str, required=False,
+                        help="Item file to replay, one item line or barcode per line.")
+    parser.add_argument("--synthetic", action="store_true", default=False, required=False,
+                        help="Draw items from the location and item type pairs of --db instead of an item file.")
+    parser.add_argument("--db", default="loc.itype.db", action="store", type=str, required=False,
+                        help="Location and item type table, or a profile store, for --synthetic. Default loc.itype.db.")
+    parser.add_argument("-n", "--requests", default=0, action="store", type=int, required=False,
+                        help="Number of requests. Default the number of items, or 10000 for --synthetic.")
+    parser.add_argument("-s", "--slots", default=8, action="store", type=int, required=False,
+                        help="Induction slots sending at once, one connection each. Default 8.")
+    parser.add_argument("-r", "--rate", default=0.0, action="store", type=float, required=False,
+                        help="Target requests per second for all slots together. Default as fast as possible.")
+    parser.add_argument("--seed", default=None, action="store", type=int, required=False,
+                        help="Seed for --synthetic items, so runs can be repeated.")
+    parser.add_argument("--json", default="", action="store", type=str, required=False,
+                        help="Also write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    if bool(args.target) == bool(args.config):
+        sys.stderr.write("** error: give either a --target service or a -c matrix to route with in this process.\n")
+        sys.exit(-1)
+    if bool(args.items) == args.synthetic:
+        sys.stderr.write("** error: give either an -i item file or --synthetic.\n")
+        sys.exit(-1)
+    if args.slots < 1 or args.rate < 0:
+        sys.stderr.write("** error: --slots must be at least 1 and --rate can't be negative.\n")
+        sys.exit(-1)
+    target = None
+    if args.target:
+        (host, separator, port) = args.target.rpartition(':')
+        if not port.isdigit():
+            sys.stderr.write("** error: --target expects host:port, not {0}.\n".format(args.target))
+            sys.exit(-1)
+        target = (host or 'localhost', int(port))
+    if args.items:
+        items = read_items(args.items)
+    else:
+        items = synthetic_items(args.db, args.requests or 10000, args.seed)
+    if not items:
+        sys.stderr.write("** error: no items to send.\n")
+        sys.exit(-1)
+    rule_engine = None
+    if args.config:
+        rule_engine = sortemu.RuleEngine()
+        rule_engine.load_config(args.config)
+        rule_engine.compile_rules()
+    generator = LoadGenerator(items, args.requests or len(items), args.slots, args.rate, target, rule_engine)
+    result = generator.run()
+    result.report()
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(result.summary(), json_file, indent=2)
+    sys.exit(0 if result.errors == 0 else 1)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+####################################################
+#
+# Python source for project sorteremu_py
+#
+# Discrete-event simulation of a 3M sorter's bins filling over a day of check-ins.
+#    Copyright (C) 2026  Edmonton Public Library
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+#
+# Items arrive at the induction slots, wait for a free slot, and are routed by sortemu.RuleEngine to a bin. A bin that
+# is full sends further items to the exception bin until staff empty it. The simulation reports when each bin fills,
+# how many items overflow to the exception bin, and the peak induction rate the configuration can sustain.
+#
+# Typical use:
+#   python sortsim.py -c clv.cfg -i checkins.lst --capacity 150 --empty_every 60
+# where checkins.lst has a timestamp in front of each item:
+#   2026-10-19 10:15:02|31221115689585  |PBKMYS|EPLSTR|PBK|870.44|
+# or, with no timestamps, a synthetic arrival rate:
+#   python sortsim.py -c clv.cfg -i items.lst --rate 400 --hours 8
+#
+####################################################
+import sys
+import argparse
+import heapq
+import random
+import datetime
+import sortemu
+
+# Formats accepted for check-in timestamps.
+TIMESTAMP_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y%m%d%H%M%S', '%Y-%m-%d %H:%M', '%H:%M:%S', '%H:%M']
+# Name of the exception bin in reports.
+EXCEPTION_BIN = 'E'
+# Simulation event kinds. Bins are emptied before items landing at the same moment.
+EMPTY = 0
+LAND = 1
+
+
+# Converts a check-in timestamp to a datetime.
+# param:  text timestamp in one of TIMESTAMP_FORMATS, or seconds since the epoch.
+# return: datetime, or None if the timestamp can't be read.
+def parse_timestamp(text):
+    text = text.strip()
+    for time_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, time_format)
+        except ValueError:
+            continue
+    try:
+        return datetime.datetime.fromtimestamp(float(text))
+    except ValueError:
+        return None
+
+
+# Parses a list of 'bin:capacity' pairs like '1:200,11:400'.
+# param:  text string of pairs.
+# return: dictionary of bin name to capacity.
+def parse_capacities(text):
+    capacities = {}
+    for pair in text.split(','):
+        if pair.strip():
+            (bin_name, capacity) = pair.split(':')
+            capacities[bin_name.strip()] = int(capacity)
+    return capacities
+
+
+# Simulates a sorter with a given matrix.
+# param:  rule_engine sortemu.RuleEngine loaded with the matrix.
+# param:  capacity number of items a bin holds, unless set in bin_capacities.
+# param:  bin_capacities dictionary of bin name to capacity for bins that differ from capacity.
+# param:  slots number of induction slots, staff and patron side together.
+# param:  slot_rate items per minute one induction slot can take.
+class SorterSimulator:
+    def __init__(self, rule_engine, capacity=150, bin_capacities=None, slots=2, slot_rate=20.0):
+        self.rule_engine = rule_engine
+        self.capacity = capacity
+        self.bin_capacities = bin_capacities or {}
+        self.slots = slots
+        self.slot_rate = slot_rate
+        # Routes are the same for every item with the same columns, so each combination is only routed once.
+        self.routes = {}
+
+    # Finds the bin an item goes to.
+    # param:  item_columns list of the item's columns, as from RuleEngine.parse_item().
+    # return: the bin name, EXCEPTION_BIN if no rule matches.
+    def route(self, item_columns):
+        key = tuple(item_columns[1:])
+        try:
+            return self.routes[key]
+        except KeyError:
+            result = self.rule_engine.route(item_columns)
+            bin_name = sortemu.bin_name(result[1]) if result else EXCEPTION_BIN
+            self.routes[key] = bin_name
+            return bin_name
+
+    def capacity_of(self, bin_name):
+        return self.bin_capacities.get(bin_name, self.capacity)
+
+    # Reads timestamped check-ins.
+    # param:  file_name file of 'timestamp|item' lines.
+    # return: list of (datetime, item_columns) in time order.
+    def read_checkins(self, file_name):
+        arrivals = []
+        with open(file_name, 'r') as checkin_file:
+            for line in checkin_file:
+                (timestamp, separator, item) = line.partition('|')
+                when = parse_timestamp(timestamp)
+                if when is None:
+                    self.rule_engine.quarantine.reject('TIME', line.strip())
+                    continue
+                item_columns = self.rule_engine.parse_item(item)
+                if item_columns is not None:
+                    arrivals.append((when, item_columns))
+        arrivals.sort(key=lambda arrival: arrival[0])
+        return arrivals
+
+    # Makes a synthetic stream of check-ins, drawing items at random from an item file with exponentially
+    # distributed gaps between them.
+    # param:  file_name item file to draw from.
+    # param:  rate items per hour.
+    # param:  start datetime of the first check-in.
+    # param:  hours length of the stream.
+    # param:  seed for the random number generator, so runs can be repeated.
+    # return: list of (datetime, item_columns) in time order.
+    def synthetic_checkins(self, file_name, rate, start, hours, seed=None):
+        generator = random.Random(seed)
+        items = []
+        with open(file_name, 'r') as item_file:
+            for line in item_file:
+                item_columns = self.rule_engine.parse_item(line)
+                if item_columns is not None:
+                    items.append(item_columns)
+        arrivals = []
+        if not items or rate <= 0:
+            return arrivals
+        elapsed = generator.expovariate(rate / 3600.0)
+        while elapsed < hours * 3600.0:
+            arrivals.append((start + datetime.timedelta(seconds=elapsed), generator.choice(items)))
+            elapsed += generator.expovariate(rate / 3600.0)
+        return arrivals
+
+    # Runs the simulation.
+    # param:  arrivals list of (datetime, item_columns) in time order.
+    # param:  empty_times list of datetimes when staff empty the bins.
+    # return: SimulationResult.
+    def run(self, arrivals, empty_times):
+        result = SimulationResult(self, arrivals, empty_times)
+        if not arrivals:
+            return result
+        # Each item takes a slot for this long, and waits if every slot is busy.
+        service = datetime.timedelta(seconds=60.0 / self.slot_rate)
+        slot_free = [arrivals[0][0]] * self.slots
+        events = []
+        order = 0
+        for (when, item_columns) in arrivals:
+            free = heapq.heappop(slot_free)
+            start = max(when, free)
+            heapq.heappush(slot_free, start + service)
+            result.add_wait((start - when).total_seconds())
+            heapq.heappush(events, (start, LAND, order, self.route(item_columns)))
+            order += 1
+        for when in empty_times:
+            heapq.heappush(events, (when, EMPTY, order, None))
+            order += 1
+        while events:
+            (when, kind, order, bin_name) = heapq.heappop(events)
+            if kind == EMPTY:
+                result.empty(when)
+            else:
+                result.land(when, bin_name)
+        return result
+
+
+# The bin fill levels and counts from a simulation run.
+class SimulationResult:
+    def __init__(self, simulator, arrivals, empty_times):
+        self.simulator = simulator
+        self.arrivals = arrivals
+        self.empty_times = sorted(empty_times)
+        self.fill = {}
+        self.peak_fill = {}
+        self.received = {}
+        self.overflow = {}
+        self.full_times = {}
+        self.exception_overflow = 0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+    def add_wait(self, seconds):
+        self.total_wait += seconds
+        if seconds > self.max_wait:
+            self.max_wait = seconds
+
+    def empty(self, when):
+        for bin_name in self.fill:
+            self.fill[bin_name] = 0
+
+    # Drops an item into its bin, or the exception bin if its bin is full. REJECT routes hand the item back and
+    # don't fill a bin.
+    def land(self, when, bin_name):
+        self.received[bin_name] = self.received.get(bin_name, 0) + 1
+        if bin_name == 'REJECT':
+            return
+        if bin_name != EXCEPTION_BIN and self.fill.get(bin_name, 0) >= self.simulator.capacity_of(bin_name):
+            self.overflow[bin_name] = self.overflow.get(bin_name, 0) + 1
+            bin_name = EXCEPTION_BIN
+        if bin_name == EXCEPTION_BIN and self.fill.get(bin_name, 0) >= self.simulator.capacity_of(bin_name):
+            # Nowhere left to put it; the sorter would stop here until staff clear the exception bin.
+            self.exception_overflow += 1
+            return
+        self.fill[bin_name] = self.fill.get(bin_name, 0) + 1
+        if self.fill[bin_name] > self.peak_fill.get(bin_name, 0):
+            self.peak_fill[bin_name] = self.fill[bin_name]
+        if self.fill[bin_name] == self.simulator.capacity_of(bin_name):
+            self.full_times.setdefault(bin_name, []).append(when)
+
+    # Finds the busiest minute of check-ins.
+    # return: the most items that arrived in any one minute.
+    def peak_arrival_rate(self):
+        per_minute = {}
+        for (when, item_columns) in self.arrivals:
+            minute = when.replace(second=0, microsecond=0)
+            per_minute[minute] = per_minute.get(minute, 0) + 1
+        return max(per_minute.values()) if per_minute else 0
+
+    # Works out the highest steady check-in rate, in items per hour, that fills no bin before it is emptied,
+    # given the share of items each bin gets, and the most the induction slots can take.
+    # return: (sustainable rate, induction limit) in items per hour.
+    def sustainable_rate(self):
+        induction_limit = self.simulator.slots * self.simulator.slot_rate * 60.0
+        times = [self.arrivals[0][0]] + self.empty_times + [self.arrivals[-1][0]] if self.arrivals else []
+        gaps = [(later - earlier).total_seconds() for (earlier, later) in zip(times, times[1:])]
+        longest_gap = max(gaps) / 3600.0 if gaps else 0.0
+        total = sum(self.received.values())
+        rate = induction_limit
+        if longest_gap > 0.0 and total > 0:
+            for (bin_name, count) in self.received.items():
+                if bin_name == 'REJECT' or count == 0:
+                    continue
+                share = count / total
+                rate = min(rate, self.simulator.capacity_of(bin_name) / (share * longest_gap))
+        return rate, induction_limit
+
+    def report(self):
+        sys.stdout.write('simulated {0} check-in(s)'.format(len(self.arrivals)))
+        if self.arrivals:
+            sys.stdout.write(' from {0} to {1}'.format(self.arrivals[0][0], self.arrivals[-1][0]))
+        sys.stdout.write(', bins emptied {0} time(s).\n'.format(len(self.empty_times)))
+        sys.stdout.write('{0:>8} {1:>8} {2:>8} {3:>8} {4:>8}  {5}\n'.format(
+            'bin', 'capacity', 'items', 'peak', 'overflow', 'first full'))
+        for bin_name in sorted(self.received, key=lambda name: (not name.isdigit(), name.zfill(8))):
+            full_times = self.full_times.get(bin_name, [])
+            sys.stdout.write('{0:>8} {1:>8} {2:>8} {3:>8} {4:>8}  {5}\n'.format(
+                bin_name, '-' if bin_name == 'REJECT' else self.simulator.capacity_of(bin_name),
+                self.received[bin_name], self.peak_fill.get(bin_name, 0), self.overflow.get(bin_name, 0),
+                '{0} ({1} time(s))'.format(full_times[0].strftime('%H:%M:%S'), len(full_times)) if full_times else '-'))
+        overflow = sum(self.overflow.values())
+        sys.stdout.write('{0} item(s) overflowed to the exception bin.\n'.format(overflow))
+        if self.exception_overflow:
+            sys.stdout.write('** Warning: {0} item(s) arrived with the exception bin full.\n'.format(
+                self.exception_overflow))
+        if self.arrivals:
+            sys.stdout.write('average wait at induction {0:0.1f}s, longest {1:0.1f}s.\n'.format(
+                self.total_wait / len(self.arrivals), self.max_wait))
+        (rate, induction_limit) = self.sustainable_rate()
+        sys.stdout.write('peak check-in rate {0} item(s) per minute.\n'.format(self.peak_arrival_rate()))
+        sys.stdout.write('sustainable rate {0:0.0f} item(s) per hour without overflow, induction limit {1:0.0f}.\n'
+                         .format(rate, induction_limit))
+
+
+# Works out when staff empty the bins.
+# param:  arrivals list of (datetime, item_columns) in time order.
+# param:  every minutes between emptying, or 0.
+# param:  at comma separated list of 'HH:MM' times of day, or ''.
+# return: sorted list of datetimes.
+def empty_schedule(arrivals, every=0, at=''):
+    if not arrivals:
+        return []
+    (first, last) = (arrivals[0][0], arrivals[-1][0])
+    times = []
+    if every > 0:
+        when = first + datetime.timedelta(minutes=every)
+        while when <= last:
+            times.append(when)
+            when += datetime.timedelta(minutes=every)
+    if at:
+        day = first.date()
+        while day <= last.date():
+            for time_of_day in at.split(','):
+                when = datetime.datetime.combine(day, datetime.datetime.strptime(time_of_day.strip(), '%H:%M').time())
+                if first <= when <= last:
+                    times.append(when)
+            day += datetime.timedelta(days=1)
+    return sorted(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulates bins filling on a sorter over a stream of check-ins.")
+    parser.add_argument("-c", "--config", action="store", type=str, required=True,
+                        help="The sort matrix, in any format sortemu.py reads.")
+    parser.add_argument("-i", "--items", action="store", type=str, required=True,
+                        help="Check-ins as 'timestamp|item' lines, or plain items if --rate is used.")
+    parser.add_argument("-r", "--rate", default=0.0, action="store", type=float, required=False,
+                        help="Check-ins per hour for a synthetic stream drawn from the items file.")
+    parser.add_argument("--hours", default=8.0, action="store", type=float, required=False,
+                        help="Length of a synthetic stream in hours. Default 8.")
+    parser.add_argument("--start", default="09:00", action="store", type=str, required=False,
+                        help="Time of day a synthetic stream starts. Default 09:00.")
+    parser.add_argument("--seed", action="store", type=int, required=False,
+                        help="Random seed for a repeatable synthetic stream.")
+    parser.add_argument("--capacity", default=150, action="store", type=int, required=False,
+                        help="Items each bin holds. Default 150.")
+    parser.add_argument("--bin_capacity", default="", action="store", type=str, required=False,
+                        help="Capacities of bins that differ from --capacity, like '1:200,11:400'. "
+                             "Use E for the exception bin.")
+    parser.add_argument("--empty_every", default=0, action="store", type=int, required=False,
+                        help="Minutes between staff emptying the bins.")
+    parser.add_argument("--empty_at", default="", action="store", type=str, required=False,
+                        help="Times of day staff empty the bins, like '10:00,12:30,15:00'.")
+    parser.add_argument("--slots", default=2, action="store", type=int, required=False,
+                        help="Number of induction slots. Default 2.")
+    parser.add_argument("--slot_rate", default=20.0, action="store", type=float, required=False,
+                        help="Items per minute one induction slot takes. Default 20.")
+    parser.add_argument("-H", "--holds", action="store", type=str, required=False,
+                        help="Holds snapshot, as for sortemu.py -H.")
+    args = parser.parse_args()
+
+    rule_engine = sortemu.RuleEngine()
+    rule_engine.load_config(args.config)
+    # A day of check-ins is held in memory, so share the column values between them.
+    rule_engine.values = sortemu.ValuePool.from_reference_tables()
+    if args.holds:
+        rule_engine.holds = sortemu.HoldSnapshot(args.holds)
+    simulator = SorterSimulator(rule_engine, args.capacity, parse_capacities(args.bin_capacity), args.slots,
+                                args.slot_rate)
+    if args.rate > 0.0:
+        start = datetime.datetime.combine(datetime.date.today(),
+                                          datetime.datetime.strptime(args.start, '%H:%M').time())
+        arrivals = simulator.synthetic_checkins(args.items, args.rate, start, args.hours, args.seed)
+    else:
+        arrivals = simulator.read_checkins(args.items)
+    result = simulator.run(arrivals, empty_schedule(arrivals, args.empty_every, args.empty_at))
+    result.report()
+    if rule_engine.quarantine.quarantined:
+        rule_engine.quarantine.report()